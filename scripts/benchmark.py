@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import logging
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from solid2 import cube, union
+
+from solid2_utils.cache import CacheEntry, CacheIndex, cache_to_stl_advanced
+from solid2_utils import frozen_mod
+from solid2_utils.fingerprint import fingerprint
+from solid2_utils.mod import Mod, tx
+from solid2_utils.render import RenderTask, save_to_file
+
+
+def _bench(fn: Callable[[], object], repeat: int) -> Dict[str, float]:
+    timings: List[float] = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {"min": min(timings), "median": statistics.median(timings), "repeat": repeat}
+
+
+def _deep_mod(depth: int) -> Mod:
+    pos = Mod()
+    for n in range(depth):
+        pos.tx(n).rz(n % 360).ty(-n).mx()
+    return pos
+
+
+def _deep_frozen_mod(depth: int) -> frozen_mod.FrozenMod:
+    pos = frozen_mod.FrozenMod()
+    for n in range(depth):
+        pos = pos.tx(n).rz(n % 360).ty(-n).mx()
+    return pos
+
+
+def _large_tree(parts: int):
+    return union()(*(tx(n).rz(n % 360)(cube([1., 2., 3.])) for n in range(parts)))
+
+
+def _fake_openscad(directory: Path, sleep: float = 0.) -> str:
+    script = directory.joinpath("openscad")
+    script.write_text("#!/bin/sh\n"
+                      f"sleep {sleep}\n"
+                      "while [ $# -gt 0 ]; do\n"
+                      "  if [ \"$1\" = \"-o\" ]; then shift; echo solid > \"$1\"; fi\n"
+                      "  shift\n"
+                      "done\n")
+    script.chmod(0o755)
+    return script.as_posix()
+
+
+def _populate_cache(build_dir: Path, entries: int) -> List[str]:
+    keys = [f"part{n}_{hashlib.md5(str(n).encode()).hexdigest()}" for n in range(entries)]
+    now = time.time()
+    with CacheIndex(build_dir) as index:
+        index.add(CacheEntry(key, build_dir.joinpath(key).with_suffix(".stl"), 1024, 1., now) for key in keys)
+    for key in keys[:100]:
+        build_dir.joinpath(key).with_suffix(".stl").write_text("solid\n")
+    return keys
+
+
+def run_benchmarks(quick: bool) -> Dict[str, Dict[str, float]]:
+    scale = 10 if quick else 1
+    repeat = 3 if quick else 5
+    results: Dict[str, Dict[str, float]] = dict()
+
+    results["mod_construction"] = _bench(lambda: [tx(n).rz(n).ty(n) for n in range(100_000 // scale)], repeat)
+    deep = _deep_mod(2_000 // scale)
+    results["mod_clone_deep"] = _bench(deep.clone, repeat)
+    results["mod_add_deep"] = _bench(lambda: deep + deep, repeat)
+    results["mod_call_deep"] = _bench(lambda: deep(cube(1)), repeat)
+    results["mod_compile_call_deep"] = _bench(lambda: _deep_mod(2_000 // scale)(cube(1), fuse=True), repeat)
+    results["frozen_mod_construction"] = _bench(
+        lambda: [frozen_mod.tx(n).rz(n).ty(n) for n in range(100_000 // scale)], repeat)
+    frozen_deep = _deep_frozen_mod(2_000 // scale)
+    results["frozen_mod_add_deep"] = _bench(lambda: frozen_deep + frozen_deep, repeat)
+    results["frozen_mod_call_deep"] = _bench(lambda: frozen_deep(cube(1)), repeat)
+
+    tree = _large_tree(20_000 // scale)
+    results["as_scad_large_tree"] = _bench(tree.as_scad, repeat)
+    results["md5_fingerprint_large_tree"] = _bench(lambda: hashlib.md5(tree.as_scad().encode()).hexdigest(), repeat)
+    results["structural_fingerprint_large_tree"] = _bench(lambda: fingerprint(tree), repeat)
+    deep_tree = _deep_mod(2_000 // scale)(cube(1))
+    results["md5_fingerprint_deep_tree"] = _bench(lambda: hashlib.md5(deep_tree.as_scad().encode()).hexdigest(), repeat)
+    results["structural_fingerprint_deep_tree"] = _bench(lambda: fingerprint(deep_tree), repeat)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        build_dir = Path(tmp_dir)
+        keys = _populate_cache(build_dir, 10_000 // scale)
+        with CacheIndex(build_dir) as index:
+            results["cache_index_lookup_hit"] = _bench(lambda: index.lookup(keys), repeat)
+            results["cache_index_lookup_miss"] = _bench(lambda: index.lookup(f"{key}_miss" for key in keys), repeat)
+        parts = [(cube(n), Path(f"part{n}")) for n in range(100)]
+        cache_to_stl_advanced(parts, build_dir, _fake_openscad(build_dir))
+        results["cache_to_stl_advanced_hit"] = _bench(
+            lambda: cache_to_stl_advanced(parts, build_dir, _fake_openscad(build_dir)), repeat)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_dir = Path(tmp_dir)
+        openscad_bin = _fake_openscad(output_dir, .05)
+        tasks = [RenderTask(cube(n), output_dir.joinpath(f"part{n}")) for n in range(200 // scale)]
+        results["save_to_file_throughput"] = _bench(
+            lambda: save_to_file(openscad_bin, tasks, file_types=[".stl"]), max(repeat // 2, 1))
+
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float) -> bool:
+    ok = True
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:32} {result["median"]:10.4f}s (new)")
+            continue
+        ratio = result["median"] / baseline[name]["median"] if baseline[name]["median"] > 0. else 1.
+        regression = ratio > 1. + threshold
+        ok = ok and not regression
+        print(f"{name:32} {result["median"]:10.4f}s {ratio:6.2f}x{"  REGRESSION" if regression else ""}")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="benchmark", description="Benchmarks for the solid2_utils hot paths")
+    parser.add_argument('--output', type=str, default="bench_output.json")
+    parser.add_argument('--compare', type=str)
+    parser.add_argument('--threshold', type=float, default=.2)
+    parser.add_argument('--quick', action='store_true')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = run_benchmarks(args.quick)
+    Path(args.output).write_text(json.dumps({"python": platform.python_version(), "machine": platform.machine(),
+                                             "quick": args.quick, "results": results}, indent=2))
+
+    if args.compare is None:
+        for name, result in results.items():
+            print(f"{name:32} {result["median"]:10.4f}s")
+        return
+    baseline = json.loads(Path(args.compare).read_text())["results"]
+    if not compare(results, baseline, args.threshold):
+        sys.exit(1)
+
+
+if "__main__" == __name__:
+    main()
@@ -1,18 +1,34 @@
-import functools
+from __future__ import annotations
+
+import copy
+import gzip
 import hashlib
+import itertools
 import logging
+import os
+import re
 import shutil
+import sqlite3
+import struct
+import threading
+import time
+from dataclasses import dataclass
 from functools import partial
 from pathlib import Path
-from typing import Callable, Iterable, Tuple, Dict, List
+from typing import Callable, Generator, Iterable, Tuple, Dict, List, TYPE_CHECKING
+
+from solid2_utils.cache_backend import CacheBackend, FileLock
+from solid2_utils.render import (RENDER_TIMINGS_FILENAME, RenderExecutor, RenderMetrics, RenderMetricsCollector,
+                                 RenderTask, save_to_file, _clone_file, _fix_paths, _openscad_version)
 
-from solid2 import import_stl
-from solid2.core.object_base import OpenSCADObject
-from solid2.extensions.bosl2.bosl2_base import Bosl2Base
+if TYPE_CHECKING:
+    from solid2.core.object_base import OpenSCADObject
+    from solid2.core.object_base.object_base_impl import BareOpenSCADObject
+    from solid2.extensions.bosl2.bosl2_base import Bosl2Base
 
-from solid2_utils.render import RenderTask, save_to_file, _wslpath
+    from solid2_utils.fingerprint import FingerprintMemo
 
-OpenSCADCacheFN = Callable[[Iterable[Tuple[OpenSCADObject, Path]]], Dict[str, OpenSCADObject]]
+OpenSCADCacheFN = Callable[[Iterable[Tuple["OpenSCADObject", Path]]], Dict[str, "OpenSCADObject"]]
 
 
 def default_no_cache_to_stl(obj_list: Iterable[Tuple[OpenSCADObject, Path]]) -> Dict[str, OpenSCADObject]:
@@ -33,38 +49,615 @@ def set_cache_to_stl_cache_function(cache_fn: OpenSCADCacheFN) -> OpenSCADCacheF
     return old
 
 
-def set_cache_to_stl_setting(openscad_bin: str, cache_dir: Path) -> OpenSCADCacheFN:
-    cache_fn = partial(cache_to_stl_advanced, openscad_bin=openscad_bin, build_dir=cache_dir)
+def set_cache_to_stl_setting(openscad_bin: str, cache_dir: Path, max_cache_bytes: int | None = None,
+                             executor: RenderExecutor | None = None,
+                             metrics: RenderMetricsCollector | None = None,
+                             compress_after: float | None = None,
+                             backend: CacheBackend | None = None) -> OpenSCADCacheFN:
+    cache_fn = partial(cache_to_stl_advanced, openscad_bin=openscad_bin, build_dir=cache_dir,
+                       max_cache_bytes=max_cache_bytes, executor=executor, metrics=metrics,
+                       compress_after=compress_after, backend=backend)
     return set_cache_to_stl_cache_function(cache_fn)
 
 
-def cache_to_stl_advanced(obj_list: Iterable[Tuple[OpenSCADObject | Bosl2Base, Path]], build_dir: Path, openscad_bin: str) -> Dict[
-    str, OpenSCADObject | Bosl2Base]:
-    fix_path = functools.partial(_wslpath, convert=openscad_bin.startswith("wsl"))
-    rts_all = [RenderTask(obj, build_dir.joinpath(name)) for obj, name in obj_list]
-    rts_filtered: List[RenderTask] = list()
-    for n in range(len(rts_all)):
-        rts_all[n].filename = Path(
-            Path(rts_all[n].filename).as_posix() + "_" + hashlib.md5(rts_all[n].scad_object.as_scad().encode()).hexdigest())
-        if not Path(rts_all[n].filename).with_suffix(".stl").exists():
-            rts_filtered.append(rts_all[n])
+@dataclass
+class CacheEntry:
+    key: str
+    path: Path
+    size: int
+    render_time: float
+    last_access: float
+    blob: str | None = None
+
+
+Bounds = Tuple[Tuple[float, float, float], Tuple[float, float, float]]
+
+_STL_HEADER = b"solid2_utils binary STL".ljust(80, b"\0")
+_STL_FACET = struct.Struct("<12fH")
+
+
+def _is_binary_stl(filename: Path) -> bool:
+    size = filename.stat().st_size
+    if size < 84:
+        return False
+    with open(filename, "rb") as f:
+        f.seek(80)
+        return size == 84 + 50 * struct.unpack("<I", f.read(4))[0]
+
+
+def _iter_ascii_stl_facets(lines: Iterable[bytes]) -> Generator[List[float], None, None]:
+    values: List[float] = list()
+    for line in lines:
+        words = line.split()
+        if len(words) == 0:
+            continue
+        if words[0] == b"facet":
+            values = [float(v) for v in words[2:5]]
+        elif words[0] == b"vertex":
+            values.extend(float(v) for v in words[1:4])
+        elif words[0] == b"endfacet":
+            if len(values) != 12:
+                raise ValueError(f"Malformed STL facet {values}")
+            yield values
+
+
+def _normalize_stl(src: Path, dst: Path) -> bool:
+    if _is_binary_stl(src):
+        with open(src, "rb") as f, open(dst, "wb") as out:
+            f.seek(80)
+            out.write(_STL_HEADER)
+            shutil.copyfileobj(f, out)
+        return True
+    with open(src, "rb") as f:
+        if f.read(5) != b"solid":
+            return False
+        f.seek(0)
+        try:
+            with open(dst, "wb") as out:
+                out.write(_STL_HEADER + bytes(4))
+                count = 0
+                for facet in _iter_ascii_stl_facets(f):
+                    out.write(_STL_FACET.pack(*facet, 0))
+                    count += 1
+                out.seek(80)
+                out.write(struct.pack("<I", count))
+        except ValueError as ex:
+            logging.warning(f"Keeping {src} as is, could not parse it: {ex}")
+            dst.unlink(missing_ok=True)
+            return False
+    return True
+
+
+def _stl_bounds(filename: Path) -> Bounds | None:
+    import numpy as np
+    with (gzip.open(filename, "rb") if filename.suffix == ".gz" else open(filename, "rb")) as f:
+        data = f.read()
+    count = struct.unpack("<I", data[80:84])[0] if len(data) >= 84 else -1
+    if len(data) == 84 + 50 * count:
+        facets = np.frombuffer(data, dtype=np.dtype([("normal", "<f4", 3), ("vertices", "<f4", (3, 3)),
+                                                     ("attribute", "<u2")]), count=count, offset=84)
+        vertices = facets["vertices"].reshape(-1, 3)
+    else:
+        vertices = np.array([facet[3:] for facet in _iter_ascii_stl_facets(data.splitlines())]).reshape(-1, 3)
+    if len(vertices) == 0:
+        return None
+    low, high = vertices.min(axis=0), vertices.max(axis=0)
+    return (float(low[0]), float(low[1]), float(low[2])), (float(high[0]), float(high[1]), float(high[2]))
+
+
+class ArtifactStore:
+    DIRNAME = "objects"
+
+    def __init__(self, build_dir: Path):
+        self.root = build_dir.joinpath(self.DIRNAME)
+
+    def blob_path(self, digest: str, compressed: bool = False) -> Path:
+        return self.root.joinpath(digest[:2], digest + (".stl.gz" if compressed else ".stl"))
+
+    def size(self, digest: str) -> int:
+        for blob in (self.blob_path(digest), self.blob_path(digest, compressed=True)):
+            if blob.exists():
+                return blob.stat().st_size
+        return 0
+
+    def put(self, filename: Path) -> str | None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.root.joinpath(f"{filename.name}.{os.getpid()}.tmp")
+        if not _normalize_stl(filename, tmp):
+            return None
+        with open(tmp, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        blob = self.blob_path(digest)
+        blob.parent.mkdir(exist_ok=True)
+        if blob.exists() or self.blob_path(digest, compressed=True).exists():
+            tmp.unlink()
         else:
-            logging.info(f"Found {rts_all[n].filename} im cache")
+            os.replace(tmp, blob)
+        self.materialize(digest, filename)
+        return digest
+
+    def materialize(self, digest: str, filename: Path) -> bool:
+        # the index vouches for the blob, one that went missing anyway only shows up when it is opened
+        blob = self.blob_path(digest)
+        try:
+            _clone_file(blob, filename)
+            return True
+        except FileNotFoundError:
+            pass
+        tmp = blob.with_name(f"{blob.name}.{os.getpid()}.tmp")
+        try:
+            with gzip.open(self.blob_path(digest, compressed=True), "rb") as src, open(tmp, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        except FileNotFoundError:
+            return False
+        os.replace(tmp, blob)
+        self.blob_path(digest, compressed=True).unlink(missing_ok=True)
+        _clone_file(blob, filename)
+        return True
+
+    def compress(self, digest: str) -> None:
+        blob = self.blob_path(digest)
+        if not blob.exists():
+            return
+        tmp = blob.with_name(f"{blob.name}.{os.getpid()}.tmp")
+        with open(blob, "rb") as src, gzip.open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp, self.blob_path(digest, compressed=True))
+        blob.unlink()
+
+    def remove(self, digest: str) -> None:
+        self.blob_path(digest).unlink(missing_ok=True)
+        self.blob_path(digest, compressed=True).unlink(missing_ok=True)
+
+
+class CacheIndex:
+    FILENAME = "cache_index.sqlite"
+    _MAX_SQL_VARIABLES = 900
+    _COLUMNS = "key, path, size, render_time, last_access, blob"
+
+    def __init__(self, build_dir: Path):
+        self.build_dir = build_dir
+        self.store = ArtifactStore(build_dir)
+        build_dir.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(build_dir.joinpath(self.FILENAME), timeout=60.)
+        with self._db:
+            # processes opening a fresh index at once must not interleave the schema check and migration
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("CREATE TABLE IF NOT EXISTS artifacts (key TEXT PRIMARY KEY, path TEXT NOT NULL, "
+                             "size INTEGER NOT NULL, render_time REAL NOT NULL, last_access REAL NOT NULL)")
+            if "blob" not in {row[1] for row in self._db.execute("PRAGMA table_info(artifacts)")}:
+                self._db.execute("ALTER TABLE artifacts ADD COLUMN blob TEXT")
+            self._db.execute("CREATE INDEX IF NOT EXISTS artifacts_last_access ON artifacts(last_access)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS artifacts_blob ON artifacts(blob)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS bounds (digest TEXT PRIMARY KEY, min_x REAL, min_y REAL, "
+                             "min_z REAL, max_x REAL, max_y REAL, max_z REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS failures (key TEXT PRIMARY KEY, time REAL NOT NULL)")
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __enter__(self) -> CacheIndex:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _to_entry(self, row: Tuple[str, str, int, float, float, str | None]) -> CacheEntry:
+        key, path, size, render_time, last_access, blob = row
+        return CacheEntry(key, self.build_dir.joinpath(path), size, render_time, last_access, blob)
+
+    def lookup(self, keys: Iterable[str], touch: bool = True) -> Dict[str, CacheEntry]:
+        found: Dict[str, CacheEntry] = dict()
+        for chunk in itertools.batched(dict.fromkeys(keys), self._MAX_SQL_VARIABLES):
+            rows = self._db.execute(
+                f"SELECT {self._COLUMNS} FROM artifacts WHERE key IN ({",".join("?" * len(chunk))})", chunk)
+            found.update((row[0], self._to_entry(row)) for row in rows)
+        if touch and len(found) > 0:
+            now = time.time()
+            with self._db:
+                self._db.executemany("UPDATE artifacts SET last_access = ? WHERE key = ?",
+                                     ((now, key) for key in found))
+            for entry in found.values():
+                entry.last_access = now
+        return found
+
+    def add(self, entries: Iterable[CacheEntry]) -> None:
+        with self._db:
+            self._db.executemany(f"INSERT OR REPLACE INTO artifacts ({self._COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                                 ((e.key, e.path.relative_to(self.build_dir).as_posix(), e.size, e.render_time,
+                                   e.last_access, e.blob) for e in entries))
+
+    def ingest(self, entries: Iterable[CacheEntry]) -> None:
+        entries = list(entries)
+        for entry in entries:
+            entry.blob = self.store.put(entry.path)
+            if entry.blob is not None:
+                entry.size = _artifact_size(entry.path) - entry.path.stat().st_size
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?)",
+                                 ((e.blob, self.store.size(e.blob)) for e in entries if e.blob is not None))
+        self.add(entries)
+
+    def materialize(self, entry: CacheEntry) -> bool:
+        if entry.path.exists():
+            return True
+        if entry.blob is None or not self.store.materialize(entry.blob, entry.path):
+            return False
+        with self._db:
+            self._db.execute("UPDATE blobs SET size = ? WHERE digest = ?", (self.store.size(entry.blob), entry.blob))
+        return True
+
+    def bounds(self, entries: Iterable[CacheEntry]) -> Dict[str, Bounds]:
+        entries = list(entries)
+        known: Dict[str, Bounds] = dict()
+        for chunk in itertools.batched(dict.fromkeys(e.blob for e in entries if e.blob is not None),
+                                       self._MAX_SQL_VARIABLES):
+            rows = self._db.execute(f"SELECT * FROM bounds WHERE digest IN ({",".join("?" * len(chunk))})", chunk)
+            known.update((digest, (tuple(v[:3]), tuple(v[3:]))) for digest, *v in rows)
+        found: Dict[str, Bounds] = dict()
+        computed: Dict[str, Bounds] = dict()
+        for entry in entries:
+            if entry.blob in known:
+                found[entry.key] = known[entry.blob]
+                continue
+            if not self.materialize(entry):
+                continue
+            bounds = _stl_bounds(entry.path)
+            if bounds is None:
+                continue
+            found[entry.key] = bounds
+            if entry.blob is not None:
+                computed[entry.blob] = known[entry.blob] = bounds
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO bounds VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 ((digest, *low, *high) for digest, (low, high) in computed.items()))
+        return found
+
+    def failures(self, keys: Iterable[str]) -> set[str]:
+        found: set[str] = set()
+        for chunk in itertools.batched(dict.fromkeys(keys), self._MAX_SQL_VARIABLES):
+            rows = self._db.execute(f"SELECT key FROM failures WHERE key IN ({",".join("?" * len(chunk))})", chunk)
+            found.update(key for key, in rows)
+        return found
+
+    def record_failures(self, keys: Iterable[str]) -> None:
+        now = time.time()
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO failures VALUES (?, ?)", ((key, now) for key in keys))
 
-    if len(rts_filtered) > 0:
-        save_to_file(openscad_bin, rts_filtered, file_types=[".stl"])
-        for rts in rts_filtered:
-            filename = Path(rts.filename).as_posix()[:-32]
+    def clear_failures(self, before: float | None = None) -> None:
+        with self._db:
+            if before is None:
+                self._db.execute("DELETE FROM failures")
+            else:
+                self._db.execute("DELETE FROM failures WHERE time < ?", (before,))
+
+    def compress_cold(self, before: float, keep: Iterable[str] = ()) -> List[str]:
+        keep_blobs = {entry.blob for entry in self.lookup(keep, touch=False).values()}
+        rows = self._db.execute("SELECT blob FROM artifacts WHERE blob IS NOT NULL GROUP BY blob "
+                                "HAVING MAX(last_access) < ?", (before,)).fetchall()
+        compressed: List[str] = list()
+        for (digest,) in rows:
+            if digest in keep_blobs or not self.store.blob_path(digest).exists():
+                continue
+            for (path,) in self._db.execute("SELECT path FROM artifacts WHERE blob = ?", (digest,)).fetchall():
+                self.build_dir.joinpath(path).unlink(missing_ok=True)
+            self.store.compress(digest)
+            compressed.append(digest)
+            logging.info(f"Compressed {digest} in cache")
+        with self._db:
+            self._db.executemany("UPDATE blobs SET size = ? WHERE digest = ?",
+                                 ((self.store.size(digest), digest) for digest in compressed))
+        return compressed
+
+    def total_size(self) -> int:
+        return (self._db.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()[0] +
+                self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0])
+
+    def evict(self, max_bytes: int, keep: Iterable[str] = ()) -> List[CacheEntry]:
+        total = self.total_size()
+        if total <= max_bytes:
+            return []
+        keep_keys = set(keep)
+        evicted: List[CacheEntry] = list()
+        rows = self._db.execute(f"SELECT {self._COLUMNS} FROM artifacts ORDER BY last_access ASC").fetchall()
+        references: Dict[str, int] = dict(
+            self._db.execute("SELECT blob, COUNT(*) FROM artifacts WHERE blob IS NOT NULL GROUP BY blob"))
+        blob_sizes: Dict[str, int] = dict(self._db.execute("SELECT digest, size FROM blobs"))
+        removed_blobs: List[str] = list()
+        for row in rows:
+            if total <= max_bytes:
+                break
+            entry = self._to_entry(row)
+            if entry.key in keep_keys:
+                continue
             for suffix in (".stl", ".scad"):
-                filename_last = Path(filename + "last").with_suffix(suffix)
-                if filename_last.exists():
-                    filename_last.unlink()
-                try:
-                    filename_last.symlink_to(Path(rts.filename).with_suffix(suffix))
-                except OSError as ex:
-                    try:
-                        shutil.copy(Path(rts.filename).with_suffix(suffix), filename_last)
-                    except OSError as ex:
-                        pass
-
-    return {str(Path(r.filename).stem[:-33]): import_stl(fix_path(Path(r.filename).with_suffix(".stl"))) for r in rts_all}
+                entry.path.with_suffix(suffix).unlink(missing_ok=True)
+            FileLock(self.build_dir.joinpath("locks", entry.key[-32:] + ".lock")).remove()
+            total -= entry.size
+            if entry.blob is not None:
+                references[entry.blob] -= 1
+                if references[entry.blob] == 0:
+                    self.store.remove(entry.blob)
+                    total -= blob_sizes.get(entry.blob, 0)
+                    removed_blobs.append(entry.blob)
+            evicted.append(entry)
+            logging.info(f"Evicted {entry.path} from cache")
+        with self._db:
+            self._db.executemany("DELETE FROM artifacts WHERE key = ?", ((e.key,) for e in evicted))
+            self._db.executemany("DELETE FROM blobs WHERE digest = ?", ((digest,) for digest in removed_blobs))
+            self._db.executemany("DELETE FROM bounds WHERE digest = ?", ((digest,) for digest in removed_blobs))
+        return evicted
+
+
+def _artifact_size(filename: Path) -> int:
+    return sum(f.stat().st_size for f in (filename.with_suffix(".stl"), filename.with_suffix(".scad")) if f.exists())
+
+
+def _publish_last(filename: Path) -> None:
+    for suffix in (".stl", ".scad"):
+        target = filename.with_suffix(suffix)
+        filename_last = Path(filename.as_posix()[:-32] + "last").with_suffix(suffix)
+        tmp = filename_last.with_name(f"{filename_last.name}.{os.getpid()}.tmp")
+        tmp.unlink(missing_ok=True)
+        try:
+            tmp.symlink_to(target)
+        except OSError:
+            try:
+                _clone_file(target, tmp)
+            except OSError:
+                continue
+        os.replace(tmp, filename_last)
+
+
+def _render_cached(obj_list: Iterable[Tuple[OpenSCADObject | Bosl2Base, Path]], build_dir: Path, openscad_bin: str,
+                   max_cache_bytes: int | None = None, executor: RenderExecutor | None = None,
+                   metrics: RenderMetricsCollector | None = None, memo: FingerprintMemo | None = None,
+                   compress_after: float | None = None, backend: CacheBackend | None = None) -> List[RenderTask]:
+    from solid2_utils.fingerprint import fingerprint
+    rts_all = [RenderTask(obj, build_dir.joinpath(name)) for obj, name in obj_list]
+    hash_s: Dict[Path, float] = dict()
+    memo = dict() if memo is None else memo
+    for rt in rts_all:
+        start = time.perf_counter()
+        rt.filename = Path(Path(rt.filename).as_posix() + "_" + fingerprint(rt.scad_object, memo))
+        hash_s[Path(rt.filename).absolute()] = time.perf_counter() - start
+    rts_by_key = {Path(rt.filename).relative_to(build_dir).as_posix(): rt for rt in rts_all}
+    locks: Dict[str, FileLock] = dict()
+
+    def add_metrics(rts: Iterable[RenderTask], cache: str) -> None:
+        if metrics is not None:
+            now = time.time()
+            for rt in rts:
+                filename = Path(rt.filename).absolute()
+                metrics.add(RenderMetrics(filename.as_posix(), start=now, end=now, hash_s=hash_s[filename],
+                                          output_sizes={".stl": _artifact_size(filename)}, cache=cache, ok=True))
+
+    def found_in_cache(index: CacheIndex, keys: Iterable[str]) -> List[str]:
+        hits = index.lookup(keys)
+        missing: List[str] = list()
+        found_on_disk: List[CacheEntry] = list()
+        for key in keys:
+            rt = rts_by_key[key]
+            stl_filename = Path(rt.filename).with_suffix(".stl")
+            if key in hits and index.materialize(hits[key]):
+                logging.info(f"Found {rt.filename} im cache")
+            elif stl_filename.exists():
+                # only ever published by rename, so an existing file is complete
+                logging.info(f"Found {rt.filename} im cache")
+                found_on_disk.append(CacheEntry(key, stl_filename, _artifact_size(Path(rt.filename)), 0., time.time()))
+            else:
+                missing.append(key)
+        index.ingest(found_on_disk)
+        add_metrics((rts_by_key[key] for key in keys if key not in missing), "hit")
+        return missing
+
+    def render(index: CacheIndex, keys: List[str]) -> None:
+        shared: List[str] = list()
+        if backend is not None:
+            for key in keys:
+                stl_filename = Path(rts_by_key[key].filename).with_suffix(".stl")
+                if backend.get(key[-32:], stl_filename):
+                    logging.info(f"Found {rts_by_key[key].filename} in shared cache")
+                    shared.append(key)
+            index.ingest(CacheEntry(key, Path(rts_by_key[key].filename).with_suffix(".stl"),
+                                    _artifact_size(Path(rts_by_key[key].filename)), 0., time.time()) for key in shared)
+            add_metrics((rts_by_key[key] for key in shared), "shared")
+        keys = [key for key in keys if key not in shared]
+        if len(keys) == 0:
+            return
+        # rendered next to the cache under a private name and renamed into place once complete
+        staging_dir = build_dir.joinpath("staging", f"{os.getpid()}_{threading.get_ident()}")
+        staging_dir.mkdir(parents=True, exist_ok=True)
+        staged = {staging_dir.joinpath(str(n)).absolute(): key for n, key in enumerate(keys)}
+        render_metrics = RenderMetricsCollector() if metrics is not None else None
+        try:
+            elapsed_by_key = {staged[filename]: elapsed for filename, elapsed in
+                              save_to_file(openscad_bin, [RenderTask(rts_by_key[key].scad_object, filename)
+                                                          for filename, key in staged.items()], file_types=[".stl"],
+                                           timings_filename=build_dir.joinpath(RENDER_TIMINGS_FILENAME),
+                                           executor=executor, metrics=render_metrics)}
+            rendered: List[CacheEntry] = list()
+            for filename, key in staged.items():
+                target = Path(rts_by_key[key].filename)
+                if not filename.with_suffix(".stl").exists():
+                    continue
+                if filename.with_suffix(".scad").exists():
+                    os.replace(filename.with_suffix(".scad"), target.with_suffix(".scad"))
+                os.replace(filename.with_suffix(".stl"), target.with_suffix(".stl"))
+                rendered.append(CacheEntry(key, target.with_suffix(".stl"), _artifact_size(target),
+                                           elapsed_by_key.get(key, 0.), time.time()))
+                if backend is not None:
+                    backend.put(key[-32:], target.with_suffix(".stl"))
+                _publish_last(target)
+            index.ingest(rendered)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        if render_metrics is not None:
+            for task_metrics in render_metrics.metrics:
+                key = staged[Path(task_metrics.name)]
+                task_metrics.name = Path(rts_by_key[key].filename).absolute().as_posix()
+                task_metrics.hash_s += hash_s.get(Path(task_metrics.name), 0.)
+                task_metrics.cache = "miss"
+                metrics.add(task_metrics)
+
+    try:
+        with CacheIndex(build_dir) as index:
+            missing = found_in_cache(index, list(rts_by_key.keys()))
+            # another process rendering the same fingerprint holds its lock, so wait for it instead of rendering twice
+            busy: List[str] = list()
+            for key in missing:
+                locks[key] = FileLock(build_dir.joinpath("locks", key[-32:] + ".lock"))
+                if not locks[key].acquire(blocking=False):
+                    busy.append(key)
+            owned = [key for key in missing if key not in busy]
+            render(index, found_in_cache(index, owned) if len(owned) > 0 else [])
+            for key in owned:
+                locks[key].release()
+            if len(busy) > 0:
+                logging.info(f"Waiting for {len(busy)} renders of other processes")
+                for key in busy:
+                    locks[key].acquire()
+                render(index, found_in_cache(index, busy))
+
+            if max_cache_bytes is not None:
+                index.evict(max_cache_bytes, keep=rts_by_key.keys())
+            if compress_after is not None:
+                index.compress_cold(time.time() - compress_after, keep=rts_by_key.keys())
+    finally:
+        for lock in locks.values():
+            lock.release()
+
+    return rts_all
+
+
+def cache_to_stl_advanced(obj_list: Iterable[Tuple[OpenSCADObject | Bosl2Base, Path]], build_dir: Path, openscad_bin: str,
+                          max_cache_bytes: int | None = None,
+                          executor: RenderExecutor | None = None,
+                          metrics: RenderMetricsCollector | None = None,
+                          compress_after: float | None = None,
+                          backend: CacheBackend | None = None) -> Dict[str, OpenSCADObject | Bosl2Base]:
+    from solid2 import import_stl
+    rts_all = _render_cached(obj_list, build_dir, openscad_bin, max_cache_bytes, executor, metrics,
+                             compress_after=compress_after, backend=backend)
+    stl_filenames = _fix_paths((Path(r.filename).with_suffix(".stl") for r in rts_all),
+                               convert=openscad_bin.startswith("wsl"))
+    return {str(Path(r.filename).stem[:-33]): import_stl(stl_filename) for r, stl_filename in zip(rts_all, stl_filenames)}
+
+
+SUBTREE_CACHE_NODE_TYPES = ("minkowski", "hull")
+SUBTREE_CACHE_REPEATED_NODE_TYPES = ("union", "difference", "intersection", "minkowski", "hull", "render",
+                                     "linear_extrude", "rotate_extrude")
+SUBTREE_FAILURE_TTL = 24 * 60 * 60
+_3D_NODE_TYPES = ("cube", "sphere", "cylinder", "polyhedron", "surface", "linear_extrude", "rotate_extrude")
+_SPECIAL_VARIABLE_RE = re.compile(r"(\$f[nas])\s*=\s*([^;]+);")
+
+SpecialVariables = Tuple[Tuple[str, str], ...]
+
+
+def _special_variables(node: BareOpenSCADObject, inherited: SpecialVariables) -> SpecialVariables:
+    # $fn, $fa and $fs set by a node or an assignment among its children apply to the whole subtree
+    variables = dict(inherited)
+    for name in ("fn", "fa", "fs"):
+        if node._params.get(f"_{name}") is not None:
+            variables[f"${name}"] = str(node._params[f"_{name}"])
+    for c in node._children:
+        value = getattr(c, "value", None)
+        if isinstance(value, str):
+            variables.update(_SPECIAL_VARIABLE_RE.findall(value))
+    return tuple(sorted(variables.items()))
+
+
+def _failure_key(key: str, openscad_bin: str) -> str:
+    try:
+        version = _openscad_version(openscad_bin)
+    except OSError:
+        version = ""
+    return hashlib.md5("\0".join([key, openscad_bin, version]).encode()).hexdigest()
+
+
+def cache_subtrees(scad_object: OpenSCADObject | Bosl2Base, build_dir: Path, openscad_bin: str,
+                   node_types: Iterable[str] = SUBTREE_CACHE_NODE_TYPES, min_repeats: int = 2,
+                   max_cache_bytes: int | None = None, executor: RenderExecutor | None = None,
+                   metrics: RenderMetricsCollector | None = None,
+                   failure_ttl: float = SUBTREE_FAILURE_TTL) -> OpenSCADObject | Bosl2Base:
+    from solid2 import import_stl, scad_inline, union
+    from solid2.core.object_base.object_base_impl import BareOpenSCADObject
+
+    from solid2_utils.fingerprint import fingerprint, node_digest
+    expensive_types = set(node_types) - {"color"}
+    repeated_types = expensive_types | set(SUBTREE_CACHE_REPEATED_NODE_TYPES)
+    memo: FingerprintMemo = dict()
+    node_digest(scad_object, memo)
+    counts: Dict[bytes, int] = dict()
+    is_3d: Dict[bytes, bool] = dict()
+    stack: List[BareOpenSCADObject] = [scad_object]
+    order: List[BareOpenSCADObject] = list()
+    while len(stack) > 0:
+        node = stack.pop()
+        counts[memo[id(node)]] = counts.get(memo[id(node)], 0) + 1
+        order.append(node)
+        stack.extend(c for c in node._children if isinstance(c, BareOpenSCADObject))
+    # only 3D results can round trip through STL, 2D ones would fail to export on every build
+    for node in reversed(order):
+        is_3d[memo[id(node)]] = node._name in _3D_NODE_TYPES or (
+                node._name != "projection" and any(is_3d.get(memo.get(id(c)), False) for c in node._children))
+
+    def is_candidate(node: BareOpenSCADObject) -> bool:
+        return node is not scad_object and len(node._children) > 0 and is_3d[memo[id(node)]] and (
+                node._name in expensive_types or (node._name in repeated_types and counts[memo[id(node)]] >= min_repeats))
+
+    selected: Dict[Tuple[bytes, SpecialVariables], BareOpenSCADObject] = dict()
+    context_stack: List[Tuple[BareOpenSCADObject, SpecialVariables]] = [(scad_object, ())]
+    while len(context_stack) > 0:
+        node, variables = context_stack.pop()
+        if is_candidate(node):
+            selected.setdefault((memo[id(node)], variables), node)
+        else:
+            variables = _special_variables(node, variables)
+            context_stack.extend((c, variables) for c in node._children if isinstance(c, BareOpenSCADObject))
+
+    def in_context(node: BareOpenSCADObject, variables: SpecialVariables) -> BareOpenSCADObject:
+        if len(variables) == 0:
+            return node
+        return union()(scad_inline("".join(f"{name}={value};\n" for name, value in variables)), node)
+
+    subtrees = {key: in_context(node, key[1]) for key, node in selected.items()}
+    # a failure may be down to the OpenSCAD setup rather than the subtree, so it only counts for the same binary and
+    # version and only for a while
+    failure_keys = {key: _failure_key(fingerprint(subtree, memo), openscad_bin) for key, subtree in subtrees.items()}
+    with CacheIndex(build_dir) as index:
+        index.clear_failures(before=time.time() - failure_ttl)
+        failed = index.failures(failure_keys.values())
+    subtrees = {key: subtree for key, subtree in subtrees.items() if failure_keys[key] not in failed}
+    if len(subtrees) == 0:
+        return scad_object
+
+    rts = _render_cached(((subtree, Path(f"{selected[key]._name}_{key[0].hex()[:8]}")) for key, subtree in
+                          subtrees.items()), build_dir, openscad_bin, max_cache_bytes, executor, metrics, memo)
+    cached: Dict[Tuple[bytes, SpecialVariables], Path] = dict()
+    for key, rt in zip(subtrees.keys(), rts):
+        stl_filename = Path(rt.filename).with_suffix(".stl")
+        if stl_filename.exists():
+            cached[key] = stl_filename
+        else:
+            logging.warning(f"Could not cache subtree {rt.filename}, keeping it inline")
+    with CacheIndex(build_dir) as index:
+        index.record_failures(failure_keys[key] for key in subtrees if key not in cached)
+    replacements: Dict[Tuple[bytes, SpecialVariables], OpenSCADObject] = {
+        key: import_stl(stl_filename) for key, stl_filename in
+        zip(cached.keys(), _fix_paths(cached.values(), convert=openscad_bin.startswith("wsl")))}
+
+    def substitute(node: BareOpenSCADObject, variables: SpecialVariables) -> BareOpenSCADObject:
+        if node is not scad_object and (memo[id(node)], variables) in replacements:
+            return replacements[(memo[id(node)], variables)]
+        variables = _special_variables(node, variables)
+        children = [substitute(c, variables) if isinstance(c, BareOpenSCADObject) else c for c in node._children]
+        if all(a is b for a, b in zip(children, node._children)):
+            return node
+        new_node = copy.copy(node)
+        new_node._children = children
+        return new_node
+
+    return substitute(scad_object, ())
@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import argparse
+import http.client
+import logging
+import os
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import BinaryIO, Protocol
+
+from solid2_utils.render import _clone_file
+
+
+class FileLock:
+    def __init__(self, filename: Path):
+        self.filename = filename
+        self._file: BinaryIO | None = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        f = open(self.filename, "a+b")
+        try:
+            if os.name == "nt":
+                import msvcrt
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            raise BlockingIOError
+                        time.sleep(.1)
+            else:
+                import fcntl
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                # the file was removed while waiting for it, so the lock has to be taken on its successor
+                if not self.filename.exists() or not os.path.samestat(os.fstat(f.fileno()), self.filename.stat()):
+                    f.close()
+                    return self.acquire(blocking)
+        except BlockingIOError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def remove(self) -> bool:
+        if not self.filename.exists() or not self.acquire(blocking=False):
+            return False
+        try:
+            self.filename.unlink(missing_ok=True)
+        except OSError:
+            # open files can not be removed on Windows
+            pass
+        finally:
+            self.release()
+        return True
+
+    def release(self) -> None:
+        if self._file is None:
+            return
+        if os.name == "nt":
+            import msvcrt
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self) -> FileLock:
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class CacheBackend(Protocol):
+    def get(self, key: str, filename: Path) -> bool: ...
+
+    def put(self, key: str, filename: Path) -> None: ...
+
+
+class SharedDirectoryBackend:
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def path(self, key: str) -> Path:
+        return self.root.joinpath(key[:2], key + ".stl")
+
+    def get(self, key: str, filename: Path) -> bool:
+        if not self.path(key).exists():
+            return False
+        _clone_file(self.path(key), filename)
+        return True
+
+    def put(self, key: str, filename: Path) -> None:
+        blob = self.path(key)
+        if blob.exists():
+            return
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        tmp = blob.with_name(f"{blob.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.copyfile(filename, tmp)
+        os.replace(tmp, blob)
+
+
+class HttpBackend:
+    def __init__(self, url: str, timeout: float | None = 60.):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def get(self, key: str, filename: Path) -> bool:
+        tmp = filename.with_name(f"{filename.name}.{os.getpid()}.tmp")
+        try:
+            with urllib.request.urlopen(f"{self.url}/{key}", timeout=self.timeout) as response, open(tmp, "wb") as f:
+                shutil.copyfileobj(response, f)
+        except urllib.error.HTTPError as ex:
+            tmp.unlink(missing_ok=True)
+            if ex.code != 404:
+                logging.warning(f"Could not get {key} from {self.url}: {ex}")
+            return False
+        except (OSError, http.client.HTTPException) as ex:
+            tmp.unlink(missing_ok=True)
+            logging.warning(f"Could not get {key} from {self.url}: {ex}")
+            return False
+        os.replace(tmp, filename)
+        return True
+
+    def put(self, key: str, filename: Path) -> None:
+        request = urllib.request.Request(f"{self.url}/{key}", data=filename.read_bytes(), method="PUT",
+                                         headers={"Content-Type": "application/octet-stream"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except (OSError, http.client.HTTPException) as ex:
+            logging.warning(f"Could not put {key} to {self.url}: {ex}")
+
+
+class _BlobRequestHandler(BaseHTTPRequestHandler):
+    server: _BlobServer
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def _key(self) -> str | None:
+        key = self.path.strip("/")
+        return key if key.isalnum() else None
+
+    def do_GET(self) -> None:
+        key = self._key()
+        if key is None or not self.server.store.path(key).exists():
+            self.send_error(404)
+            return
+        blob = self.server.store.path(key)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(blob.stat().st_size))
+        self.end_headers()
+        with open(blob, "rb") as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_PUT(self) -> None:
+        key = self._key()
+        if key is None:
+            self.send_error(400)
+            return
+        blob = self.server.store.path(key)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        tmp = blob.with_name(f"{blob.name}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(self.rfile.read(int(self.headers["Content-Length"])))
+        os.replace(tmp, blob)
+        self.send_response(204)
+        self.end_headers()
+
+
+class _BlobServer(ThreadingHTTPServer):
+    daemon_threads = True
+    store: SharedDirectoryBackend
+
+
+class BlobServer:
+    def __init__(self, root: Path, host: str = "127.0.0.1", port: int = 0):
+        self.server = _BlobServer((host, port), _BlobRequestHandler)
+        self.server.store = SharedDirectoryBackend(root)
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_forever(self) -> None:
+        self.server.serve_forever()
+
+    def start(self) -> BlobServer:
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def shutdown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> BlobServer:
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="solid2_utils.cache_backend", description="Shared STL cache for solid2_utils")
+    parser.add_argument('root', type=str)
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    server = BlobServer(Path(args.root), args.host, args.port)
+    logging.info(f"Serving {args.root} on {server.url}")
+    server.serve_forever()
+
+
+if "__main__" == __name__:
+    main()
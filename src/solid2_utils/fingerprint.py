@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import hashlib
+from typing import Dict, List, Tuple
+
+from solid2.core.extension_manager import default_extension_manager
+from solid2.core.object_base import ObjectBase
+from solid2.core.object_base.object_base_impl import BareOpenSCADObject
+from solid2.core.scad_render import get_include_string
+
+FingerprintMemo = Dict[int, bytes]
+
+
+def _node_head(node: object) -> bytes:
+    kind = f"{type(node).__module__}.{type(node).__qualname__}"
+    if isinstance(node, BareOpenSCADObject):
+        return f"{kind}\0{node._generate_scad_head()}".encode()
+    if isinstance(node, ObjectBase):
+        return kind.encode()
+    return f"{kind}\0{node._render()}".encode()
+
+
+def node_digest(scad_object: object, memo: FingerprintMemo | None = None) -> bytes:
+    # the memo is keyed by id(), so it must not outlive the objects nor see them mutated
+    memo = dict() if memo is None else memo
+    stack: List[Tuple[object, bool]] = [(scad_object, False)]
+    while len(stack) > 0:
+        node, expanded = stack.pop()
+        if id(node) in memo:
+            continue
+        children = node._children if isinstance(node, ObjectBase) else []
+        if not expanded:
+            stack.append((node, True))
+            stack.extend((c, False) for c in children if id(c) not in memo)
+            continue
+        digest = hashlib.md5(_node_head(node))
+        digest.update(len(children).to_bytes(8))
+        for c in children:
+            digest.update(memo[id(c)])
+        memo[id(node)] = digest.digest()
+    return memo[id(scad_object)]
+
+
+def fingerprint(scad_object: object, memo: FingerprintMemo | None = None) -> str:
+    root = default_extension_manager.wrap_root_node(scad_object)
+    context = "\0".join([get_include_string(), default_extension_manager.call_pre_render(scad_object),
+                         default_extension_manager.call_post_render(root)])
+    memo = dict() if memo is None else memo
+    digest = hashlib.md5(context.encode())
+    digest.update(node_digest(root, memo))
+    if root is not scad_object:
+        del memo[id(root)]
+    return digest.hexdigest()
+
+
+def path_references(scad_object: object) -> str:
+    # the parts of the scad text that can name files, without serializing the whole tree
+    parts = [get_include_string()]
+    seen: set[int] = set()
+    stack = [scad_object]
+    while len(stack) > 0:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        if isinstance(node, BareOpenSCADObject):
+            if node._name in ("import", "surface"):
+                parts.append(node._generate_scad_head())
+        elif not isinstance(node, ObjectBase):
+            parts.append(node._render())
+        if isinstance(node, ObjectBase):
+            stack.extend(node._children)
+    return "\n".join(parts)
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import functools
+from typing import Callable, Dict, Generator, List, Tuple, TYPE_CHECKING
+
+from solid2_utils.mod import (XYZ, Matrix4, Mod, _Action, _Debug, _Mi, _Ro, _Sc, _Tr, _apply_action, _compile,
+                              _compiled_matrix, _rotate, _scale, _translate)
+
+if TYPE_CHECKING:
+    from solid2.core.object_base import OpenSCADObject
+    from solid2.extensions.bosl2.bosl2_base import Bosl2Base
+
+_INTERN_SIZE = 1 << 12
+
+
+class FrozenMod:
+    # an immutable rope of actions: appending an action or adding two mods only creates one node referencing
+    # the existing ones, nothing is ever copied
+    __slots__ = ("_action", "_left", "_right", "_length", "_compiled")
+
+    def __init__(self):
+        self._action: _Action | None = None
+        self._left: FrozenMod | None = None
+        self._right: FrozenMod | None = None
+        self._length = 0
+        self._compiled: List[Matrix4 | _Action] | None = None
+
+    @staticmethod
+    def _node(action: _Action | None, left: FrozenMod | None, right: FrozenMod | None, length: int) -> FrozenMod:
+        node = object.__new__(FrozenMod)
+        node._action = action
+        node._left = left
+        node._right = right
+        node._length = length
+        node._compiled = None
+        return node
+
+    @staticmethod
+    def _leaf(action: _Action) -> FrozenMod:
+        return FrozenMod._node(action, None, None, 1)
+
+    def _append(self, action: _Action) -> FrozenMod:
+        if self._length == 0:
+            return FrozenMod._node(action, None, None, 1)
+        return FrozenMod._node(action, self, None, self._length + 1)
+
+    def _concat(self, other: FrozenMod) -> FrozenMod:
+        if other._length == 0:
+            return self
+        if self._length == 0:
+            return other
+        if other._length == 1:
+            return self._append(other._action)
+        return FrozenMod._node(None, self, other, self._length + other._length)
+
+    def actions(self) -> Generator[_Action, None, None]:
+        stack: List[FrozenMod | _Action] = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            if not isinstance(node, FrozenMod):
+                yield node
+                continue
+            if node._action is not None:
+                stack.append(node._action)
+            if node._right is not None:
+                stack.append(node._right)
+            if node._left is not None:
+                stack.append(node._left)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def matrix(self) -> Matrix4:
+        return _compiled_matrix(self.compile())
+
+    def compile(self) -> List[Matrix4 | _Action]:
+        if self._compiled is None:
+            self._compiled = _compile(self.actions())
+        return self._compiled
+
+    def s(self, *factors: XYZ, x: float | None = None, y: float | None = None, z: float | None = None) -> FrozenMod:
+        return self._append(_scale(factors, x, y, z))
+
+    def t(self, *coordinates: XYZ, x: float | None = None, y: float | None = None,
+          z: float | None = None) -> FrozenMod:
+        return self._append(_translate(coordinates, x, y, z))
+
+    def r(self, *angles: XYZ, x: float | None = None, y: float | None = None, z: float | None = None) -> FrozenMod:
+        return self._append(_rotate(angles, x, y, z))
+
+    def m(self, x: int = 0, y: int = 0, z: int = 0) -> FrozenMod:
+        return self._append(_Mi((x, y, z)))
+
+    def debug(self, flag: bool = True) -> FrozenMod:
+        return self._append(_Debug(flag))
+
+    def tx(self, x: float | int) -> FrozenMod:
+        return self._append(_Tr((x, 0., 0.)))
+
+    def ty(self, y: float | int) -> FrozenMod:
+        return self._append(_Tr((0., y, 0.)))
+
+    def tz(self, z: float | int) -> FrozenMod:
+        return self._append(_Tr((0., 0., z)))
+
+    def rx(self, x: float | int) -> FrozenMod:
+        return self._append(_Ro((x, 0., 0.)))
+
+    def ry(self, y: float | int) -> FrozenMod:
+        return self._append(_Ro((0., y, 0.)))
+
+    def rz(self, z: float | int) -> FrozenMod:
+        return self._append(_Ro((0., 0., z)))
+
+    def sx(self, x: float | int) -> FrozenMod:
+        return self._append(_Sc((x, 1., 1.)))
+
+    def sy(self, y: float | int) -> FrozenMod:
+        return self._append(_Sc((1., y, 1.)))
+
+    def sz(self, z: float | int) -> FrozenMod:
+        return self._append(_Sc((1., 1., z)))
+
+    def mx(self) -> FrozenMod:
+        return self._append(_Mi((1, 0, 0)))
+
+    def my(self) -> FrozenMod:
+        return self._append(_Mi((0, 1, 0)))
+
+    def mz(self) -> FrozenMod:
+        return self._append(_Mi((0, 0, 1)))
+
+    def clone(self) -> FrozenMod:
+        return self
+
+    def __call__(self, openscad_object: OpenSCADObject | Bosl2Base, fuse: bool = False) -> OpenSCADObject | Bosl2Base:
+        for action in self.compile() if fuse else self.actions():
+            openscad_object = _apply_action(openscad_object, action)
+        return openscad_object
+
+    def __add__(self, other: FrozenMod | Mod) -> FrozenMod:
+        return self._concat(other if isinstance(other, FrozenMod) else freeze(other))
+
+
+def freeze(mod: Mod) -> FrozenMod:
+    frozen = FrozenMod()
+    for action in mod._actions:
+        frozen = frozen._concat(FrozenMod._leaf(action))
+    return frozen
+
+
+def _interned(fn: Callable[..., FrozenMod]) -> Callable[..., FrozenMod]:
+    cache: Dict[Tuple, FrozenMod] = dict()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs) -> FrozenMod:
+        # keyed by type too, so tx(1) and tx(1.) keep rendering as written
+        items = tuple(sorted(kwargs.items()))
+        key = (args, tuple(map(type, args)), items, tuple(type(value) for _, value in items))
+        try:
+            return cache[key]
+        except KeyError:
+            result = fn(*args, **kwargs)
+            if len(cache) < _INTERN_SIZE:
+                cache[key] = result
+            return result
+        except TypeError:
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def t(*coordinates: XYZ, x: float | None = None, y: float | None = None, z: float | None = None) -> FrozenMod:
+    return FrozenMod._leaf(_translate(coordinates, x, y, z))
+
+
+@_interned
+def tx(x: float) -> FrozenMod:
+    return t(x=x)
+
+
+@_interned
+def ty(y: float) -> FrozenMod:
+    return t(y=y)
+
+
+@_interned
+def tz(z: float) -> FrozenMod:
+    return t(z=z)
+
+
+def r(*angles: XYZ, x: float | None = None, y: float | None = None, z: float | None = None) -> FrozenMod:
+    return FrozenMod._leaf(_rotate(angles, x, y, z))
+
+
+@_interned
+def rx(x: float) -> FrozenMod:
+    return r(x=x)
+
+
+@_interned
+def ry(y: float) -> FrozenMod:
+    return r(y=y)
+
+
+@_interned
+def rz(z: float) -> FrozenMod:
+    return r(z=z)
+
+
+def s(*factors: XYZ, x: float | None = None, y: float | None = None, z: float | None = None) -> FrozenMod:
+    return FrozenMod._leaf(_scale(factors, x, y, z))
+
+
+@_interned
+def sx(x: float) -> FrozenMod:
+    return s(x=x)
+
+
+@_interned
+def sy(y: float) -> FrozenMod:
+    return s(y=y)
+
+
+@_interned
+def sz(z: float) -> FrozenMod:
+    return s(z=z)
+
+
+@_interned
+def m(x: int = 0, y: int = 0, z: int = 0) -> FrozenMod:
+    return FrozenMod._leaf(_Mi((x, y, z)))
+
+
+def mx() -> FrozenMod:
+    return m(1, 0, 0)
+
+
+def my() -> FrozenMod:
+    return m(0, 1, 0)
+
+
+def mz() -> FrozenMod:
+    return m(0, 0, 1)
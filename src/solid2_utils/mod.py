@@ -1,14 +1,43 @@
 from __future__ import annotations
 
-import copy
+import math
 from dataclasses import dataclass
-from typing import List, Tuple, Sequence
+from typing import Iterable, Iterator, List, Tuple, Sequence, TYPE_CHECKING
 
-from solid2 import P2, P3, P4
-from solid2.core.object_base import OpenSCADObject
-from solid2.extensions.bosl2.bosl2_base import Bosl2Base
+if TYPE_CHECKING:
+    import numpy as np
+    from numpy.typing import ArrayLike, NDArray
+    from solid2 import P3
+    from solid2.core.object_base import OpenSCADObject
+    from solid2.extensions.bosl2.bosl2_base import Bosl2Base
 
-XYZ = P4 | P3 | P2 | Sequence[float | int] | int | float
+    from solid2_utils.frozen_mod import FrozenMod
+
+# solid2's P4 | P3 | P2, spelled out so importing this module does not load solid2
+XYZ = (Tuple[float, float, float, float] | Tuple[float, float, float] | Tuple[float, float] | Sequence[float | int] |
+       int | float)
+
+
+@dataclass(frozen=True)
+class _ModP3Action:
+    set_values: Tuple[float | None, float | None, float | None] = (None, None, None)
+    add_values: Tuple[float, float, float] = (0., 0., 0.)
+    mul_values: Tuple[float, float, float] = (1., 1., 1.)
+
+
+def mod_p3_action(setx: float | int | None = None, sety: float | int | None = None, setz: float | int | None = None,
+                  addx: float | int = 0., addy: float | int = 0., addz: float | int = 0., mulx: float | int = 1.,
+                  muly: float | int = 1., mulz: float | int = 1.,
+                  add: Tuple[float | int, float | int, float | int] | float | int = 0.,
+                  mul: Tuple[float | int, float | int, float | int] | float | int = 1., ) -> _ModP3Action:
+    _a: Tuple[float, float, float] = (float(add[0]), float(add[1]), float(add[2])) if isinstance(add, tuple) else (
+        float(add), float(add), float(add))
+    _m: Tuple[float, float, float] = (float(mul[0]), float(mul[1]), float(mul[2])) if isinstance(mul, tuple) else (
+        float(mul), float(mul), float(mul))
+    return _ModP3Action((float(setx) if setx is not None else None, float(sety) if sety is not None else None,
+                         float(setz) if setz is not None else None),
+                        (addx + _a[0], addy + _a[1], addz + _a[2]),
+                        (mulx * _m[0], muly * _m[1], mulz * _m[2]))
 
 
 def mod_p3(v: P3, setx: float | int | None = None, sety: float | int | None = None, setz: float | int | None = None,
@@ -16,121 +45,293 @@ def mod_p3(v: P3, setx: float | int | None = None, sety: float | int | None = No
            muly: float | int = 1., mulz: float | int = 1.,
            add: Tuple[float | int, float | int, float | int] | float | int = 0.,
            mul: Tuple[float | int, float | int, float | int] | float | int = 1., ) -> P3:
-    set_values: Tuple[float, float, float] = (float(setx) if setx is not None else v[0],
-                                              float(sety) if sety is not None else v[1],
-                                              float(setz) if setz is not None else v[2])
-    _a: Tuple[float, float, float] = (float(add[0]), float(add[1]), float(add[2])) if isinstance(add, tuple) else (
-        float(add), float(add), float(add))
-    _m: Tuple[float, float, float] = (float(mul[0]), float(mul[1]), float(mul[2])) if isinstance(mul, tuple) else (
-        float(mul), float(mul), float(mul))
-    add_values = (addx + _a[0], addy + _a[1], addz + _a[2])
-    mul_values = (mulx * _m[0], muly * _m[1], mulz * _m[2])
+    action = mod_p3_action(setx, sety, setz, addx, addy, addz, mulx, muly, mulz, add, mul)
     new_v: List[float] = [vv for vv in v]
 
     for i in range(3):
-        new_v[i] = set_values[i]
-        new_v[i] += add_values[i]
-        new_v[i] *= mul_values[i]
+        set_value = action.set_values[i]
+        new_v[i] = set_value if set_value is not None else v[i]
+        new_v[i] += action.add_values[i]
+        new_v[i] *= action.mul_values[i]
 
     return new_v[0], new_v[1], new_v[2]
 
 
-class _ModP3Action:
-    pass
-
-
 class ModP3:
-    def __init__(self, *args: _ModP3Action):
-        pass
+    _CHUNK_SIZE = 1 << 16
+
+    def __init__(self, *args: _ModP3Action | Mod):
+        import numpy as np
+
+        self._steps: List[_ModP3Action | NDArray[np.float64]] = list()
+        for arg in args:
+            if isinstance(arg, _ModP3Action):
+                self._steps.append(arg)
+                continue
+            matrix = np.asarray(arg.matrix(), dtype=np.float64)
+            last = self._steps[-1] if len(self._steps) > 0 else None
+            if last is not None and not isinstance(last, _ModP3Action):
+                self._steps[-1] = matrix @ last
+            else:
+                self._steps.append(matrix)
+
+    def __call__(self, points: ArrayLike, out: NDArray[np.float64] | None = None) -> NDArray[np.float64]:
+        import numpy as np
+
+        points = np.asarray(points, dtype=np.float64)
+        if points.ndim != 2 or points.shape[1] != 3:
+            raise ValueError(f"Expected points with shape (N, 3), got {points.shape}")
+        if out is None:
+            out = points.copy()
+        elif out is not points:
+            if out.shape != points.shape:
+                raise ValueError(f"Expected out with shape {points.shape}, got {out.shape}")
+            np.copyto(out, points)
+
+        for step in self._steps:
+            if isinstance(step, _ModP3Action):
+                for i in range(3):
+                    set_value = step.set_values[i]
+                    if set_value is not None:
+                        out[:, i] = set_value
+                out += step.add_values
+                out *= step.mul_values
+            else:
+                rotation = step[:3, :3].T
+                translation = step[:3, 3]
+                for start in range(0, len(out), self._CHUNK_SIZE):
+                    chunk = out[start:start + self._CHUNK_SIZE]
+                    chunk[...] = chunk @ rotation
+                    chunk += translation
+        return out
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class _Tr:
     coordinates: XYZ = (0., 0., 0.)
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class _Sc:
     factor: XYZ = (1., 1., 1.)
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class _Ro:
     angles: XYZ = (0., 0., 0.)
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class _Mi:
     axis: Tuple[int, int, int] = (0, 0, 0)
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class _Debug:
     flag: bool = True
 
 
+Matrix4 = Tuple[Tuple[float, float, float, float], Tuple[float, float, float, float], Tuple[
+    float, float, float, float], Tuple[float, float, float, float]]
+
+_IDENTITY: Matrix4 = ((1., 0., 0., 0.), (0., 1., 0., 0.), (0., 0., 1., 0.), (0., 0., 0., 1.))
+
+
+def _xyz(values: XYZ, default: float) -> Tuple[float, float, float] | None:
+    if isinstance(values, int | float):
+        values = (values,)
+    padded = [*values, *(default for _ in range(3 - len(values)))][:3]
+    if not all(isinstance(v, int | float) for v in padded):
+        return None
+    return float(padded[0]), float(padded[1]), float(padded[2])
+
+
+def _sin_cos(degrees: float) -> Tuple[float, float]:
+    # exact values for multiples of 90 degree like OpenSCAD does
+    if degrees % 90. == 0.:
+        return ((0., 1.), (1., 0.), (0., -1.), (-1., 0.))[int(degrees // 90.) % 4]
+    radians = math.radians(degrees)
+    return math.sin(radians), math.cos(radians)
+
+
+def _matmul(a: Matrix4, b: Matrix4) -> Matrix4:
+    return tuple(tuple(sum(a[i][k] * b[k][j] for k in range(4)) for j in range(4)) for i in range(4))  # type: ignore
+
+
+def _action_matrix(action: _Tr | _Ro | _Mi | _Sc) -> Matrix4 | None:
+    if isinstance(action, _Tr):
+        v = _xyz(action.coordinates, 0.)
+        if v is None:
+            return None
+        return (1., 0., 0., v[0]), (0., 1., 0., v[1]), (0., 0., 1., v[2]), (0., 0., 0., 1.)
+    if isinstance(action, _Sc):
+        v = _xyz(action.factor, 1.)
+        if v is None:
+            return None
+        return (v[0], 0., 0., 0.), (0., v[1], 0., 0.), (0., 0., v[2], 0.), (0., 0., 0., 1.)
+    if isinstance(action, _Ro):
+        v = _xyz(action.angles, 0.)
+        if v is None:
+            return None
+        sx, cx = _sin_cos(v[0])
+        sy, cy = _sin_cos(v[1])
+        sz, cz = _sin_cos(v[2])
+        rot_x: Matrix4 = ((1., 0., 0., 0.), (0., cx, -sx, 0.), (0., sx, cx, 0.), (0., 0., 0., 1.))
+        rot_y: Matrix4 = ((cy, 0., sy, 0.), (0., 1., 0., 0.), (-sy, 0., cy, 0.), (0., 0., 0., 1.))
+        rot_z: Matrix4 = ((cz, -sz, 0., 0.), (sz, cz, 0., 0.), (0., 0., 1., 0.), (0., 0., 0., 1.))
+        return _matmul(rot_z, _matmul(rot_y, rot_x))
+    if isinstance(action, _Mi):
+        n = _xyz(action.axis, 0.)
+        if n is None:
+            return None
+        length_sq = n[0] * n[0] + n[1] * n[1] + n[2] * n[2]
+        if length_sq == 0.:
+            return _IDENTITY
+        return tuple(tuple((1. if i == j else 0.) - 2. * n[i] * n[j] / length_sq for j in range(3)) + (0.,) for i in
+                     range(3)) + ((0., 0., 0., 1.),)  # type: ignore
+    raise ValueError("Unexpected type for action")
+
+
+def _scale(factors: Tuple[XYZ, ...], x: float | None, y: float | None, z: float | None) -> _Sc:
+    if len(factors) == 1 and isinstance(factors[0], tuple | list):
+        return _Sc(tuple(factors[0]))
+    elif len(factors) == 1 and isinstance(factors[0], int | float):
+        return _Sc((factors[0], factors[0] * 0, factors[0] * 0))
+    elif len(factors) == 2 and isinstance(factors[0], int | float) and isinstance(factors[1], int | float):
+        return _Sc((factors[0], factors[1], factors[0] * 0))
+    elif len(factors) == 3 and isinstance(factors[0], int | float) and isinstance(factors[1],
+                                                                                  int | float) and isinstance(
+        factors[2], int | float):
+        return _Sc((factors[0], factors[1], factors[2]))
+    elif any(c is not None for c in (x, y, z)):
+        return _Sc(tuple(c if c is not None else 1. for c in (x, y, z)))
+    raise ValueError("Either factors has to be non None or x,y,z have to be not None")
+
+
+def _translate(coordinates: Tuple[XYZ, ...], x: float | None, y: float | None, z: float | None) -> _Tr:
+    if len(coordinates) == 1 and isinstance(coordinates[0], tuple | list):
+        return _Tr(tuple(coordinates[0]))
+    elif len(coordinates) == 1 and isinstance(coordinates[0], int | float):
+        return _Tr((coordinates[0], coordinates[0] * 0, coordinates[0] * 0))
+    elif len(coordinates) == 2 and isinstance(coordinates[0], int | float) and isinstance(coordinates[1],
+                                                                                          int | float):
+        return _Tr((coordinates[0], coordinates[1], coordinates[0] * 0))
+    elif len(coordinates) == 3 and isinstance(coordinates[0], int | float) and isinstance(coordinates[1],
+                                                                                          int | float) and isinstance(
+        coordinates[2], int | float):
+        return _Tr((coordinates[0], coordinates[1], coordinates[2]))
+    elif any(c is not None for c in (x, y, z)):
+        return _Tr(tuple(c if c is not None else 0. for c in (x, y, z)))
+    raise ValueError("Either coordinates has to be non None or x,y,z have to be not None")
+
+
+def _rotate(angles: Tuple[XYZ, ...], x: float | None, y: float | None, z: float | None) -> _Ro:
+    if len(angles) == 1 and isinstance(angles[0], tuple | list):
+        return _Ro(tuple(angles[0]))
+    elif len(angles) == 1 and isinstance(angles[0], int | float):
+        return _Ro((angles[0], angles[0] * 0, angles[0] * 0))
+    elif len(angles) == 2 and isinstance(angles[0], int | float) and isinstance(angles[1], int | float):
+        return _Ro((angles[0], angles[1], angles[0] * 0))
+    elif len(angles) == 3 and isinstance(angles[0], int | float) and isinstance(angles[1],
+                                                                                int | float) and isinstance(
+        angles[2], int | float):
+        return _Ro((angles[0], angles[1], angles[2]))
+    elif any(c is not None for c in (x, y, z)):
+        return _Ro(tuple(c if c is not None else 0. for c in (x, y, z)))
+    raise ValueError("Either angles has to be non None or x,y,z have to be not None")
+
+
+_Action = _Tr | _Ro | _Mi | _Sc | _Debug
+
+
+def _apply_action(openscad_object: OpenSCADObject | Bosl2Base,
+                  action: Matrix4 | _Action) -> OpenSCADObject | Bosl2Base:
+    if isinstance(action, tuple):
+        if action != _IDENTITY:
+            from solid2 import multmatrix
+            openscad_object = multmatrix([list(row) for row in action])(openscad_object)
+    elif isinstance(action, _Tr):
+        openscad_object = openscad_object.translate(action.coordinates)
+    elif isinstance(action, _Ro):
+        openscad_object = openscad_object.rotate(action.angles)
+    elif isinstance(action, _Sc):
+        openscad_object = openscad_object.scale(action.factor)
+    elif isinstance(action, _Mi):
+        openscad_object = openscad_object.mirror(action.axis)
+    elif isinstance(action, _Debug):
+        if action.flag:
+            openscad_object = openscad_object.debug()
+    else:
+        raise ValueError("Unexpected type for action")
+    return openscad_object
+
+
+def _compile(actions: Iterable[_Action]) -> List[Matrix4 | _Action]:
+    compiled: List[Matrix4 | _Action] = list()
+    current: Matrix4 | None = None
+    for action in actions:
+        matrix = None if isinstance(action, _Debug) else _action_matrix(action)
+        if matrix is not None:
+            current = matrix if current is None else _matmul(matrix, current)
+            continue
+        if current is not None:
+            compiled.append(current)
+            current = None
+        compiled.append(action)
+    if current is not None:
+        compiled.append(current)
+    return compiled
+
+
+def _compiled_matrix(compiled: Iterable[Matrix4 | _Action]) -> Matrix4:
+    matrix = _IDENTITY
+    for action in compiled:
+        if isinstance(action, _Debug):
+            continue
+        if not isinstance(action, tuple):
+            raise ValueError(f"Can't convert {action} to a matrix")
+        matrix = _matmul(action, matrix)
+    return matrix
+
+
 class Mod:
     def __init__(self):
-        self._actions: List[_Tr | _Ro | _Mi | _Sc | _Debug] = list()
+        self._actions: List[_Action] = list()
+        self._compiled: List[Matrix4 | _Action] | None = None
+
+    def _append(self, action: _Action) -> None:
+        self._actions.append(action)
+        self._compiled = None
+
+    def actions(self) -> Iterator[_Action]:
+        return iter(self._actions)
+
+    def matrix(self) -> Matrix4:
+        return _compiled_matrix(self.compile())
+
+    def compile(self) -> List[Matrix4 | _Action]:
+        if self._compiled is None:
+            self._compiled = _compile(self._actions)
+        return self._compiled
 
     def s(self, *factors: XYZ, x: float | None = None, y: float | None = None, z: float | None = None):
-        if len(factors) == 1 and isinstance(factors[0], tuple | list):
-            self._actions.append(_Sc(factors[0]))
-        elif len(factors) == 1 and isinstance(factors[0], int | float):
-            self._actions.append(_Sc((factors[0], factors[0] * 0, factors[0] * 0)))
-        elif len(factors) == 2 and isinstance(factors[0], int | float) and isinstance(factors[1], int | float):
-            self._actions.append(_Sc((factors[0], factors[1], factors[0] * 0)))
-        elif len(factors) == 3 and isinstance(factors[0], int | float) and isinstance(factors[1],
-                                                                                      int | float) and isinstance(
-            factors[2], int | float):
-            self._actions.append(_Sc((factors[0], factors[1], factors[2])))
-        elif any(c is not None for c in (x, y, z)):
-            self._actions.append(_Sc([c if c is not None else 1. for c in (x, y, z)]))
-        else:
-            raise ValueError("Either factors has to be non None or x,y,z have to be not None")
+        self._append(_scale(factors, x, y, z))
         return self
 
     def t(self, *coordinates: XYZ, x: float | None = None, y: float | None = None, z: float | None = None) -> Mod:
-        if len(coordinates) == 1 and isinstance(coordinates[0], tuple | list):
-            self._actions.append(_Tr(coordinates[0]))
-        elif len(coordinates) == 1 and isinstance(coordinates[0], int | float):
-            self._actions.append(_Tr([coordinates[0], coordinates[0] * 0, coordinates[0] * 0]))
-        elif len(coordinates) == 2 and isinstance(coordinates[0], int | float) and isinstance(coordinates[1],
-                                                                                              int | float):
-            self._actions.append(_Tr([coordinates[0], coordinates[1], coordinates[0] * 0]))
-        elif len(coordinates) == 3 and isinstance(coordinates[0], int | float) and isinstance(coordinates[1],
-                                                                                              int | float) and isinstance(
-            coordinates[2], int | float):
-            self._actions.append(_Tr([coordinates[0], coordinates[1], coordinates[2]]))
-        elif any(c is not None for c in (x, y, z)):
-            self._actions.append(_Tr([c if c is not None else 0. for c in (x, y, z)]))
-        else:
-            raise ValueError("Either coordinates has to be non None or x,y,z have to be not None")
+        self._append(_translate(coordinates, x, y, z))
         return self
 
     def r(self, *angles: XYZ, x: float | None = None, y: float | None = None, z: float | None = None) -> Mod:
-        if len(angles) == 1 and isinstance(angles[0], tuple | list):
-            self._actions.append(_Ro(angles[0]))
-        elif len(angles) == 1 and isinstance(angles[0], int | float):
-            self._actions.append(_Ro((angles[0], angles[0] * 0, angles[0] * 0)))
-        elif len(angles) == 2 and isinstance(angles[0], int | float) and isinstance(angles[1], int | float):
-            self._actions.append(_Ro((angles[0], angles[1], angles[0] * 0)))
-        elif len(angles) == 3 and isinstance(angles[0], int | float) and isinstance(angles[1],
-                                                                                    int | float) and isinstance(
-            angles[2], int | float):
-            self._actions.append(_Ro((angles[0], angles[1], angles[2])))
-        elif any(c is not None for c in (x, y, z)):
-            self._actions.append(_Ro([c if c is not None else 0. for c in (x, y, z)]))
-        else:
-            raise ValueError("Either angles has to be non None or x,y,z have to be not None")
+        self._append(_rotate(angles, x, y, z))
         return self
 
     def m(self, x: int = 0, y: int = 0, z: int = 0) -> Mod:
-        self._actions.append(_Mi((x, y, z)))
+        self._append(_Mi((x, y, z)))
         return self
 
     def debug(self, flag: bool = True) -> Mod:
-        self._actions.append(_Debug(flag))
+        self._append(_Debug(flag))
         return self
 
     def tx(self, x: float | int) -> Mod:
@@ -170,32 +371,25 @@ class Mod:
         return self.m(z=1)
 
     def clone(self) -> Mod:
-        return copy.deepcopy(self)
-
-    def __call__(self, openscad_object: OpenSCADObject | Bosl2Base) -> OpenSCADObject | Bosl2Base:
-        for action in self._actions:
-            if isinstance(action, _Tr):
-                openscad_object = openscad_object.translate(action.coordinates)
-            elif isinstance(action, _Ro):
-                openscad_object = openscad_object.rotate(action.angles)
-            elif isinstance(action, _Sc):
-                openscad_object = openscad_object.scale(action.factor)
-            elif isinstance(action, _Mi):
-                openscad_object = openscad_object.mirror(action.axis)
-            elif isinstance(action, _Debug):
-                if action.flag:
-                    openscad_object = openscad_object.debug()
-            else:
-                raise ValueError("Unexpected type for action")
+        # actions are immutable, so the copy can share them
+        new_instance = type(self).__new__(type(self))
+        new_instance._actions = list(self._actions)
+        new_instance._compiled = self._compiled
+        return new_instance
+
+    def __call__(self, openscad_object: OpenSCADObject | Bosl2Base, fuse: bool = False) -> OpenSCADObject | Bosl2Base:
+        for action in self.compile() if fuse else self._actions:
+            openscad_object = _apply_action(openscad_object, action)
         return openscad_object
 
-    def __add__(self, other: Mod) -> Mod:
+    def __add__(self, other: Mod | FrozenMod) -> Mod:
         new_instance = self.clone()
         new_instance += other
         return new_instance
 
-    def __iadd__(self, other: Mod) -> Mod:
-        self._actions.extend(other._actions)
+    def __iadd__(self, other: Mod | FrozenMod) -> Mod:
+        self._actions.extend(other.actions())
+        self._compiled = None
         return self
 
 
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import math
+from typing import Iterable, List, Protocol, Sequence, Tuple
+
+from solid2.core.object_base import OpenSCADObject
+from solid2.extensions.bosl2.bosl2_base import Bosl2Base
+
+from solid2_utils.mod import XYZ, Matrix4, _IDENTITY, _Ro, _Tr, _action_matrix, _matmul, _xyz
+
+
+class _HasMatrix(Protocol):
+    def matrix(self) -> Matrix4: ...
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _is_translation(matrix: Matrix4) -> bool:
+    return all(matrix[i][j] == _IDENTITY[i][j] for i in range(4) for j in range(3)) and matrix[3] == _IDENTITY[3]
+
+
+class Instances(OpenSCADObject):
+    # renders the children once inside a for loop over the transforms instead of once per transform
+    def __init__(self, matrices: Sequence[Matrix4]):
+        super().__init__("for", {})
+        self.matrices = list(matrices)
+
+    def _generate_scad_head(self) -> str:
+        if all(_is_translation(matrix) for matrix in self.matrices):
+            vectors = ", ".join(f"[{_number(m[0][3])}, {_number(m[1][3])}, {_number(m[2][3])}]" for m in self.matrices)
+            return f"for (solid2_utils_v = [{vectors}]) translate(solid2_utils_v)"
+        matrices = ", ".join("[" + ", ".join("[" + ", ".join(_number(v) for v in row) + "]" for row in m[:3]) + "]"
+                             for m in self.matrices)
+        return f"for (solid2_utils_m = [{matrices}]) multmatrix(solid2_utils_m)"
+
+
+def instances(openscad_object: OpenSCADObject | Bosl2Base,
+              transforms: Iterable[_HasMatrix | Matrix4]) -> OpenSCADObject:
+    matrices = [transform if isinstance(transform, tuple) else transform.matrix() for transform in transforms]
+    return Instances(matrices)(openscad_object)
+
+
+def grid(openscad_object: OpenSCADObject | Bosl2Base, counts: int | Tuple[int, ...], spacing: XYZ,
+         center: bool = False) -> OpenSCADObject:
+    n = (counts, 1, 1) if isinstance(counts, int) else (*counts, *(1 for _ in range(3 - len(counts))))
+    step = _xyz(spacing, 0.)
+    if step is None:
+        raise ValueError(f"Expected numeric spacing, got {spacing}")
+    offset = [-(n[i] - 1) * step[i] / 2. if center else 0. for i in range(3)]
+    matrices: List[Matrix4] = [
+        _action_matrix(_Tr((offset[0] + ix * step[0], offset[1] + iy * step[1], offset[2] + iz * step[2])))
+        for iz in range(n[2]) for iy in range(n[1]) for ix in range(n[0])]
+    return Instances(matrices)(openscad_object)
+
+
+def polar(openscad_object: OpenSCADObject | Bosl2Base, count: int, radius: float = 0., start: float = 0.,
+          angle: float = 360., rotate: bool = True) -> OpenSCADObject:
+    if count < 1:
+        raise ValueError(f"Expected at least one instance, got count={count}")
+    step = angle / count if math.isclose(abs(angle), 360.) else angle / max(count - 1, 1)
+    matrices: List[Matrix4] = list()
+    for i in range(count):
+        a = start + i * step
+        if rotate:
+            matrices.append(_matmul(_action_matrix(_Ro((0., 0., a))), _action_matrix(_Tr((radius, 0., 0.)))))
+        else:
+            rotation = _action_matrix(_Ro((0., 0., a)))
+            matrices.append(_action_matrix(_Tr((radius * rotation[0][0], radius * rotation[1][0], 0.))))
+    return Instances(matrices)(openscad_object)
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Sequence, Tuple, TYPE_CHECKING
+
+from solid2_utils.cache import CacheIndex, _render_cached
+from solid2_utils.render import RenderExecutor, RenderMetricsCollector, RenderTask, _fix_paths, save_to_file
+
+if TYPE_CHECKING:
+    from solid2.core.object_base import OpenSCADObject
+
+
+@dataclass
+class _Shelf:
+    y: float
+    height: float
+    width: float = 0.
+
+
+@dataclass
+class _Plate:
+    shelves: List[_Shelf] = field(default_factory=list)
+
+    @property
+    def height(self) -> float:
+        return sum(shelf.height for shelf in self.shelves)
+
+
+def pack_rectangles(sizes: Sequence[Tuple[float, float]], bed: Tuple[float, float],
+                    spacing: float = 0.) -> List[Tuple[int, float, float, bool]]:
+    # first fit decreasing height shelf packing, each part lies with its short side across the shelf if it fits
+    bed_w, bed_h = bed[0] + spacing, bed[1] + spacing
+    oriented: List[Tuple[float, float, bool]] = list()
+    for idx, (w, h) in enumerate(sizes):
+        w, h = w + spacing, h + spacing
+        candidates = [(w, h, False), (h, w, True)] if w >= h else [(h, w, True), (w, h, False)]
+        fitting = [c for c in candidates if c[0] <= bed_w and c[1] <= bed_h]
+        if len(fitting) == 0:
+            raise ValueError(f"Part {idx} of {sizes[idx][0]} x {sizes[idx][1]} does not fit on a {bed[0]} x {bed[1]} bed")
+        oriented.append(fitting[0])
+
+    placements: List[Tuple[int, float, float, bool]] = [(0, 0., 0., False)] * len(sizes)
+    plates: List[_Plate] = list()
+    for idx in sorted(range(len(sizes)), key=lambda i: oriented[i][1], reverse=True):
+        w, h, rotated = oriented[idx]
+        placed = False
+        for n, plate in enumerate(plates):
+            shelf = next((s for s in plate.shelves if s.height >= h and s.width + w <= bed_w), None)
+            if shelf is None and plate.height + h <= bed_h:
+                shelf = _Shelf(plate.height, h)
+                plate.shelves.append(shelf)
+            if shelf is not None:
+                placements[idx] = (n, shelf.width, shelf.y, rotated)
+                shelf.width += w
+                placed = True
+                break
+        if not placed:
+            plates.append(_Plate([_Shelf(0., h, w)]))
+            placements[idx] = (len(plates) - 1, 0., 0., rotated)
+    return placements
+
+
+def plate_tasks(render_tasks: Iterable[RenderTask], build_dir: Path, openscad_bin: str, output_dir: Path,
+                bed: Tuple[float, float], spacing: float = 5., name: str = "plate",
+                max_cache_bytes: int | None = None, executor: RenderExecutor | None = None,
+                metrics: RenderMetricsCollector | None = None) -> List[RenderTask]:
+    from solid2 import import_stl, union
+    render_tasks = list(render_tasks)
+    rts = _render_cached(((rt.scad_object, Path(Path(rt.filename).name)) for rt in render_tasks), build_dir,
+                         openscad_bin, max_cache_bytes, executor, metrics)
+    keys = [Path(rt.filename).relative_to(build_dir).as_posix() for rt in rts]
+    with CacheIndex(build_dir) as index:
+        bounds = index.bounds(index.lookup(keys).values())
+    missing = [Path(rt.filename).as_posix() for rt, key in zip(render_tasks, keys) if key not in bounds]
+    if len(missing) > 0:
+        raise ValueError(f"No cached mesh for {", ".join(missing)}")
+
+    placements = pack_rectangles([(high[0] - low[0], high[1] - low[1]) for low, high in (bounds[k] for k in keys)],
+                                 bed, spacing)
+    stl_filenames = _fix_paths((Path(rt.filename).with_suffix(".stl") for rt in rts),
+                               convert=openscad_bin.startswith("wsl"))
+    plates: Dict[int, List[OpenSCADObject]] = dict()
+    for rt, key, stl_filename, (n, x, y, rotated) in zip(render_tasks, keys, stl_filenames, placements):
+        (min_x, min_y, min_z), (max_x, max_y, _) = bounds[key]
+        part = import_stl(stl_filename)
+        if rotated:
+            part = part.rotate([0, 0, 90])
+            min_x, min_y = -max_y, min_x
+        rt.position = (x - min_x, y - min_y, -min_z)
+        plates.setdefault(n, []).append(part.translate(rt.position))
+    return [RenderTask(union()(*parts), output_dir.joinpath(f"{name}{n}")) for n, parts in sorted(plates.items())]
+
+
+def save_plates(openscad_bin: str, render_tasks: Iterable[RenderTask], build_dir: Path, output_dir: Path,
+                bed: Tuple[float, float], spacing: float = 5., name: str = "plate", file_types: List[str] | None = None,
+                max_cache_bytes: int | None = None, executor: RenderExecutor | None = None,
+                metrics: RenderMetricsCollector | None = None) -> List[Tuple[Path, float]]:
+    plates = plate_tasks(render_tasks, build_dir, openscad_bin, output_dir, bed, spacing, name, max_cache_bytes,
+                         executor, metrics)
+    return save_to_file(openscad_bin, plates, file_types=[".3mf"] if file_types is None else file_types,
+                        executor=executor, metrics=metrics)
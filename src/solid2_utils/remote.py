@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+import zipfile
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Generator, Iterable, List, Tuple
+
+from solid2_utils.render import RenderMetrics, _RenderTaskArgs, _render_to_file, _write_scad, find_openscad
+
+
+class _RenderRequestHandler(BaseHTTPRequestHandler):
+    server: _RenderWorkerServer
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def _send_json(self, data: Dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path != "/info":
+            self.send_error(404)
+            return
+        self._send_json({"slots": self.server.worker.slots})
+
+    def do_POST(self) -> None:
+        if self.path != "/render":
+            self.send_error(404)
+            return
+        name = Path(self.headers["X-Name"]).name
+        file_types = [ext for ext in self.headers["X-File-Types"].split(",") if ext]
+        name_model = self.headers.get("X-Name-Model", "1") == "1"
+        scad_text = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+
+        with self.server.worker.limit, tempfile.TemporaryDirectory(prefix="solid2_utils_") as tmp_dir:
+            filename = Path(tmp_dir).joinpath(name)
+            archive_filename = Path(tmp_dir).joinpath("outputs.zip")
+            try:
+                _, elapsed, metrics = _render_to_file(_RenderTaskArgs(None, filename, file_types,
+                                                                      openscad_bin=self.server.worker.openscad_bin,
+                                                                      scad_text=scad_text, name_model=name_model))
+                with zipfile.ZipFile(archive_filename, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                    for ext in file_types:
+                        if filename.with_suffix(ext).exists():
+                            archive.write(filename.with_suffix(ext), ext)
+            except Exception as ex:
+                # a failed task is answered, dropping the connection would look like a dead worker to the client
+                logging.exception(f"Failed to render {name}: {ex}")
+                self.send_error(500, str(ex))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(archive_filename.stat().st_size))
+            self.send_header("X-Elapsed", str(elapsed))
+            self.send_header("X-Metrics", json.dumps(asdict(metrics)))
+            self.end_headers()
+            with open(archive_filename, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+
+
+class _RenderWorkerServer(ThreadingHTTPServer):
+    daemon_threads = True
+    worker: RenderWorker
+
+
+class RenderWorker:
+    def __init__(self, openscad_bin: str | None, host: str = "127.0.0.1", port: int = 0, slots: int | None = None):
+        self.openscad_bin = openscad_bin
+        self.slots = slots if slots is not None else max(multiprocessing.cpu_count() - 2, 1)
+        self.limit = threading.BoundedSemaphore(self.slots)
+        self.server = _RenderWorkerServer((host, port), _RenderRequestHandler)
+        self.server.worker = self
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_forever(self) -> None:
+        self.server.serve_forever()
+
+    def start(self) -> RenderWorker:
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def shutdown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> RenderWorker:
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+
+
+def start_local_workers(count: int, openscad_bin: str | None, slots: int = 1) -> List[RenderWorker]:
+    return [RenderWorker(openscad_bin, slots=slots).start() for _ in range(count)]
+
+
+def _is_unreachable(ex: Exception) -> bool:
+    # only failing to connect means the worker is gone, a dropped connection is a failure of that one task
+    if not isinstance(ex, urllib.error.URLError) or isinstance(ex, urllib.error.HTTPError):
+        return False
+    return isinstance(ex.reason, (ConnectionRefusedError, TimeoutError))
+
+
+class RemoteRenderer:
+    def __init__(self, workers: Iterable[str], retries: int = 2, timeout: float | None = 60. * 60.):
+        self.workers = list(workers)
+        self.retries = retries
+        self.timeout = timeout
+
+    def _slots(self, url: str) -> int:
+        try:
+            with urllib.request.urlopen(f"{url}/info", timeout=self.timeout) as response:
+                return int(json.load(response)["slots"])
+        except (OSError, ValueError, KeyError) as ex:
+            logging.warning(f"Render worker {url} is not available: {ex}")
+            return 0
+
+    def _render(self, url: str, task: _RenderTaskArgs) -> Tuple[Path, float, RenderMetrics]:
+        _write_scad(task)
+        request = urllib.request.Request(f"{url}/render", data=(task.scad_text or "").encode("utf-8"), method="POST",
+                                         headers={"X-Name": task.filename.name,
+                                                  "X-File-Types": ",".join(task.file_types),
+                                                  "X-Name-Model": "1" if task.name_model else "0"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response, tempfile.TemporaryFile() as tmp:
+            elapsed = float(response.headers["X-Elapsed"])
+            metrics = RenderMetrics(**json.loads(response.headers["X-Metrics"]))
+            shutil.copyfileobj(response, tmp)
+            tmp.seek(0)
+            with zipfile.ZipFile(tmp) as archive:
+                for ext in archive.namelist():
+                    # replaces drafts of progressive renders only once complete
+                    output = task.filename.with_suffix(ext)
+                    staged = output.with_name(f"{output.name}.{threading.get_ident()}.tmp")
+                    with archive.open(ext) as src, open(staged, "wb") as dst:
+                        shutil.copyfileobj(src, dst)
+                    os.replace(staged, output)
+        metrics.name = task.filename.absolute().as_posix()
+        metrics.slot = f"{url} {metrics.slot}"
+        return task.filename.absolute(), elapsed, metrics
+
+    def _work(self, url: str, tasks: queue.Queue, results: queue.Queue, done: threading.Event) -> None:
+        # every worker slot pulls the next task as soon as it is idle, so fast workers take over more of the batch
+        while not done.is_set():
+            try:
+                task, attempts = tasks.get(timeout=.1)
+            except queue.Empty:
+                continue
+            try:
+                results.put(self._render(url, task))
+            except Exception as ex:
+                logging.warning(f"Render worker {url} failed on {task.filename}: {ex}")
+                if attempts < self.retries:
+                    tasks.put((task, attempts + 1))
+                else:
+                    results.put((task.filename.absolute(), 0.))
+                if _is_unreachable(ex):
+                    logging.warning(f"Render worker {url} is gone, stopping one of its slots")
+                    return
+
+    def __call__(self, render_tasks_args: List[_RenderTaskArgs]
+                 ) -> Generator[Tuple[Path, float] | Tuple[Path, float, RenderMetrics], None, None]:
+        tasks: queue.Queue = queue.Queue()
+        results: queue.Queue = queue.Queue()
+        done = threading.Event()
+        for task in render_tasks_args:
+            tasks.put((task, 0))
+
+        threads = [threading.Thread(target=self._work, args=(url, tasks, results, done), daemon=True)
+                   for url in self.workers for _ in range(self._slots(url))]
+        for thread in threads:
+            thread.start()
+
+        remaining = {task.filename.absolute() for task in render_tasks_args}
+        try:
+            while len(remaining) > 0:
+                try:
+                    result = results.get(timeout=.1)
+                except queue.Empty:
+                    if any(thread.is_alive() for thread in threads):
+                        continue
+                    try:
+                        result = results.get_nowait()
+                    except queue.Empty:
+                        for filename in sorted(remaining):
+                            logging.error(f"No render worker left for {filename}")
+                            yield filename, 0.
+                        return
+                remaining.discard(result[0])
+                yield result
+        finally:
+            done.set()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="solid2_utils.remote", description="Render worker for solid2_utils")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--slots', type=int)
+    parser.add_argument('--openscad_bin', type=str)
+    args = parser.parse_args()
+
+    worker = RenderWorker(find_openscad(args.openscad_bin), args.host, args.port, args.slots)
+    logging.info(f"Serving render worker on {worker.url} with {worker.slots} slots")
+    worker.serve_forever()
+
+
+if "__main__" == __name__:
+    main()
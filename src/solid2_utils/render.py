@@ -1,22 +1,37 @@
+from __future__ import annotations
+
 import argparse
+import contextlib
 import functools
+import hashlib
+import json
 import logging
 import multiprocessing
 import os
+import queue
 import re
 import shutil
+import signal
+import sqlite3
+import statistics
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import zipfile
-from dataclasses import dataclass
-from itertools import chain, product
+from dataclasses import asdict, dataclass, field, replace
+from itertools import batched, chain, count, product, takewhile
 from pathlib import Path
-from typing import Tuple, Iterable, List, Generator
+from typing import AsyncGenerator, BinaryIO, Callable, Dict, Tuple, Iterable, List, Generator, TextIO, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import asyncio
 
-from solid2 import P3, scad_inline, union
-from solid2.core.object_base import OpenSCADObject
-from solid2.extensions.bosl2.bosl2_base import Bosl2Base
+    from solid2 import P3
+    from solid2.core.object_base import OpenSCADObject
+    from solid2.extensions.bosl2.bosl2_base import Bosl2Base
 
 
 @dataclass
@@ -32,103 +47,1148 @@ def set_output_dir(output_path: Path, render_task: Iterable[RenderTask]) -> Gene
 
 
 def set_render_task_fn(fn: int, render_task: Iterable[RenderTask]) -> Generator[RenderTask, None, None]:
+    from solid2 import scad_inline, union
     for rt in render_task:
         yield RenderTask(union()(scad_inline(f"$fn={fn};\n"), rt.scad_object), rt.filename, rt.position)
 
 
 @dataclass
 class _RenderTaskArgs:
-    scad_object: OpenSCADObject | Bosl2Base
+    scad_object: OpenSCADObject | Bosl2Base | None
     filename: Path
     file_types: List[str]
     openscad_bin: str | None = None
     verbose: bool = False
+    scad_text: str | None = None
+    fingerprint: str | None = None
+    stamp: str | None = None
+    scad_filename: Path | None = None
+    render_args: List[str] | None = None
+    dependencies: List[Path] = field(default_factory=list)
+    translated_paths: Dict[str, str] = field(default_factory=dict)
+    name_model: bool = True
+    timeout: float | None = None
+    cpus: List[int] | None = None
+
+
+@dataclass
+class RenderMetrics:
+    name: str
+    slot: str = ""
+    start: float = 0.
+    end: float = 0.
+    serialize_s: float = 0.
+    hash_s: float = 0.
+    queue_wait_s: float = 0.
+    openscad_wall_s: float = 0.
+    openscad_cpu_s: float = 0.
+    peak_rss_bytes: int = 0
+    output_sizes: Dict[str, int] = field(default_factory=dict)
+    cache: str | None = None
+    ok: bool = False
+
+
+class RenderMetricsCollector:
+    def __init__(self):
+        self.metrics: List[RenderMetrics] = list()
+        self._lock = threading.Lock()
+
+    def add(self, metrics: RenderMetrics) -> None:
+        with self._lock:
+            self.metrics.append(metrics)
+
+    def to_json(self) -> str:
+        return json.dumps([asdict(m) for m in self.metrics], indent=2)
+
+    def to_chrome_trace(self) -> str:
+        slots: Dict[str, int] = dict()
+        events: List[Dict] = list()
+        for m in sorted(self.metrics, key=lambda m: m.start):
+            slot = m.slot if m.slot else "main"
+            if slot not in slots:
+                slots[slot] = len(slots) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": slots[slot],
+                               "args": {"name": slot}})
+            events.append({"name": Path(m.name).name, "cat": m.cache or "render", "ph": "X", "pid": 1,
+                           "tid": slots[slot], "ts": m.start * 1e6, "dur": max(m.end - m.start, 0.) * 1e6,
+                           "args": asdict(m)})
+        return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
+
+    def save(self, json_filename: Path | None = None, chrome_trace_filename: Path | None = None) -> None:
+        if json_filename is not None:
+            json_filename.write_text(self.to_json())
+        if chrome_trace_filename is not None:
+            chrome_trace_filename.write_text(self.to_chrome_trace())
+
+
+def _slot_name() -> str:
+    return f"{os.getpid()}:{threading.current_thread().name}"
+
+
+def _output_sizes(task: _RenderTaskArgs) -> Dict[str, int]:
+    return {ext: task.filename.with_suffix(ext).stat().st_size for ext in task.file_types if
+            task.filename.with_suffix(ext).exists()}
+
+
+@dataclass
+class _OpenSCADRun:
+    returncode: int
+    stdout: bytes
+    stderr: bytes
+    cpu_s: float = 0.
+    peak_rss_bytes: int = 0
+    timed_out: bool = False
+
+
+def _kill_process_tree(process: subprocess.Popen | asyncio.subprocess.Process) -> None:
+    try:
+        if os.name == "posix":
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+
+def _run_openscad(openscad_cli_args: List[str], timeout: float | None = None,
+                  cpus: List[int] | None = None) -> _OpenSCADRun:
+    if not hasattr(os, "wait4"):
+        try:
+            out = subprocess.run(openscad_cli_args, capture_output=True, timeout=timeout)
+        except subprocess.TimeoutExpired as ex:
+            return _OpenSCADRun(-1, ex.stdout or b"", ex.stderr or b"", timed_out=True)
+        return _OpenSCADRun(out.returncode, out.stdout, out.stderr)
+    # wait4 instead of subprocess.run to get the rusage of the OpenSCAD child itself
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(openscad_cli_args, stdout=stdout, stderr=stderr, start_new_session=True)
+        if cpus is not None and hasattr(os, "sched_setaffinity"):
+            # OpenSCAD sizes its thread pool by the affinity mask, so this caps its threads
+            try:
+                os.sched_setaffinity(process.pid, cpus)
+            except OSError as ex:
+                logging.debug(f"Could not set the CPU affinity of OpenSCAD: {ex}")
+        timed_out = threading.Event()
+
+        def kill() -> None:
+            timed_out.set()
+            _kill_process_tree(process)
+
+        timer = threading.Timer(timeout, kill) if timeout is not None else None
+        if timer is not None:
+            timer.start()
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+        finally:
+            if timer is not None:
+                timer.cancel()
+        process.returncode = os.waitstatus_to_exitcode(status)
+        stdout.seek(0)
+        stderr.seek(0)
+        return _OpenSCADRun(process.returncode, stdout.read(), stderr.read(), rusage.ru_utime + rusage.ru_stime,
+                            rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024), timed_out.is_set())
+
+
+RenderResult = Tuple[Path, float] | Tuple[Path, float, RenderMetrics]
+RenderExecutor = Callable[[List[_RenderTaskArgs]], Iterable[RenderResult]]
+
+_wslpath_cache: Dict[str, str] = dict()
+# keeps each wsl command line well below the 32767 characters Windows allows, even for MAX_PATH long paths
+_WSLPATH_BATCH = 64
 
 
 def _wslpath(path: str | Path, convert: bool = False) -> str:
     if not convert:
         return path
-    if isinstance(path, Path):
-        path = str(path.absolute().as_posix())
-    to_run = ["wsl", "wslpath", path]
-    out = subprocess.run(to_run, capture_output=True, check=False).stdout.decode().strip()
-    logging.info(f"{to_run=} {out=}")
-    return out
-
-
-def _render_to_file(task: _RenderTaskArgs) -> Tuple[Path, float]:
-    fix_path = functools.partial(_wslpath, convert=task.openscad_bin.startswith("wsl") if task.openscad_bin is not None else False)
-    scad_filename = task.filename.with_suffix(".scad").absolute().as_posix()
-    task.scad_object.save_as_scad(scad_filename)
-    elapsed = 0.0
+    return _wslpaths([path])[0]
+
+
+def _fix_paths(paths: Iterable[Path], convert: bool = False) -> List[str | Path]:
+    return list(_wslpaths(paths)) if convert else list(paths)
+
+
+def _wslpaths(paths: Iterable[str | Path]) -> List[str]:
+    paths = [str(p.absolute().as_posix()) if isinstance(p, Path) else p for p in paths]
+    for missing in batched(dict.fromkeys(p for p in paths if p not in _wslpath_cache), _WSLPATH_BATCH):
+        to_run = ["wsl", "sh", "-c", 'for p in "$@"; do wslpath "$p"; done', "sh", *missing]
+        out = subprocess.run(to_run, capture_output=True, check=False).stdout.decode().splitlines()
+        logging.info(f"{to_run=} {out=}")
+        if len(out) == len(missing):
+            _wslpath_cache.update(zip(missing, (o.strip() for o in out)))
+        else:
+            for p in missing:
+                _wslpath_cache[p] = subprocess.run(["wsl", "wslpath", p], capture_output=True,
+                                                   check=False).stdout.decode().strip()
+    return [_wslpath_cache[p] for p in paths]
+
+
+def _task_paths(task: _RenderTaskArgs) -> Tuple[List[str], str]:
+    return ([task.filename.with_suffix(ext).absolute().as_posix() for ext in task.file_types],
+            (task.scad_filename or task.filename.with_suffix(".scad")).absolute().as_posix())
+
+
+def _task_dirs(task: _RenderTaskArgs) -> List[str]:
+    outputs, scad_filename = _task_paths(task)
+    return list(dict.fromkeys(Path(p).parent.as_posix() for p in (*outputs, scad_filename)))
+
+
+def _user_cache_filename() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    return (Path(cache_home) if cache_home else Path.home().joinpath(".cache")).joinpath("solid2_utils",
+                                                                                      "openscad.json")
+
+
+def _load_user_cache() -> Dict:
+    try:
+        return json.loads(_user_cache_filename().read_text())
+    except (OSError, ValueError):
+        return dict()
+
+
+def _store_user_cache(cache: Dict) -> None:
+    filename = _user_cache_filename()
+    try:
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        tmp_filename = filename.with_suffix(f".{os.getpid()}.tmp")
+        tmp_filename.write_text(json.dumps(cache, indent=2))
+        os.replace(tmp_filename, filename)
+    except OSError as ex:
+        logging.info(f"Could not write {filename}: {ex}")
+
+
+_USER_CACHE_TTL = 24 * 60 * 60
+
+
+def _openscad_signature(openscad_bin: str) -> List[int] | None:
+    resolved = shutil.which(openscad_bin) if not openscad_bin.startswith("wsl") else None
+    if resolved is None:
+        return None
+    stat = os.stat(resolved)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _is_fresh(entry: Dict, signature: List[int] | None) -> bool:
+    # binaries inside wsl can't be stat'ed cheaply, those entries expire after a day instead
+    if signature is not None:
+        return entry.get("signature") == signature
+    return time.time() - entry.get("time", 0.) < _USER_CACHE_TTL
+
+
+def _write_scad(task: _RenderTaskArgs) -> str:
+    scad_filename = _task_paths(task)[1]
+    if task.scad_text is not None:
+        Path(scad_filename).write_text(task.scad_text, encoding="utf-8")
+    else:
+        task.scad_object.save_as_scad(scad_filename)
+    return scad_filename
+
+
+_FICLONE = 0x40049409
+
+
+_staging_ids = count()
+
+
+def _staged(task: _RenderTaskArgs) -> _RenderTaskArgs:
+    # OpenSCAD writes to private names, the outputs are replaced only once the render succeeded. Outputs may also be
+    # hard links shared with duplicates, so they are never written through.
+    output_dir = task.filename.absolute().parent
+    output_dir.mkdir(parents=True, exist_ok=True)
+    name = (f".{task.filename.with_suffix("").name.replace(".", "_")}_{os.getpid()}_{threading.get_ident()}_"
+            f"{next(_staging_ids)}_tmp")
+    return replace(task, filename=output_dir.joinpath(name),
+                   scad_filename=task.scad_filename or task.filename.with_suffix(".scad"))
+
+
+def _publish_staged(output: _RenderTaskArgs, task: _RenderTaskArgs, ok: bool) -> None:
+    for ext in task.file_types:
+        if ok and output.filename.with_suffix(ext).exists():
+            os.replace(output.filename.with_suffix(ext), task.filename.with_suffix(ext))
+        else:
+            output.filename.with_suffix(ext).unlink(missing_ok=True)
+
+
+def _clone_file(src: Path, dst: Path) -> None:
+    # reflink, hard link or copy, whatever the file system supports first
+    tmp = dst.with_name(f"{dst.name}.{os.getpid()}.tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        if sys.platform != "linux":
+            raise OSError("reflinks are only supported on linux")
+        import fcntl
+        with open(src, "rb") as f, open(tmp, "wb") as out:
+            fcntl.ioctl(out.fileno(), _FICLONE, f.fileno())
+    except OSError:
+        tmp.unlink(missing_ok=True)
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _openscad_render_args() -> List[str]:
     manifold = True
     extra_cli_args = ["--backend", "Manifold"] if manifold else []
+    return [*extra_cli_args, "--colorscheme", "BeforeDawn"]
+
+
+def _openscad_bin_args(openscad_bin: str) -> List[str]:
+    if openscad_bin.startswith("wsl"):
+        return openscad_bin.split(" ", 1)
+    return [openscad_bin]
+
+
+@functools.cache
+def _openscad_version(openscad_bin: str) -> str:
+    cache = _load_user_cache()
+    signature = _openscad_signature(openscad_bin)
+    entry = cache.get("versions", dict()).get(openscad_bin)
+    if entry is not None and _is_fresh(entry, signature):
+        return entry["value"]
+    out = subprocess.run([*_openscad_bin_args(openscad_bin), "--version"], capture_output=True, check=False)
+    version = (out.stdout + out.stderr).decode(errors="replace").strip()
+    cache.setdefault("versions", dict())[openscad_bin] = {"value": version, "signature": signature,
+                                                          "time": time.time()}
+    _store_user_cache(cache)
+    return version
+
+
+def _default_library_dirs() -> List[Path]:
+    if sys.platform == "win32":
+        return [Path.home().joinpath("Documents", "OpenSCAD", "libraries"),
+                Path(os.environ.get("ProgramFiles", "C:/Program Files")).joinpath("OpenSCAD", "libraries")]
+    if sys.platform == "darwin":
+        return [Path.home().joinpath("Documents", "OpenSCAD", "libraries"),
+                Path("/Applications/OpenSCAD.app/Contents/Resources/libraries")]
+    data_home = os.environ.get("XDG_DATA_HOME")
+    return [(Path(data_home) if data_home else Path.home().joinpath(".local", "share")).joinpath("OpenSCAD", "libraries"),
+            Path("/usr/local/share/openscad/libraries"), Path("/usr/share/openscad/libraries")]
+
+
+def _parse_library_dirs(info: str) -> List[Path]:
+    lines = iter(info.splitlines())
+    for line in lines:
+        if line.strip().startswith("OpenSCAD library path"):
+            return [Path(path.strip()) for path in takewhile(lambda l: l.startswith((" ", "\t")), lines)
+                    if path.strip()]
+    return []
+
+
+@functools.cache
+def _openscad_library_dirs(openscad_bin: str | None) -> List[Path]:
+    # the user and installation library dirs, searched after OPENSCADPATH like OpenSCAD does
+    if openscad_bin is None:
+        return _default_library_dirs()
+    if openscad_bin.startswith("wsl"):
+        return []
+    cache = _load_user_cache()
+    signature = _openscad_signature(openscad_bin)
+    entry = cache.get("library_dirs", dict()).get(openscad_bin)
+    if entry is not None and _is_fresh(entry, signature):
+        return [Path(p) for p in entry["value"]]
+    try:
+        out = subprocess.run([openscad_bin, "--info"], capture_output=True, check=False, timeout=60)
+        library_dirs = _parse_library_dirs((out.stdout + out.stderr).decode(errors="replace"))
+    except (OSError, subprocess.TimeoutExpired):
+        library_dirs = []
+    if len(library_dirs) == 0:
+        return _default_library_dirs()
+    cache.setdefault("library_dirs", dict())[openscad_bin] = {"value": [p.as_posix() for p in library_dirs],
+                                                              "signature": signature, "time": time.time()}
+    _store_user_cache(cache)
+    return library_dirs
+
+
+def find_openscad(openscad_bin: str | None = None) -> str | None:
+    found = next((p for p in (openscad_bin, shutil.which("openscad-nightly"), shutil.which("openscad")) if p is not None),
+                 None)
+    is_wsl = shutil.which("wsl")
+    if found is not None or is_wsl is None or len(is_wsl) == 0:
+        return found
+
+    cache = _load_user_cache()
+    entry = cache.get("wsl_openscad")
+    if entry is not None and _is_fresh(entry, None):
+        return entry["value"]
+    out = subprocess.run(["wsl", "bash", "-l", "-c", "which openscad-nightly openscad"], capture_output=True,
+                         check=False).stdout.decode().split()
+    if len(out) == 0:
+        return None
+    found = f"wsl {out[0]}"
+    cache["wsl_openscad"] = {"value": found, "time": time.time()}
+    _store_user_cache(cache)
+    return found
+
+
+def _openscad_cli_args(task: _RenderTaskArgs, openscad_bin: str, scad_filename: str) -> List[str]:
+    out_filenames = [task.filename.with_suffix(ext).absolute().as_posix() for ext in task.file_types]
+    if openscad_bin.startswith("wsl"):
+        # only the directories are translated, so the staged names need no extra wsl round trips
+        _wslpath_cache.update(task.translated_paths)
+        paths = [Path(p) for p in (*out_filenames, scad_filename)]
+        *out_filenames, scad_filename = [f"{d.rstrip("/")}/{p.name}" for d, p in
+                                         zip(_wslpaths([p.parent.as_posix() for p in paths]), paths)]
+    openscad_bin_args = _openscad_bin_args(openscad_bin)
+
+    render_args = task.render_args if task.render_args is not None else _openscad_render_args()
+    return [*openscad_bin_args, *chain.from_iterable(product(("-o",), out_filenames)), *render_args, scad_filename]
+
+
+def _render_to_file(task: _RenderTaskArgs) -> Tuple[Path, float, RenderMetrics]:
+    metrics = RenderMetrics(task.filename.absolute().as_posix(), slot=_slot_name(), start=time.time())
+    output = _staged(task)
+    serialize_start = time.perf_counter()
+    scad_filename = _write_scad(output)
+    metrics.serialize_s = time.perf_counter() - serialize_start
+    elapsed = 0.0
     if task.openscad_bin is not None:
-        out_filenames = tuple(chain.from_iterable(product(("-o",), (
-            fix_path(task.filename.with_suffix(ext).absolute().as_posix()) for ext in task.file_types))))
-        openscad_bin: List[str] = [task.openscad_bin]
-        if task.openscad_bin.startswith("wsl"):
-            openscad_bin = task.openscad_bin.split(" ", 1)
-
-        openscad_cli_args = [*openscad_bin, *out_filenames, *extra_cli_args, "--colorscheme", "BeforeDawn",
-                             fix_path(scad_filename)]
-        return_code = None
-        try:
-            logging.info(f"Running [{",".join(f'"{s}"' for s in openscad_cli_args)}]")
-            start = time.time()
+        openscad_cli_args = _openscad_cli_args(output, task.openscad_bin, scad_filename)
+        logging.info(f"Running [{",".join(f'"{s}"' for s in openscad_cli_args)}]")
+        start = time.time()
 
-            return_code = subprocess.run(openscad_cli_args, capture_output=True)
-            return_code.check_returncode()
-            elapsed = (time.time() - start)
-            if task.filename.with_suffix(".3mf").exists():
-                set_model_name(task.filename.with_suffix(".3mf"), task.filename.name)
-        except subprocess.CalledProcessError as ex:
+        run = _run_openscad(openscad_cli_args, task.timeout, task.cpus)
+        metrics.openscad_wall_s = time.time() - start
+        metrics.openscad_cpu_s = run.cpu_s
+        metrics.peak_rss_bytes = run.peak_rss_bytes
+        if run.timed_out:
+            logging.error(f"Timeout after {task.timeout}s rendering {scad_filename}")
+        elif run.returncode != 0:
             logging.info(f"Saving {scad_filename}")
-            logging.error(ex)
-            if return_code is not None:
-                logging.error(return_code.stdout)
-            return task.filename.absolute(), elapsed
+            logging.error(subprocess.CalledProcessError(run.returncode, openscad_cli_args))
+            logging.error(run.stdout)
+        else:
+            elapsed = metrics.openscad_wall_s
+            try:
+                if task.name_model and output.filename.with_suffix(".3mf").exists():
+                    set_model_name(output.filename.with_suffix(".3mf"), task.filename.name)
+            except ValueError as ex:
+                logging.error(ex)
+                logging.error(run.stdout)
+                logging.error(run.stderr)
+                sys.stdout.buffer.write(run.stderr)
+        _publish_staged(output, task, elapsed > 0.)
+    metrics.output_sizes = _output_sizes(task)
+    metrics.ok = elapsed > 0.
+    metrics.end = time.time()
+    return task.filename.absolute(), elapsed, metrics
+
+
+async def _render_to_file_async(task: _RenderTaskArgs, limit: asyncio.Semaphore,
+                                timeout: float | None) -> Tuple[Path, float, RenderMetrics]:
+    async with limit:
+        metrics = RenderMetrics(task.filename.absolute().as_posix(), slot=_slot_name(), start=time.time())
+        try:
+            filename, elapsed = await _run_render_async(task, timeout, metrics)
+        except Exception as ex:
+            logging.error(f"Failed to render {task.filename.absolute().as_posix()}: {ex}")
+            filename, elapsed = task.filename.absolute(), 0.
+        metrics.output_sizes = _output_sizes(task)
+        metrics.ok = elapsed > 0.
+        metrics.end = time.time()
+        return filename, elapsed, metrics
+
+
+async def _run_render_async(task: _RenderTaskArgs, timeout: float | None,
+                            metrics: RenderMetrics) -> Tuple[Path, float]:
+    import asyncio
+    output = _staged(task)
+    serialize_start = time.perf_counter()
+    write = asyncio.ensure_future(asyncio.to_thread(_write_scad, output))
+    try:
+        scad_filename = await asyncio.shield(write)
+    except asyncio.CancelledError:
+        # the thread can't be stopped, a cancelled render is only over once it stopped writing the scad file
+        await write
+        raise
+    metrics.serialize_s = time.perf_counter() - serialize_start
+    if task.openscad_bin is None:
+        return task.filename.absolute(), 0.
+    elapsed = 0.
+    try:
+        elapsed = await _run_openscad_async(output, task, scad_filename, timeout)
+    finally:
+        _publish_staged(output, task, elapsed > 0.)
+    return task.filename.absolute(), elapsed
+
+
+async def _run_openscad_async(output: _RenderTaskArgs, task: _RenderTaskArgs, scad_filename: str,
+                              timeout: float | None) -> float:
+    import asyncio
+    openscad_cli_args = _openscad_cli_args(output, task.openscad_bin, scad_filename)
+    logging.info(f"Running [{",".join(f'"{s}"' for s in openscad_cli_args)}]")
+    start = time.time()
+    process = await asyncio.create_subprocess_exec(*openscad_cli_args, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE,
+                                                   start_new_session=os.name == "posix")
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except TimeoutError:
+        _kill_process_tree(process)
+        await process.wait()
+        logging.error(f"Timeout after {timeout}s rendering {scad_filename}")
+        return 0.
+    except asyncio.CancelledError:
+        _kill_process_tree(process)
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        logging.info(f"Saving {scad_filename}")
+        logging.error(f"{openscad_cli_args} returned non-zero exit status {process.returncode}")
+        logging.error(stdout)
+        return 0.
+    elapsed = time.time() - start
+    if task.name_model and output.filename.with_suffix(".3mf").exists():
+        try:
+            await asyncio.to_thread(set_model_name, output.filename.with_suffix(".3mf"), task.filename.name)
         except ValueError as ex:
             logging.error(ex)
-            if return_code is not None:
-                logging.error(return_code.stdout)
-                logging.error(return_code.stderr)
-                sys.stdout.buffer.write(return_code.stderr)
-    return task.filename.absolute(), elapsed
+            logging.error(stdout)
+            logging.error(stderr)
+    return elapsed
+
+
+_3MF_MODEL = "3D/3dmodel.model"
+_COPY_CHUNK_SIZE = 1 << 20
+
+
+# the raw copy writes through ZipFile internals, without them members are recompressed through the public API
+_RAW_COPY_ATTRIBUTES = ("fp", "start_dir", "filelist", "NameToInfo", "_didModify")
+
+
+def _supports_raw_copy(new: zipfile.ZipFile) -> bool:
+    return callable(getattr(zipfile.ZipInfo, "FileHeader", None)) and all(
+        hasattr(new, attr) for attr in _RAW_COPY_ATTRIBUTES)
+
+
+def _copy_zip_member_stream(old: zipfile.ZipFile, new: zipfile.ZipFile, zip_info: zipfile.ZipInfo) -> None:
+    new_info = zipfile.ZipInfo(zip_info.filename, zip_info.date_time)
+    new_info.compress_type = zip_info.compress_type
+    new_info.external_attr = zip_info.external_attr
+    new_info.file_size = zip_info.file_size
+    with old.open(zip_info) as member_src, new.open(new_info, "w") as member_dst:
+        shutil.copyfileobj(member_src, member_dst, _COPY_CHUNK_SIZE)
+
+
+def _copy_zip_member_raw(src: BinaryIO, new: zipfile.ZipFile, zip_info: zipfile.ZipInfo) -> None:
+    src.seek(zip_info.header_offset)
+    header = src.read(30)
+    if header[:4] != b"PK\x03\x04":
+        raise zipfile.BadZipFile(f"Bad local file header for {zip_info.filename}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    src.seek(name_length + extra_length, os.SEEK_CUR)
+
+    new_info = zipfile.ZipInfo(zip_info.filename, zip_info.date_time)
+    for attr in ("compress_type", "comment", "create_system", "create_version", "extract_version", "external_attr",
+                 "internal_attr", "CRC", "compress_size", "file_size"):
+        setattr(new_info, attr, getattr(zip_info, attr))
+    # sizes are known up front, so the copy never needs a trailing data descriptor
+    new_info.flag_bits = zip_info.flag_bits & ~0x08
+    new_info.header_offset = new.fp.tell()
+    new.fp.write(new_info.FileHeader())
+    remaining = zip_info.compress_size
+    while remaining > 0:
+        chunk = src.read(min(remaining, _COPY_CHUNK_SIZE))
+        if len(chunk) == 0:
+            raise zipfile.BadZipFile(f"Truncated data for {zip_info.filename}")
+        new.fp.write(chunk)
+        remaining -= len(chunk)
+    new.start_dir = new.fp.tell()
+    new.filelist.append(new_info)
+    new.NameToInfo[new_info.filename] = new_info
+    new._didModify = True
+
+
+def _replace_stream(src: BinaryIO, dst: BinaryIO, old: bytes, new: bytes) -> None:
+    pending = b""
+    while True:
+        chunk = src.read(_COPY_CHUNK_SIZE)
+        data = pending + chunk
+        pos = 0
+        while (idx := data.find(old, pos)) != -1:
+            dst.write(data[pos:idx])
+            dst.write(new)
+            pos = idx + len(old)
+        if len(chunk) == 0:
+            dst.write(data[pos:])
+            return
+        # keep a tail that could still be the start of a match split across chunks
+        keep = max(pos, len(data) - len(old) + 1)
+        dst.write(data[pos:keep])
+        pending = data[keep:]
 
 
 def set_model_name(filename: Path, name: str) -> None:
     old_filename = filename
     new_filename = filename.with_suffix(".new")
     try:
-        with zipfile.ZipFile(old_filename) as old:
+        with open(old_filename, "rb") as src, zipfile.ZipFile(src) as old:
             with zipfile.ZipFile(new_filename, "w") as new:
+                raw_copy = _supports_raw_copy(new)
                 for zip_info in old.infolist():
-                    not_a_bad_file = zip_info.filename != "3D/3dmodel.model"
-                    if not_a_bad_file:
-                        new.writestr(zip_info, old.read(zip_info))
+                    not_a_bad_file = zip_info.filename != _3MF_MODEL
+                    if not_a_bad_file and raw_copy:
+                        _copy_zip_member_raw(src, new, zip_info)
+                    elif not_a_bad_file:
+                        _copy_zip_member_stream(old, new, zip_info)
                     else:
-                        text = old.read("3D/3dmodel.model").decode("utf-8")
-                        xml_str = text.replace("OpenSCAD Model", name)
-                        with new.open("3D/3dmodel.model", "w", ) as f:
-                            f.write(xml_str.encode("utf-8"))
+                        model_info = zipfile.ZipInfo(zip_info.filename, zip_info.date_time)
+                        model_info.compress_type = zip_info.compress_type
+                        model_info.external_attr = zip_info.external_attr
+                        model_info.file_size = zip_info.file_size
+                        with old.open(zip_info) as model_src, new.open(model_info, "w") as model_dst:
+                            _replace_stream(model_src, model_dst, b"OpenSCAD Model", name.encode("utf-8"))
     except zipfile.BadZipFile as exc:
+        new_filename.unlink(missing_ok=True)
         raise ValueError(f"for file {old_filename}") from exc
     shutil.move(new_filename, old_filename)
 
 
-def save_to_file(openscad_bin: str | None, render_tasks: Iterable[RenderTask], file_types: List[str] | None = None,
-                 include_filter_regex: re.Pattern[str] | None = None, remove_duplicates=True,
-                 verbose: bool = False) -> None:
+def set_model_names(filenames: Iterable[Path], verbose: bool = False) -> List[Path]:
     if verbose:
         from multiprocessing.dummy import Pool
     else:
         from multiprocessing import Pool
 
+    filenames = [Path(f) for f in filenames]
+    with Pool(max(multiprocessing.cpu_count() - 2, 1)) as pool:
+        pool.starmap(set_model_name, ((f, f.stem) for f in filenames))
+    return filenames
+
+
+@dataclass
+class RenderProgress:
+    total: int
+    done: int = 0
+    started: float = field(default_factory=time.time)
+    stream: TextIO = field(default_factory=lambda: sys.stderr)
+
+    @property
+    def eta(self) -> float | None:
+        if self.done == 0:
+            return None
+        return (time.time() - self.started) / self.done * (self.total - self.done)
+
+    def __call__(self, filename: Path, elapsed: float) -> None:
+        self.done += 1
+        eta = self.eta
+        eta_str = f"ETA {eta:.0f}s" if eta is not None else "ETA ?"
+        self.stream.write(f"[{self.done}/{self.total}] {time.time() - self.started:.0f}s, {eta_str}: "
+                          f"{filename.name} in {elapsed:.2f}s\n")
+        self.stream.flush()
+
+
+RENDER_TIMINGS_FILENAME = "render_timings.sqlite"
+
+
+class RenderTimings:
+    def __init__(self, filename: Path):
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(filename, timeout=60.)
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("CREATE TABLE IF NOT EXISTS timings (fingerprint TEXT PRIMARY KEY, "
+                             "scad_size INTEGER NOT NULL, seconds REAL NOT NULL)")
+            if "peak_rss" not in {row[1] for row in self._db.execute("PRAGMA table_info(timings)")}:
+                self._db.execute("ALTER TABLE timings ADD COLUMN peak_rss INTEGER NOT NULL DEFAULT 0")
+
+    def close(self) -> None:
+        self._db.close()
+
+    def __enter__(self) -> RenderTimings:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def lookup(self, fingerprints: Iterable[str]) -> Dict[str, Tuple[int, float]]:
+        found: Dict[str, Tuple[int, float]] = dict()
+        for chunk in batched(dict.fromkeys(fingerprints), 900):
+            rows = self._db.execute(f"SELECT fingerprint, scad_size, seconds FROM timings "
+                                    f"WHERE fingerprint IN ({",".join("?" * len(chunk))})", chunk)
+            found.update((fingerprint, (scad_size, seconds)) for fingerprint, scad_size, seconds in rows)
+        return found
+
+    def record(self, fingerprint: str, scad_size: int, seconds: float, peak_rss: int = 0) -> None:
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO timings (fingerprint, scad_size, seconds, peak_rss) "
+                             "VALUES (?, ?, ?, ?)", (fingerprint, scad_size, seconds, peak_rss))
+
+    def peak_rss(self, fingerprints: Iterable[str]) -> Dict[str, int]:
+        found: Dict[str, int] = dict()
+        for chunk in batched(dict.fromkeys(fingerprints), 900):
+            rows = self._db.execute(f"SELECT fingerprint, peak_rss FROM timings "
+                                    f"WHERE peak_rss > 0 AND fingerprint IN ({",".join("?" * len(chunk))})", chunk)
+            found.update(rows)
+        return found
+
+    def seconds_per_byte(self) -> float | None:
+        rates = [seconds / scad_size for scad_size, seconds in
+                 self._db.execute("SELECT scad_size, seconds FROM timings WHERE scad_size > 0")]
+        return statistics.median(rates) if len(rates) > 0 else None
+
+    def estimate(self, tasks: Iterable[Tuple[str, int]]) -> List[float]:
+        tasks = list(tasks)
+        known = self.lookup(fingerprint for fingerprint, _ in tasks)
+        rate = self.seconds_per_byte()
+        # never seen tasks are estimated by the size of their scad, scaled by what similar renders took
+        return [known[fingerprint][1] if fingerprint in known else scad_size * (rate if rate is not None else 1.)
+                for fingerprint, scad_size in tasks]
+
+
+@dataclass
+class RenderLimits:
+    memory_bytes: int | None = None
+    default_peak_rss_bytes: int = 1 << 30
+    timeout: float | None = None
+    openscad_threads: int | None = None
+    workers: int | None = None
+
+
+_SPECIAL_VARIABLE_RE = re.compile(r"\$(f[nas])\s*=\s*(\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)")
+
+
+@dataclass
+class DraftQuality:
+    fn: int = 0
+    fa: float = 30.
+    fs: float = 4.
+    # upper bound for the $fn objects set on themselves, e.g. cylinder(_fn=64), when fn is 0
+    max_fn: int = 16
+
+    def render_args(self) -> List[str]:
+        return ["-D", f"$fn={self.fn}", "-D", f"$fa={self.fa}", "-D", f"$fs={self.fs}"]
+
+    def coarsen(self, scad_text: str) -> str:
+        # the -D values only replace the top level, numbers assigned in the scad text itself are capped here. Included
+        # or used files keep their resolution.
+        def cap(match: re.Match[str]) -> str:
+            name, value = match.group(1), float(match.group(2))
+            if name == "fn":
+                value = min(value, self.fn if self.fn > 0 else self.max_fn) if value > 0 else value
+            else:
+                value = max(value, self.fa if name == "fa" else self.fs)
+            return f"${name} = {value:g}"
+
+        return _SPECIAL_VARIABLE_RE.sub(cap, scad_text)
+
+
+DRAFTS_DIRNAME = ".solid2_utils_drafts"
+
+
+def _available_memory() -> int | None:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _cpu_sets(threads: int | None) -> List[List[int]]:
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else \
+        list(range(multiprocessing.cpu_count()))
+    if threads is None or threads >= len(cpus):
+        return [cpus]
+    return [cpus[i:i + threads] for i in range(0, len(cpus) - threads + 1, threads)]
+
+
+def _iter_admitted(pool, tasks: List[_RenderTaskArgs], predicted_rss: List[int], limits: RenderLimits,
+                   workers: int) -> Generator[Tuple[Path, float, RenderMetrics], None, None]:
+    # only starts a render when its predicted peak RSS fits next to the ones already running
+    results: queue.SimpleQueue = queue.SimpleQueue()
+    waiting = list(zip(tasks, predicted_rss))
+    cpu_sets = _cpu_sets(limits.openscad_threads) if limits.openscad_threads is not None else []
+    cpu_set_usage = [0] * len(cpu_sets)
+    running: Dict[Path, Tuple[int, int | None]] = dict()
+    reserved = 0
+    # the live available memory already excludes the running renders, so the reservations are counted against a
+    # snapshot from before the first one started
+    budget = limits.memory_bytes if limits.memory_bytes is not None else _available_memory()
+
+    def fits(rss: int) -> bool:
+        available = _available_memory()
+        return (budget is None or reserved + rss <= budget) and (available is None or rss <= available)
+
+    while len(waiting) > 0 or len(running) > 0:
+        while len(waiting) > 0 and len(running) < workers:
+            idx = 0 if len(running) == 0 else next((i for i, (_, rss) in enumerate(waiting) if fits(rss)), None)
+            if idx is None:
+                break
+            task, rss = waiting.pop(idx)
+            cpu_set = None
+            if len(cpu_sets) > 0:
+                cpu_set = cpu_set_usage.index(min(cpu_set_usage))
+                cpu_set_usage[cpu_set] += 1
+                task.cpus = cpu_sets[cpu_set]
+            task.timeout = limits.timeout
+            if len(running) == 0 and not fits(rss):
+                logging.warning(f"{task.filename} is predicted to need {rss >> 20} MiB, more than is available")
+            running[task.filename.absolute()] = (rss, cpu_set)
+            reserved += rss
+            pool.apply_async(_render_to_file, (task,), callback=results.put, error_callback=results.put)
+        result = results.get()
+        if isinstance(result, BaseException):
+            raise result
+        rss, cpu_set = running.pop(result[0])
+        reserved -= rss
+        if cpu_set is not None:
+            cpu_set_usage[cpu_set] -= 1
+        yield result
+
+
+_PATH_REFERENCE_RE = re.compile(r'(?:include|use)\s*<([^>]+)>|(?:import|surface)\s*\(\s*(?:file\s*=\s*)?"([^"]+)"')
+
+
+def _relative_references(task: _RenderTaskArgs, text: str) -> List[str]:
+    # relative paths resolve against the directory of the scad file, so equal text may still be different geometry
+    scad_dir = (task.scad_filename or task.filename).absolute().parent
+    resolved: List[str] = list()
+    for library, data_file in _PATH_REFERENCE_RE.findall(text):
+        if library and not Path(library).is_absolute():
+            resolved.append((_resolve_library(library, scad_dir, _openscad_library_dirs(task.openscad_bin)) or
+                             scad_dir.joinpath(library)).as_posix())
+        elif data_file and not Path(data_file).is_absolute():
+            resolved.append(scad_dir.joinpath(data_file).as_posix())
+    return resolved
+
+
+def _content_key(task: _RenderTaskArgs) -> str | None:
+    if task.scad_text is not None:
+        content = hashlib.md5(task.scad_text.encode()).hexdigest()
+        references = _relative_references(task, task.scad_text)
+    elif task.scad_object is not None:
+        from solid2_utils.fingerprint import fingerprint, path_references
+        content = fingerprint(task.scad_object)
+        references = _relative_references(task, path_references(task.scad_object))
+    else:
+        return None
+    return hashlib.md5("\0".join([content, task.openscad_bin or "", *task.file_types, *(task.render_args or []),
+                                  *(d.as_posix() for d in task.dependencies), *references]).encode()).hexdigest()
+
+
+def _render_fingerprint(scad_text: str, file_types: List[str]) -> str:
+    return hashlib.md5("\n".join([scad_text, *file_types]).encode()).hexdigest()
+
+
+def _schedule_longest_first(render_tasks_args: List[_RenderTaskArgs], timings: RenderTimings) -> List[_RenderTaskArgs]:
+    for task in render_tasks_args:
+        if task.scad_text is None:
+            task.scad_text = task.scad_object.as_scad() + "\n"
+        if task.fingerprint is None:
+            task.fingerprint = _render_fingerprint(task.scad_text, task.file_types)
+    estimates = timings.estimate((task.fingerprint, len(task.scad_text)) for task in render_tasks_args)
+    order = sorted(range(len(render_tasks_args)), key=lambda idx: estimates[idx], reverse=True)
+    return [render_tasks_args[idx] for idx in order]
+
+
+_INCLUDE_RE = re.compile(r"^\s*(?:include|use)\s*<([^>]+)>", re.MULTILINE)
+
+_library_cache: Dict[Path, Tuple[int, int, str, List[Path]]] = dict()
+
+
+def _resolve_library(name: str, including_dir: Path, library_dirs: List[Path]) -> Path | None:
+    if Path(name).is_absolute():
+        return Path(name).resolve() if Path(name).is_file() else None
+    search_dirs = [including_dir, *(Path(p) for p in os.environ.get("OPENSCADPATH", "").split(os.pathsep) if p),
+                   *library_dirs]
+    for candidate in (d.joinpath(name) for d in search_dirs):
+        if candidate.is_file():
+            return candidate.resolve()
+    return None
+
+
+def _library_file(filename: Path, library_dirs: List[Path]) -> Tuple[str, List[Path]]:
+    stat = filename.stat()
+    cached = _library_cache.get(filename)
+    if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2], cached[3]
+    content = filename.read_bytes()
+    dependencies = [_resolve_library(name, filename.parent, library_dirs) or Path(name) for name in
+                    _INCLUDE_RE.findall(content.decode(errors="replace"))]
+    digest = hashlib.md5(content).hexdigest()
+    _library_cache[filename] = (stat.st_mtime_ns, stat.st_size, digest, dependencies)
+    return digest, dependencies
+
+
+def _libraries_digest(scad_text: str, scad_dir: Path, library_dirs: List[Path]) -> str:
+    digest = hashlib.md5()
+    seen: set[Path] = set()
+    stack = [_resolve_library(name, scad_dir, library_dirs) or Path(name) for name in
+             reversed(_INCLUDE_RE.findall(scad_text))]
+    while len(stack) > 0:
+        filename = stack.pop()
+        if filename in seen:
+            continue
+        seen.add(filename)
+        if not filename.is_file():
+            digest.update(f"{filename.as_posix()}:missing\n".encode())
+            continue
+        file_digest, dependencies = _library_file(filename, library_dirs)
+        digest.update(f"{filename.as_posix()}:{file_digest}\n".encode())
+        stack.extend(reversed(dependencies))
+    return digest.hexdigest()
+
+
+def _render_stamp(task: _RenderTaskArgs) -> str:
+    scad_text = task.scad_text or ""
+    openscad = [task.openscad_bin, _openscad_version(task.openscad_bin)] if task.openscad_bin is not None else []
+    render_args = task.render_args if task.render_args is not None else _openscad_render_args()
+    dependencies = [f"{d.as_posix()}:{hashlib.md5(d.read_bytes()).hexdigest() if d.exists() else "missing"}" for d in
+                    task.dependencies]
+    return hashlib.md5("\n".join([hashlib.md5(scad_text.encode()).hexdigest(), *openscad, *render_args,
+                                  *task.file_types, *dependencies,
+                                  _libraries_digest(scad_text, task.filename.absolute().parent,
+                                                    _openscad_library_dirs(task.openscad_bin))]).encode()).hexdigest()
+
+
+def _stamp_filename(filename: Path, ext: str) -> Path:
+    return Path(filename.with_suffix(ext).as_posix() + ".stamp")
+
+
+def _is_up_to_date(task: _RenderTaskArgs) -> bool:
+    for ext in task.file_types:
+        stamp_filename = _stamp_filename(task.filename, ext)
+        if not task.filename.with_suffix(ext).exists() or not stamp_filename.exists():
+            return False
+        if stamp_filename.read_text().strip() != task.stamp:
+            return False
+    return True
+
+
+def _write_stamps(task: _RenderTaskArgs) -> None:
+    for ext in task.file_types:
+        if task.filename.with_suffix(ext).exists() and task.stamp is not None:
+            _stamp_filename(task.filename, ext).write_text(task.stamp + "\n")
+
+
+def _draft_scad_filename(task: _RenderTaskArgs) -> Path:
+    return task.filename.absolute().parent.joinpath(f".{task.filename.name}_draft.scad")
+
+
+def _output_identity(filename: Path) -> Tuple[int, int] | None:
+    try:
+        stat = filename.stat()
+        return stat.st_ino, stat.st_mtime_ns
+    except OSError:
+        return None
+
+
+class _RenderBatch:
+    def __init__(self, render_tasks_args: List[_RenderTaskArgs], progress: bool, timings_filename: Path | None,
+                 incremental: bool, serialize: bool = False, metrics: RenderMetricsCollector | None = None,
+                 remove_duplicates: bool = False):
+        self.timings = RenderTimings(timings_filename) if timings_filename is not None else None
+        self.incremental = incremental
+        self.metrics = metrics
+        self._serialize_s: Dict[Path, float] = dict()
+        self._hash_s: Dict[Path, float] = dict()
+        if serialize or incremental or self.timings is not None:
+            for task in render_tasks_args:
+                if task.scad_text is None:
+                    start = time.perf_counter()
+                    task.scad_text = task.scad_object.as_scad() + "\n"
+                    self._serialize_s[task.filename.absolute()] = time.perf_counter() - start
+        if incremental or self.timings is not None:
+            for task in render_tasks_args:
+                start = time.perf_counter()
+                if incremental:
+                    task.stamp = _render_stamp(task)
+                if self.timings is not None:
+                    task.fingerprint = _render_fingerprint(task.scad_text, task.file_types)
+                self._hash_s[task.filename.absolute()] = time.perf_counter() - start
+        self.up_to_date: List[_RenderTaskArgs] = list()
+        self.pending: List[_RenderTaskArgs] = render_tasks_args
+        if incremental:
+            self.pending = list()
+            for task in render_tasks_args:
+                (self.up_to_date if _is_up_to_date(task) else self.pending).append(task)
+        self._tasks_by_filename = {task.filename.absolute(): task for task in render_tasks_args}
+        self.duplicates: Dict[Path, List[_RenderTaskArgs]] = dict()
+        self._drafts: Dict[Path, _RenderTaskArgs] = dict()
+        self._replaced_outputs: Dict[Path, Tuple[int, int] | None] = dict()
+        self._draft_outputs: Dict[Path, Tuple[int, int] | None] = dict()
+        self._final_outputs: set[Path] = set()
+        if remove_duplicates:
+            representatives: Dict[str, _RenderTaskArgs] = dict()
+            unique: List[_RenderTaskArgs] = list()
+            for task in self.pending:
+                key = _content_key(task)
+                if key is not None and key in representatives:
+                    self.duplicates.setdefault(representatives[key].filename.absolute(), []).append(task)
+                    continue
+                if key is not None:
+                    representatives[key] = task
+                unique.append(task)
+            for filename in self.duplicates:
+                self._tasks_by_filename[filename].name_model = False
+            self.pending = unique
+        if self.timings is not None:
+            self.pending = _schedule_longest_first(self.pending, self.timings)
+        wsl_tasks = [task for task in self.pending if task.openscad_bin is not None and task.openscad_bin.startswith("wsl")]
+        if len(wsl_tasks) > 0:
+            dirs = [d for task in wsl_tasks for d in _task_dirs(task)]
+            translated = dict(zip(dirs, _wslpaths(dirs)))
+            for task in wsl_tasks:
+                task.translated_paths = {d: translated[d] for d in _task_dirs(task)}
+        self.progress = RenderProgress(len(render_tasks_args)) if progress else None
+        self.submitted = time.time()
+
+        if len(self.pending) > 0:
+            logging.info(f"Will generate {", ".join(task.filename.as_posix() for task in self.pending)}", )
+
+    def skipped(self, task: _RenderTaskArgs) -> Tuple[Path, float]:
+        filename = task.filename.absolute()
+        logging.info(f"Up to date {filename.as_posix()}")
+        if self.metrics is not None:
+            now = time.time()
+            self.metrics.add(RenderMetrics(filename.as_posix(), start=now, end=now,
+                                           serialize_s=self._serialize_s.get(filename, 0.),
+                                           hash_s=self._hash_s.get(filename, 0.), output_sizes=_output_sizes(task),
+                                           cache="up_to_date", ok=True))
+        if self.progress is not None:
+            self.progress(filename, 0.)
+        return filename, 0.
+
+    def finished(self, filename: Path, elapsed: float,
+                 metrics: RenderMetrics | None = None) -> List[Tuple[Path, float]]:
+        logging.info(f"Saved in {elapsed:.2f}s {filename.absolute().as_posix()}")
+        task = self._tasks_by_filename.get(filename)
+        if self.metrics is not None:
+            if metrics is None:
+                now = time.time()
+                metrics = RenderMetrics(filename.as_posix(), start=now - elapsed, end=now, openscad_wall_s=elapsed,
+                                        ok=elapsed > 0.)
+            metrics.serialize_s += self._serialize_s.get(filename, 0.)
+            metrics.hash_s += self._hash_s.get(filename, 0.)
+            metrics.queue_wait_s = max(metrics.start - self.submitted, 0.)
+            self.metrics.add(metrics)
+        if task is not None and elapsed > 0.:
+            if self.timings is not None and task.fingerprint is not None:
+                self.timings.record(task.fingerprint, len(task.scad_text or ""), elapsed,
+                                    metrics.peak_rss_bytes if metrics is not None else 0)
+            if self.incremental:
+                _write_stamps(task)
+        if self.progress is not None:
+            self.progress(filename, elapsed)
+        if task is not None and len(self._drafts) > 0:
+            self._final_published(task, elapsed > 0.)
+        results = [(filename, elapsed)]
+        if task is not None and filename in self.duplicates:
+            results.extend(self._fan_out(task, duplicate, elapsed) for duplicate in self.duplicates[filename])
+            self._name_model(task)
+        return results
+
+    def _name_model(self, task: _RenderTaskArgs) -> None:
+        if task.filename.with_suffix(".3mf").exists():
+            try:
+                set_model_name(task.filename.with_suffix(".3mf"), task.filename.name)
+            except ValueError as ex:
+                logging.error(ex)
+
+    def _fan_out(self, task: _RenderTaskArgs, duplicate: _RenderTaskArgs, elapsed: float) -> Tuple[Path, float]:
+        start = time.time()
+        filename = duplicate.filename.absolute()
+        _write_scad(duplicate)
+        if elapsed > 0.:
+            for ext in task.file_types:
+                if task.filename.with_suffix(ext).exists():
+                    _clone_file(task.filename.with_suffix(ext), duplicate.filename.with_suffix(ext))
+            self._name_model(duplicate)
+            if self.incremental:
+                _write_stamps(duplicate)
+            logging.info(f"Copied {task.filename.absolute().as_posix()} to {filename.as_posix()}")
+        if self.metrics is not None:
+            self.metrics.add(RenderMetrics(filename.as_posix(), start=start, end=time.time(),
+                                           output_sizes=_output_sizes(duplicate), cache="duplicate", ok=elapsed > 0.))
+        if self.progress is not None:
+            self.progress(filename, elapsed)
+        return filename, elapsed
+
+    def predicted_rss(self, tasks: List[_RenderTaskArgs], default: int) -> List[int]:
+        known = self.timings.peak_rss(task.fingerprint for task in tasks if task.fingerprint is not None) \
+            if self.timings is not None else dict()
+        return [known.get(task.fingerprint, default) for task in tasks]
+
+    def drafts(self, quality: DraftQuality) -> List[_RenderTaskArgs]:
+        # drafts are cached by content and quality, the final renders replace them once complete
+        drafts: List[_RenderTaskArgs] = list()
+        for task in self.pending:
+            render_args = task.render_args if task.render_args is not None else _openscad_render_args()
+            if task.scad_text is None:
+                task.scad_text = task.scad_object.as_scad() + "\n"
+            # the scad file stays next to the task's one, relative includes and imports resolve against its directory
+            draft = replace(task, scad_text=quality.coarsen(task.scad_text),
+                            render_args=[*render_args, *quality.render_args()], stamp=None, fingerprint=None,
+                            name_model=True, scad_filename=_draft_scad_filename(task), translated_paths=dict())
+            draft.filename = task.filename.absolute().parent.joinpath(DRAFTS_DIRNAME, _content_key(draft),
+                                                                      task.filename.name)
+            self._drafts[draft.filename] = task
+            if all(draft.filename.with_suffix(ext).exists() for ext in task.file_types):
+                self._publish_draft(draft.filename, task)
+                continue
+            # the final render may replace the outputs before this draft's result is consumed, its outputs are
+            # recognized by no longer being the files that were there when the draft was queued
+            for target in [task, *self.duplicates.get(task.filename.absolute(), [])]:
+                for ext in task.file_types:
+                    self._replaced_outputs[target.filename.with_suffix(ext).absolute()] = \
+                        _output_identity(target.filename.with_suffix(ext))
+            draft.filename.parent.mkdir(parents=True, exist_ok=True)
+            drafts.append(draft)
+        return drafts
+
+    def _publish_draft(self, draft_filename: Path, task: _RenderTaskArgs) -> None:
+        for target in [task, *self.duplicates.get(task.filename.absolute(), [])]:
+            for ext in task.file_types:
+                output = target.filename.with_suffix(ext)
+                if output.absolute() in self._final_outputs or (
+                        output.absolute() in self._replaced_outputs and
+                        _output_identity(output) != self._replaced_outputs[output.absolute()]):
+                    continue
+                if draft_filename.with_suffix(ext).exists():
+                    _clone_file(draft_filename.with_suffix(ext), output)
+                    self._draft_outputs[output.absolute()] = _output_identity(output)
+        logging.info(f"Draft of {task.filename.absolute().as_posix()}")
+
+    def _final_published(self, task: _RenderTaskArgs, ok: bool) -> None:
+        # a draft is only a stand-in, it does not remain as the output of a failed final render
+        for target in [task, *self.duplicates.get(task.filename.absolute(), [])]:
+            for ext in task.file_types:
+                output = target.filename.with_suffix(ext).absolute()
+                self._final_outputs.add(output)
+                if not ok and output in self._draft_outputs and \
+                        _output_identity(output) == self._draft_outputs[output]:
+                    output.unlink(missing_ok=True)
+                    logging.error(f"Removed the draft {output.as_posix()}, its final render failed")
+
+    def is_draft(self, filename: Path) -> bool:
+        return filename in self._drafts
+
+    def draft_finished(self, filename: Path, elapsed: float, metrics: RenderMetrics | None = None) -> None:
+        task = self._drafts[filename]
+        _draft_scad_filename(task).unlink(missing_ok=True)
+        if elapsed > 0.:
+            self._publish_draft(filename, task)
+        if self.metrics is not None and metrics is not None:
+            metrics.cache = "draft"
+            self.metrics.add(metrics)
+
+    def close(self) -> None:
+        if self.timings is not None:
+            self.timings.close()
+
+
+def _render_tasks_args(openscad_bin: str | None, render_tasks: Iterable[RenderTask], file_types: List[str] | None,
+                       include_filter_regex: re.Pattern[str] | None, remove_duplicates: bool,
+                       verbose: bool) -> List[_RenderTaskArgs]:
     render_tasks_list = list(render_tasks)
     if remove_duplicates:
         unique_scads_idx = {filename: idx for filename, idx in
-                            zip((r.filename for r in render_tasks), range(len(render_tasks_list)))}
+                            zip((r.filename for r in render_tasks_list), range(len(render_tasks_list)))}
         render_tasks_list = [render_tasks_list[idx] for idx in unique_scads_idx.values()]
 
     file_types = [".3mf", ".png"] if file_types is None else file_types
@@ -138,12 +1198,174 @@ def save_to_file(openscad_bin: str | None, render_tasks: Iterable[RenderTask], f
                         verbose=verbose) for t in render_tasks_list]
     if include_filter_regex is not None:
         render_tasks_args = [t for t in render_tasks_args if include_filter_regex.search(t.filename.as_posix())]
+    return render_tasks_args
 
-    logging.info(f"Will generate {", ".join(task.filename.as_posix() for task in render_tasks_args)}", )
 
-    with Pool(max(multiprocessing.cpu_count() - 2, 1)) as pool:
-        for filename, elapsed in pool.map(_render_to_file, render_tasks_args):
-            logging.info(f"Saved in {elapsed:.2f}s {filename.absolute().as_posix()}")
+def iter_save_to_file(openscad_bin: str | None, render_tasks: Iterable[RenderTask], file_types: List[str] | None = None,
+                      include_filter_regex: re.Pattern[str] | None = None, remove_duplicates=True,
+                      verbose: bool = False, progress: bool = False, timings_filename: Path | None = None,
+                      incremental: bool = False, executor: RenderExecutor | None = None,
+                      metrics: RenderMetricsCollector | None = None, limits: RenderLimits | None = None,
+                      draft: DraftQuality | None = None) -> Generator[Tuple[Path, float], None, None]:
+    render_tasks_args = _render_tasks_args(openscad_bin, render_tasks, file_types, include_filter_regex,
+                                           remove_duplicates, verbose)
+    yield from _iter_render(render_tasks_args, verbose, progress, timings_filename, incremental, executor, metrics,
+                            remove_duplicates, limits, draft)
+
+
+def _iter_render(render_tasks_args: List[_RenderTaskArgs], verbose: bool, progress: bool,
+                 timings_filename: Path | None, incremental: bool, executor: RenderExecutor | None = None,
+                 metrics: RenderMetricsCollector | None = None, remove_duplicates: bool = False,
+                 limits: RenderLimits | None = None,
+                 draft: DraftQuality | None = None) -> Generator[Tuple[Path, float], None, None]:
+    if verbose:
+        from multiprocessing.dummy import Pool
+    else:
+        from multiprocessing import Pool
+
+    if len(render_tasks_args) == 0:
+        return
+
+    batch = _RenderBatch(render_tasks_args, progress, timings_filename, incremental, serialize=executor is not None,
+                         metrics=metrics, remove_duplicates=remove_duplicates)
+    try:
+        for task in batch.up_to_date:
+            yield batch.skipped(task)
+        if len(batch.pending) == 0:
+            return
+        work = [*batch.drafts(draft), *batch.pending] if draft is not None else batch.pending
+        with contextlib.ExitStack() as stack:
+            if executor is not None:
+                results = executor(work)
+            elif limits is None:
+                pool = stack.enter_context(Pool(max(multiprocessing.cpu_count() - 2, 1)))
+                results = pool.imap_unordered(_render_to_file, work)
+            else:
+                workers = limits.workers
+                if workers is None:
+                    workers = max(len(_cpu_sets(limits.openscad_threads)), 1) if limits.openscad_threads is not None \
+                        else max(multiprocessing.cpu_count() - 2, 1)
+                pool = stack.enter_context(Pool(workers))
+                results = _iter_admitted(pool, work, batch.predicted_rss(work, limits.default_peak_rss_bytes), limits,
+                                         workers)
+            for result in results:
+                if batch.is_draft(result[0]):
+                    batch.draft_finished(*result)
+                else:
+                    yield from batch.finished(*result)
+    finally:
+        batch.close()
+
+
+def save_to_file(openscad_bin: str | None, render_tasks: Iterable[RenderTask], file_types: List[str] | None = None,
+                 include_filter_regex: re.Pattern[str] | None = None, remove_duplicates=True,
+                 verbose: bool = False, progress: bool = False,
+                 callback: Callable[[Path, float], None] | None = None, timings_filename: Path | None = None,
+                 incremental: bool = False, executor: RenderExecutor | None = None,
+                 metrics: RenderMetricsCollector | None = None, limits: RenderLimits | None = None,
+                 draft: DraftQuality | None = None) -> List[Tuple[Path, float]]:
+    results: List[Tuple[Path, float]] = list()
+    for filename, elapsed in iter_save_to_file(openscad_bin, render_tasks, file_types, include_filter_regex,
+                                               remove_duplicates, verbose, progress, timings_filename, incremental,
+                                               executor, metrics, limits, draft):
+        if callback is not None:
+            callback(filename, elapsed)
+        results.append((filename, elapsed))
+    return results
+
+
+async def iter_save_to_file_asyncio(openscad_bin: str | None, render_tasks: Iterable[RenderTask],
+                                    file_types: List[str] | None = None,
+                                    include_filter_regex: re.Pattern[str] | None = None, remove_duplicates=True,
+                                    verbose: bool = False, progress: bool = False,
+                                    timings_filename: Path | None = None, incremental: bool = False,
+                                    max_concurrency: int | None = None, timeout: float | None = None,
+                                    metrics: RenderMetricsCollector | None = None
+                                    ) -> AsyncGenerator[Tuple[Path, float], None]:
+    import asyncio
+    render_tasks_args = _render_tasks_args(openscad_bin, render_tasks, file_types, include_filter_regex,
+                                           remove_duplicates, verbose)
+    if len(render_tasks_args) == 0:
+        return
+
+    batch = _RenderBatch(render_tasks_args, progress, timings_filename, incremental, serialize=True, metrics=metrics,
+                         remove_duplicates=remove_duplicates)
+    limit = asyncio.Semaphore(max_concurrency if max_concurrency is not None else max(multiprocessing.cpu_count() - 2, 1))
+    pending = [asyncio.create_task(_render_to_file_async(task, limit, timeout)) for task in batch.pending]
+    try:
+        for task in batch.up_to_date:
+            yield batch.skipped(task)
+        for next_done in asyncio.as_completed(pending):
+            filename, elapsed, task_metrics = await next_done
+            for result in batch.finished(filename, elapsed, task_metrics):
+                yield result
+    finally:
+        for pending_task in pending:
+            pending_task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        batch.close()
+
+
+def save_to_file_asyncio(openscad_bin: str | None, render_tasks: Iterable[RenderTask],
+                         file_types: List[str] | None = None,
+                         include_filter_regex: re.Pattern[str] | None = None, remove_duplicates=True,
+                         verbose: bool = False, progress: bool = False,
+                         callback: Callable[[Path, float], None] | None = None,
+                         timings_filename: Path | None = None, incremental: bool = False,
+                         max_concurrency: int | None = None, timeout: float | None = None,
+                         metrics: RenderMetricsCollector | None = None) -> List[Tuple[Path, float]]:
+    import asyncio
+
+    async def collect() -> List[Tuple[Path, float]]:
+        results: List[Tuple[Path, float]] = list()
+        async for filename, elapsed in iter_save_to_file_asyncio(openscad_bin, render_tasks, file_types,
+                                                                 include_filter_regex, remove_duplicates, verbose,
+                                                                 progress, timings_filename, incremental,
+                                                                 max_concurrency, timeout, metrics):
+            if callback is not None:
+                callback(filename, elapsed)
+            results.append((filename, elapsed))
+        return results
+
+    return asyncio.run(collect())
+
+
+@dataclass
+class PreviewSettings:
+    colorscheme: str = "BeforeDawn"
+    camera: str | None = None
+    imgsize: Tuple[int, int] | None = None
+    projection: str | None = None
+    view_all: bool = True
+
+    def render_args(self) -> List[str]:
+        args = ["--colorscheme", self.colorscheme]
+        if self.camera is not None:
+            args.append(f"--camera={self.camera}")
+        if self.imgsize is not None:
+            args.append(f"--imgsize={self.imgsize[0]},{self.imgsize[1]}")
+        if self.projection is not None:
+            args.append(f"--projection={self.projection}")
+        if self.view_all:
+            args.extend(["--viewall", "--autocenter"])
+        return args
+
+
+def save_previews(openscad_bin: str, meshes: Iterable[Path], settings: PreviewSettings | None = None,
+                  verbose: bool = False, progress: bool = False,
+                  incremental: bool = True) -> List[Tuple[Path, float]]:
+    from solid2 import import_stl
+    settings = PreviewSettings() if settings is None else settings
+    meshes = [Path(mesh) for mesh in meshes]
+    render_tasks_args: List[_RenderTaskArgs] = list()
+    for mesh, import_filename in zip(meshes, _fix_paths((m.absolute() for m in meshes),
+                                                        convert=openscad_bin.startswith("wsl"))):
+        scad_object = import_stl(import_filename)
+        render_tasks_args.append(
+            _RenderTaskArgs(scad_object, mesh.with_suffix(""), [".png"], openscad_bin=openscad_bin, verbose=verbose,
+                            scad_text=scad_object._render(), scad_filename=Path(mesh.as_posix() + ".preview.scad"),
+                            render_args=settings.render_args(), dependencies=[mesh.absolute()]))
+    return list(_iter_render(render_tasks_args, verbose, progress, None, incremental))
 
 
 def solid2_utils_cli(prog: str, description: str, default_output_path: Path):
@@ -151,9 +1373,13 @@ def solid2_utils_cli(prog: str, description: str, default_output_path: Path):
     parser.add_argument('--skip_rendering', action='store_true')
     parser.add_argument('--preview', action='store_true')
     parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--progress', action='store_true')
+    parser.add_argument('--incremental', action='store_true')
     parser.add_argument('--openscad_bin', type=str)
     parser.add_argument('--include_filter_regex', type=str)
     parser.add_argument('--build_dir', type=str)
+    parser.add_argument('--watch', action='store_true')
+    parser.add_argument('--progressive', action='store_true')
 
     args, unknown_args = parser.parse_known_args()
 
@@ -165,16 +1391,7 @@ def solid2_utils_cli(prog: str, description: str, default_output_path: Path):
         logging.info(f'Output dir "{output_path}" did not exist, trying to create it now')
         os.makedirs(output_path)
 
-    openscad_bin_candidates = [args.openscad_bin, shutil.which("openscad-nightly"), shutil.which("openscad"), ]
-    is_wsl = shutil.which("wsl")
-    if is_wsl is not None and len(is_wsl) > 0:
-        for c in ("openscad-nightly", "openscad"):
-            f = subprocess.run(["wsl", "bash", "-l", "-c", f"which {c}"], capture_output=True,
-                               check=False).stdout.decode().strip()
-            if len(f) > 0:
-                openscad_bin_candidates.append(f"wsl {f}")
-
-    openscad_bin: str | None = next((p for p in openscad_bin_candidates if p is not None), None)
+    openscad_bin: str | None = find_openscad(args.openscad_bin)
 
     if openscad_bin is None and not args.skip_rendering:
         logging.warn("Didn't found openscad in PATH environment variable, skipping rendering 3mf/stl/png!")
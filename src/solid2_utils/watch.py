@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import asyncio
+import importlib
+import inspect
+import logging
+import multiprocessing
+import re
+import runpy
+import sys
+import time
+from pathlib import Path
+from types import ModuleType
+from typing import Callable, Dict, Iterable, List, Set, Tuple
+
+from solid2_utils.render import (RenderMetrics, RenderTask, _RenderTaskArgs, _is_up_to_date, _render_stamp,
+                                 _render_tasks_args, _render_to_file_async, _write_stamps)
+
+BuildTasks = Callable[[], Iterable[RenderTask]]
+
+
+def _module_file(module: ModuleType) -> Path | None:
+    filename = getattr(module, "__file__", None)
+    if filename is None or not filename.endswith(".py"):
+        return None
+    return Path(filename).resolve()
+
+
+def _stat(filename: Path) -> Tuple[int, int]:
+    try:
+        stat = filename.stat()
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return -1, -1
+
+
+def _references(module: ModuleType, names: Set[str]) -> bool:
+    for value in vars(module).values():
+        if isinstance(value, ModuleType):
+            if value.__name__ in names:
+                return True
+        elif getattr(value, "__module__", None) in names:
+            return True
+    return False
+
+
+class _DesignWatcher:
+    def __init__(self, build_tasks: BuildTasks, roots: List[Path]):
+        self.build_tasks = build_tasks
+        self.roots = roots
+        self._build_file = Path(inspect.getfile(build_tasks)).resolve()
+        self._build_name = build_tasks.__qualname__
+        self._files: Dict[Path, Tuple[int, int]] = dict()
+        self._scan()
+
+    def _is_design_file(self, filename: Path) -> bool:
+        return "site-packages" not in filename.parts and any(filename.is_relative_to(root) for root in self.roots)
+
+    def _modules(self) -> Dict[str, Path]:
+        modules: Dict[str, Path] = dict()
+        main = sys.modules.get("__main__")
+        for name, module in list(sys.modules.items()):
+            filename = _module_file(module)
+            # multiprocessing aliases the script as __mp_main__
+            if module is not main and filename is not None and self._is_design_file(filename):
+                modules[name] = filename
+        return modules
+
+    def _scan(self) -> None:
+        files = [self._build_file, *self._modules().values()]
+        self._files = {filename: _stat(filename) for filename in files}
+
+    def changed(self) -> List[Path]:
+        return [filename for filename, stat in self._files.items() if _stat(filename) != stat]
+
+    def reload(self, changed: List[Path]) -> None:
+        modules = self._modules()
+        stale = {name for name, filename in modules.items() if filename in changed}
+        # modules holding on to objects of a reloaded module must be reloaded as well, or they keep the old ones
+        while True:
+            dependents = {name for name in modules if name not in stale and _references(sys.modules[name], stale)}
+            if len(dependents) == 0:
+                break
+            stale |= dependents
+        # sys.modules is in import order, importers before the modules they import
+        for name in reversed(list(sys.modules)):
+            if name in stale:
+                logging.info(f"Reloading {name}")
+                importlib.reload(sys.modules[name])
+        module = sys.modules.get(getattr(self.build_tasks, "__module__", ""))
+        if module is not None and module.__name__ in stale:
+            self.build_tasks = getattr(module, self._build_name)
+        elif (module is None or module.__name__ == "__main__") and (self._build_file in changed or len(stale) > 0):
+            # the script itself can not be reloaded, so its top level is run again without the __main__ guard
+            namespace = runpy.run_path(self._build_file.as_posix(), run_name="__solid2_utils_watch__")
+            self.build_tasks = namespace[self._build_name]
+
+    def generate(self) -> List[RenderTask] | None:
+        changed = self.changed()
+        try:
+            if len(changed) > 0:
+                self.reload(changed)
+            return list(self.build_tasks())
+        except Exception as ex:
+            logging.exception(f"Failed to generate the render tasks: {ex}")
+            return None
+        finally:
+            self._scan()
+
+
+async def _render_after(previous: asyncio.Task | None, task: _RenderTaskArgs, limit: asyncio.Semaphore,
+                        timeout: float | None) -> Tuple[Path, float, RenderMetrics]:
+    # a cancelled render still kills OpenSCAD and cleans up, it uses the same scad file and outputs as its successor
+    if previous is not None:
+        try:
+            await asyncio.wait([previous])
+        except asyncio.CancelledError:
+            await asyncio.wait([previous])
+            raise
+    return await _render_to_file_async(task, limit, timeout)
+
+
+async def _watch(watcher: _DesignWatcher, openscad_bin: str | None, file_types: List[str] | None,
+                 include_filter_regex: re.Pattern[str] | None, verbose: bool, interval: float,
+                 max_concurrency: int | None, timeout: float | None, callback: Callable[[Path, float], None] | None,
+                 generations: int | None) -> None:
+    limit = asyncio.Semaphore(max_concurrency if max_concurrency is not None else max(multiprocessing.cpu_count() - 2, 1))
+    stamps: Dict[Path, str] = dict()
+    running: Dict[Path, Tuple[asyncio.Task, _RenderTaskArgs]] = dict()
+    generation = 0
+
+    def reap() -> None:
+        for filename, (render, task) in list(running.items()):
+            if not render.done():
+                continue
+            del running[filename]
+            if render.cancelled():
+                continue
+            if render.exception() is not None:
+                logging.error(f"Failed to render {filename.as_posix()}: {render.exception()}")
+                continue
+            _, elapsed, _ = render.result()
+            logging.info(f"Saved in {elapsed:.2f}s {filename.as_posix()}")
+            if elapsed > 0.:
+                _write_stamps(task)
+            if callback is not None:
+                callback(filename, elapsed)
+
+    try:
+        while generations is None or generation < generations:
+            render_tasks = watcher.generate()
+            if render_tasks is not None:
+                generation += 1
+                start = time.time()
+                render_tasks_args = _render_tasks_args(openscad_bin, render_tasks, file_types, include_filter_regex,
+                                                       True, verbose)
+                for task in render_tasks_args:
+                    filename = task.filename.absolute()
+                    task.scad_text = task.scad_object.as_scad() + "\n"
+                    task.stamp = _render_stamp(task)
+                    if stamps.get(filename) == task.stamp:
+                        continue
+                    stamps[filename] = task.stamp
+                    previous = None
+                    if filename in running:
+                        logging.info(f"Cancelling the outdated render of {filename.as_posix()}")
+                        previous = running.pop(filename)[0]
+                        previous.cancel()
+                    if _is_up_to_date(task):
+                        continue
+                    running[filename] = (asyncio.create_task(_render_after(previous, task, limit, timeout)), task)
+                logging.info(f"Generation {generation} took {time.time() - start:.2f}s, "
+                             f"{len(running)} renders in flight")
+            while len(watcher.changed()) == 0:
+                await asyncio.sleep(interval)
+                reap()
+                if generations is not None and generation >= generations and len(running) == 0:
+                    return
+    finally:
+        for render, _ in running.values():
+            render.cancel()
+        if len(running) > 0:
+            await asyncio.gather(*(render for render, _ in running.values()), return_exceptions=True)
+
+
+def watch(build_tasks: BuildTasks, openscad_bin: str | None, file_types: List[str] | None = None,
+          include_filter_regex: re.Pattern[str] | None = None, roots: Iterable[Path] | None = None,
+          verbose: bool = False, interval: float = .5, max_concurrency: int | None = None,
+          timeout: float | None = None, callback: Callable[[Path, float], None] | None = None,
+          generations: int | None = None) -> None:
+    build_file = Path(inspect.getfile(build_tasks)).resolve()
+    roots = [Path(root).resolve() for root in roots] if roots is not None else [build_file.parent]
+    logging.info(f"Watching {", ".join(root.as_posix() for root in roots)} for changes")
+    try:
+        asyncio.run(_watch(_DesignWatcher(build_tasks, roots), openscad_bin, file_types, include_filter_regex,
+                           verbose, interval, max_concurrency, timeout, callback, generations))
+    except KeyboardInterrupt:
+        pass
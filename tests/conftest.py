@@ -0,0 +1,36 @@
+from pathlib import Path
+from typing import Callable, List
+
+import pytest
+
+
+def write_fake_openscad(directory: Path, sleep: float = 0., output: str = "echo solid", runs: Path | None = None,
+                        library_dirs: List[Path] | None = None, name: str = "openscad") -> str:
+    # output is a shell command writing the mesh to stdout, it sees $quality (draft when $fa is overridden) and the
+    # name of the scad file as $scad, only final renders sleep and every render appends its quality to runs
+    script = directory.joinpath(name)
+    lines = ["#!/bin/sh"]
+    if library_dirs is not None:
+        paths = "".join(f"  {d.as_posix()}\\n" for d in library_dirs)
+        lines.append(f"if [ \"$1\" = \"--info\" ]; then printf 'OpenSCAD library path:\\n{paths}\\n'; exit; fi")
+    lines += ["quality=final",
+              "for scad in \"$@\"; do case \"$scad\" in '$fa='*) quality=draft;; esac; done"]
+    if runs is not None:
+        lines.append(f"echo $quality >> {runs.as_posix()}")
+    if sleep > 0.:
+        lines.append(f"[ $quality = final ] && sleep {sleep}")
+    lines += ["while [ $# -gt 0 ]; do",
+              f"  if [ \"$1\" = \"-o\" ]; then shift; {output} > \"$1\"; fi",
+              "  shift",
+              "done",
+              ""]
+    script.write_text("\n".join(lines))
+    script.chmod(0o755)
+    return script.as_posix()
+
+
+@pytest.fixture
+def fake_openscad(tmp_path: Path) -> Callable[..., str]:
+    def make(**kwargs) -> str:
+        return write_fake_openscad(tmp_path, **kwargs)
+    return make
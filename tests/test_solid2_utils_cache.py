@@ -0,0 +1,223 @@
+import threading
+import time
+from pathlib import Path
+
+from solid2 import circle, color, cube, hull, scad_inline, sphere, square, union
+
+from solid2_utils.cache_backend import BlobServer, FileLock, HttpBackend
+from solid2_utils.cache import ArtifactStore, CacheEntry, CacheIndex, cache_subtrees, cache_to_stl_advanced
+from solid2_utils.fingerprint import fingerprint, node_digest
+from solid2_utils.render import RenderMetricsCollector, _render_to_file
+
+_STL_OUTPUT = ("printf 'solid t\\n facet normal 0 0 1\\n  outer loop\\n   vertex 0 0 0\\n   vertex 1 0 0\\n"
+               "   vertex 0 1 0\\n  endloop\\n endfacet\\nendsolid t\\n'")
+
+
+def _write_artifact(build_dir: Path, key: str, size: int) -> Path:
+    filename = build_dir.joinpath(key).with_suffix(".stl")
+    filename.write_bytes(b"x" * size)
+    return filename
+
+
+def test_cache_index_lookup(tmp_path: Path):
+    with CacheIndex(tmp_path) as index:
+        index.add([CacheEntry("a", _write_artifact(tmp_path, "a", 10), 10, 1.5, 0.)])
+        found = index.lookup(["a", "b"])
+        assert list(found.keys()) == ["a"]
+        assert found["a"].path == tmp_path.joinpath("a.stl")
+        assert found["a"].render_time == 1.5
+        assert found["a"].last_access > 0.
+
+    with CacheIndex(tmp_path) as index:
+        assert index.total_size() == 10
+
+
+def test_cache_index_evict_lru(tmp_path: Path):
+    now = time.time()
+    with CacheIndex(tmp_path) as index:
+        index.add(CacheEntry(key, _write_artifact(tmp_path, key, 10), 10, 0., now + n) for n, key in
+                  enumerate(("old", "keep", "new")))
+        evicted = index.evict(15, keep=["keep"])
+        assert [e.key for e in evicted] == ["old", "new"]
+        assert not tmp_path.joinpath("old.stl").exists()
+        assert tmp_path.joinpath("keep.stl").exists()
+        assert index.total_size() == 10
+
+
+def test_cache_index_evict_removes_locks(tmp_path: Path):
+    locks = {key: FileLock(tmp_path.joinpath("locks", key + ".lock")) for key in ("old", "busy", "keep")}
+    for lock in locks.values():
+        lock.acquire()
+        lock.release()
+    locks["busy"].acquire()
+    with CacheIndex(tmp_path) as index:
+        index.add(CacheEntry(key, _write_artifact(tmp_path, key, 10), 10, 0., n) for n, key in enumerate(locks))
+        index.evict(10, keep=["keep"])
+    assert sorted(f.stem for f in tmp_path.joinpath("locks").iterdir()) == ["busy", "keep"]
+
+    waiter = FileLock(locks["busy"].filename)
+    acquired = threading.Thread(target=waiter.acquire)
+    acquired.start()
+    time.sleep(.1)
+    locks["busy"].filename.unlink()
+    locks["busy"].release()
+    acquired.join()
+    assert not FileLock(locks["busy"].filename).acquire(blocking=False)
+    waiter.release()
+
+
+def test_artifact_store_materialize_missing_blob(tmp_path: Path):
+    store = ArtifactStore(tmp_path)
+    store.blob_path("ab" * 32).parent.mkdir(parents=True)
+
+    assert not store.materialize("ab" * 32, tmp_path.joinpath("part.stl"))
+    assert not tmp_path.joinpath("part.stl").exists()
+    assert list(store.root.rglob("*")) == [store.blob_path("ab" * 32).parent]
+
+
+def test_cache_to_stl_advanced_hit(tmp_path: Path):
+    c = cube(1)
+    key = "part_" + fingerprint(c)
+    _write_artifact(tmp_path, key, 10)
+
+    metrics = RenderMetricsCollector()
+    result = cache_to_stl_advanced([(c, Path("part"))], build_dir=tmp_path, openscad_bin="openscad", metrics=metrics)
+    assert list(result.keys()) == ["part"]
+    assert [(m.cache, m.output_sizes) for m in metrics.metrics] == [("hit", {".stl": 10})]
+
+    with CacheIndex(tmp_path) as index:
+        assert index.lookup([key])[key].size == 10
+
+
+def _precache(build_dir: Path, obj, name: str) -> None:
+    key = f"{name}_{fingerprint(obj)}"
+    _write_artifact(build_dir, key, 10)
+
+
+def test_cache_subtrees(tmp_path: Path):
+    shared = hull()(cube(1), sphere(1))
+    assembly = union()(shared.translate(5, 0, 0), shared.translate(-5, 0, 0), cube(2))
+    name = "hull_" + node_digest(shared).hex()[:8]
+    _precache(tmp_path, shared, name)
+
+    result = cache_subtrees(assembly, build_dir=tmp_path, openscad_bin="openscad")
+
+    scad = result.as_scad()
+    assert "hull()" not in scad
+    assert scad.count("import(") == 2
+    assert "hull()" in assembly.as_scad()
+
+
+def test_cache_subtrees_nothing_to_cache(tmp_path: Path):
+    assembly = union()(cube(1).translate(5, 0, 0), sphere(2))
+    assert cache_subtrees(assembly, build_dir=tmp_path, openscad_bin="openscad") is assembly
+
+
+def test_cache_subtrees_skips_color_and_2d(tmp_path: Path):
+    flat = hull()(square(1), circle(1))
+    flat_assembly = union()(flat, flat.translate(5, 0, 0))
+    assert cache_subtrees(flat_assembly, build_dir=tmp_path, openscad_bin="openscad") is flat_assembly
+
+    shared = union()(cube(1), sphere(1))
+    _precache(tmp_path, shared, "union_" + node_digest(shared).hex()[:8])
+    assembly = union()(color("red")(shared), color("red")(shared).translate(5, 0, 0), flat, flat)
+    scad = cache_subtrees(assembly, build_dir=tmp_path, openscad_bin="false", executor=_serial_executor).as_scad()
+    assert scad.count("color(") == 2
+    assert scad.count("import(") == 2
+    assert scad.count("hull()") == 2
+
+
+def test_cache_subtrees_keeps_special_variables(tmp_path: Path, fake_openscad):
+    shared = hull()(cube(1), sphere(1))
+    assembly = union()(scad_inline("$fn=8;\n"), shared, shared.translate(5, 0, 0))
+    scad = cache_subtrees(assembly, build_dir=tmp_path, openscad_bin=fake_openscad(output=_STL_OUTPUT),
+                          executor=_serial_executor).as_scad()
+    assert scad.count("import(") == 2
+    assert "$fn=8;" in next(tmp_path.glob("hull_*_last.scad")).read_text()
+
+
+def test_cache_subtrees_records_failures(tmp_path: Path, fake_openscad):
+    shared = hull()(cube(1), sphere(1))
+    assembly = union()(shared, shared.translate(5, 0, 0))
+    metrics = RenderMetricsCollector()
+    cache_subtrees(assembly, build_dir=tmp_path, openscad_bin="false", executor=_serial_executor, metrics=metrics)
+    assert [m.cache for m in metrics.metrics] == ["miss"]
+
+    metrics = RenderMetricsCollector()
+    result = cache_subtrees(assembly, build_dir=tmp_path, openscad_bin="false", executor=_serial_executor,
+                            metrics=metrics)
+    assert result is assembly
+    assert metrics.metrics == []
+
+    metrics = RenderMetricsCollector()
+    cache_subtrees(assembly, build_dir=tmp_path, openscad_bin="false", executor=_serial_executor, metrics=metrics,
+                   failure_ttl=0.)
+    assert [m.cache for m in metrics.metrics] == ["miss"]
+
+    scad = cache_subtrees(assembly, build_dir=tmp_path, openscad_bin=fake_openscad(output=_STL_OUTPUT),
+                          executor=_serial_executor).as_scad()
+    assert scad.count("import(") == 2
+
+
+def test_cache_to_stl_advanced_artifact_store(tmp_path: Path, fake_openscad):
+    build_dir = tmp_path.joinpath("build")
+    parts = [(cube(1), Path("a")), (cube(2), Path("b"))]
+    result = cache_to_stl_advanced(parts, build_dir=build_dir,
+                                   openscad_bin=fake_openscad(output=_STL_OUTPUT))
+    assert list(result.keys()) == ["a", "b"]
+
+    blobs = list(build_dir.joinpath("objects").rglob("*.stl"))
+    assert len(blobs) == 1
+    assert blobs[0].stat().st_size == 84 + 50
+    stl_a = build_dir.joinpath(f"a_{fingerprint(cube(1))}.stl")
+    assert stl_a.read_bytes() == blobs[0].read_bytes()
+
+    with CacheIndex(build_dir) as index:
+        entries = index.lookup([stl_a.with_suffix("").name], touch=False)
+        assert list(entries.values())[0].blob == blobs[0].stem
+        assert index.compress_cold(time.time() + 1.) == [blobs[0].stem]
+    assert not stl_a.exists()
+    assert not blobs[0].exists()
+
+    cache_to_stl_advanced(parts[:1], build_dir=build_dir, openscad_bin="false")
+    assert stl_a.stat().st_size == 84 + 50
+    assert blobs[0].exists()
+
+
+def _serial_executor(tasks):
+    # no process pool, forking from the threads of these tests is not safe
+    return map(_render_to_file, tasks)
+
+
+def test_cache_to_stl_advanced_concurrent_requesters_render_once(tmp_path: Path, fake_openscad):
+    build_dir = tmp_path.joinpath("build")
+    openscad_bin = fake_openscad(sleep=.5, output=_STL_OUTPUT, runs=tmp_path.joinpath("runs"))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        cache_to_stl_advanced([(cube(3), Path("part"))], build_dir=build_dir, openscad_bin=openscad_bin,
+                              executor=_serial_executor)))
+        for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 2
+    assert tmp_path.joinpath("runs").read_text().split() == ["final"]
+    assert build_dir.joinpath(f"part_{fingerprint(cube(3))}.stl").exists()
+    assert build_dir.joinpath("part_last.stl").exists()
+    assert list(build_dir.joinpath("staging").iterdir()) == []
+
+
+def test_cache_to_stl_advanced_http_backend(tmp_path: Path, fake_openscad):
+    with BlobServer(tmp_path.joinpath("shared")) as server:
+        backend = HttpBackend(server.url)
+        cache_to_stl_advanced([(cube(1), Path("a"))], build_dir=tmp_path.joinpath("ci1"),
+                              openscad_bin=fake_openscad(output=_STL_OUTPUT), executor=_serial_executor,
+                              backend=backend)
+        metrics = RenderMetricsCollector()
+        cache_to_stl_advanced([(cube(1), Path("a"))], build_dir=tmp_path.joinpath("ci2"), openscad_bin="false",
+                              metrics=metrics, backend=backend)
+
+    assert [m.cache for m in metrics.metrics] == ["shared"]
+    assert tmp_path.joinpath("ci2", f"a_{fingerprint(cube(1))}.stl").stat().st_size == 84 + 50
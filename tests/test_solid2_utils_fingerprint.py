@@ -0,0 +1,28 @@
+from solid2 import cube, scad_inline, sphere, translate, union
+
+from solid2_utils.fingerprint import fingerprint, node_digest
+
+
+def test_fingerprint_structural():
+    assert fingerprint(translate(1, 2, 3)(cube(1))) == fingerprint(translate(1, 2, 3)(cube(1)))
+    assert fingerprint(translate(1, 2, 3)(cube(1))) != fingerprint(translate(1, 2, 3)(cube(2)))
+    assert fingerprint(union()(cube(1), sphere(1))) != fingerprint(union()(sphere(1), cube(1)))
+    assert fingerprint(union()(cube(1))) != fingerprint(union()(cube(1)).debug())
+    assert fingerprint(union()(scad_inline("a = 1;\n"))) != fingerprint(union()(scad_inline("a = 2;\n")))
+    assert len(fingerprint(cube(1))) == 32
+
+
+def test_node_digest_memoized_shared_subtrees():
+    shared = union()(cube(1), sphere(2))
+    assembly = union()(shared.translate(1, 0, 0), shared.translate(2, 0, 0))
+    memo = dict()
+    node_digest(assembly, memo)
+    assert len(memo) == 6
+    assert memo[id(shared)] == node_digest(union()(cube(1), sphere(2)))
+
+
+def test_fingerprint_deep_tree():
+    obj = cube(1)
+    for n in range(5000):
+        obj = translate(n, 0, 0)(obj)
+    assert fingerprint(obj) != fingerprint(translate(-1, 0, 0)(obj))
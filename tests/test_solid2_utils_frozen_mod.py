@@ -0,0 +1,56 @@
+from solid2 import cube
+
+from solid2_utils import frozen_mod, mod
+from solid2_utils.frozen_mod import FrozenMod, freeze
+
+
+def _chain(factory):
+    return factory.tx(10.).rz(45.).t(1., 2., 3.).s([2., 1., 1.]).mx().debug().ty(-5.)
+
+
+def test_frozen_mod_matches_mod():
+    c = cube([10., 10., 10.])
+    assert _chain(frozen_mod.r(x=30.))(c).as_scad() == _chain(mod.r(x=30.))(c).as_scad()
+    assert _chain(frozen_mod.r(x=30.))(c, fuse=True).as_scad() == _chain(mod.r(x=30.))(c, fuse=True).as_scad()
+    assert freeze(_chain(mod.r(x=30.))).matrix() == _chain(frozen_mod.r(x=30.)).matrix()
+
+
+def test_frozen_mod_immutable_and_shared():
+    a = frozen_mod.tx(10.)
+    b = a.ty(5.)
+    ab = a + b
+    assert len(a) == 1 and len(b) == 2 and len(ab) == 3
+    assert list(a.actions()) == [frozen_mod.tx(10.)._action]
+    assert ab._left is a and ab._right is b and ab._action is None
+    assert a + FrozenMod() is a
+    assert a.clone() is a
+    assert len(a + mod.tx(1.).ty(2.)) == 3
+
+
+def test_frozen_mod_interned():
+    assert frozen_mod.tx(10.) is frozen_mod.tx(10.)
+    assert frozen_mod.tx(10) is not frozen_mod.tx(10.)
+    assert frozen_mod.mx() is frozen_mod.mx()
+    assert frozen_mod.tx(10)(cube(1)).as_scad() == mod.tx(10)(cube(1)).as_scad()
+    assert frozen_mod.tx(x=3) is frozen_mod.tx(x=3)
+    assert frozen_mod.tx(x=3)(cube(1)).as_scad() == mod.tx(x=3)(cube(1)).as_scad()
+    assert frozen_mod.m(x=1)(cube(1)).as_scad() == mod.m(x=1)(cube(1)).as_scad()
+    assert frozen_mod.m(z=1) is not frozen_mod.m(x=1)
+
+
+def test_frozen_mod_deep_chain():
+    pos = FrozenMod()
+    for n in range(5000):
+        pos = pos.tx(1.)
+    assert len(list(pos.actions())) == 5000
+    assert pos.matrix()[0][3] == 5000.
+
+
+def test_frozen_mod_mixes_with_mod():
+    c = cube(1.)
+    expected = mod.tx(1.).ty(2.).tz(3.)(c).as_scad()
+    assert (mod.tx(1.) + frozen_mod.ty(2.).tz(3.))(c).as_scad() == expected
+    assert (frozen_mod.tx(1.) + mod.ty(2.).tz(3.))(c).as_scad() == expected
+    mixed = mod.tx(1.)
+    mixed += frozen_mod.ty(2.).tz(3.)
+    assert mixed(c).as_scad() == expected
@@ -1,10 +1,12 @@
 import itertools
 from typing import Dict, List
 
+import pytest
+
 from solid2 import cube, translate
 from solid2.core.object_base import OpenSCADObject
 
-from solid2_utils.mod import t, Mod, tx
+from solid2_utils.mod import t, Mod, tx, s, ModP3, mod_p3, mod_p3_action
 
 
 def convert_to_scad(result: Dict[str, OpenSCADObject]) -> Dict[str, List[str]]:
@@ -112,3 +114,64 @@ def test_enable_disable():
     as_scad_reverse = convert_to_scad(result)
     for a, b in itertools.pairwise(as_scad_reverse.keys()):
         assert a == b, f"a is {','.join(as_scad_reverse[a])}; b is {','.join(as_scad_reverse[b])}"
+
+
+def _apply(matrix, p):
+    return tuple(sum(matrix[i][j] * v for j, v in enumerate((*p, 1.))) for i in range(3))
+
+
+def test_compile_fuses_chain():
+    pos = tx(10.).rz(90.).ty(5.).mx()
+    compiled = pos.compile()
+    assert len(compiled) == 1
+    assert _apply(compiled[0], (1., 2., 3.)) == (2., 16., 3.)
+
+    scad = pos(cube([1., 1., 1.]), fuse=True).as_scad()
+    assert scad.count("multmatrix") == 1
+    assert "translate" not in scad and "rotate" not in scad and "mirror" not in scad
+
+
+def test_compile_splits_at_debug_and_invalidates():
+    pos = tx(10.).debug().ty(5.)
+    assert len(pos.compile()) == 3
+    assert pos.compile() is pos.compile()
+
+    pos.tz(1.)
+    assert len(pos.compile()) == 3
+    assert _apply(pos.compile()[2], (0., 0., 0.)) == (0., 5., 1.)
+
+    pos += tx(1.)
+    assert _apply(pos.compile()[2], (0., 0., 0.)) == (1., 5., 1.)
+
+    scad = pos(cube([1., 1., 1.]), fuse=True).as_scad()
+    assert scad.count("multmatrix") == 2
+    assert "#" in scad
+
+
+def test_compile_scale_rotate_mirror():
+    pos = s(2., 3., 4.).r(x=90.).m(1, 1, 0)
+    x, y, z = _apply(pos.compile()[0], (1., 1., 1.))
+    assert (round(x, 9), round(y, 9), round(z, 9)) == (4., -2., 3.)
+    assert len(Mod()(cube(1), fuse=True).as_scad()) == len(cube(1).as_scad())
+
+
+def test_mod_p3_batched():
+    np = pytest.importorskip("numpy")
+    points = np.array([[1., 2., 3.], [-4., 5., 0.5]])
+    action = mod_p3_action(setz=7., addx=1., mul=(2., 1., 3.))
+
+    result = ModP3(action)(points)
+
+    assert result.tolist() == [list(mod_p3(tuple(p), setz=7., addx=1., mul=(2., 1., 3.))) for p in points.tolist()]
+    assert points[0].tolist() == [1., 2., 3.]
+
+
+def test_mod_p3_batched_mod_in_place():
+    np = pytest.importorskip("numpy")
+    points = np.array([[1., 2., 3.], [0., 0., 0.]])
+    mod_p3_batch = ModP3(tx(10.).rz(90.), t(0., 5., 0.).mx(), mod_p3_action(addz=1.))
+
+    result = mod_p3_batch(points, out=points)
+
+    assert result is points
+    assert points.tolist() == [[2., 16., 4.], [0., 15., 1.]]
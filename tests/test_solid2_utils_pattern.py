@@ -0,0 +1,38 @@
+import pytest
+from solid2 import cube, sphere, union
+
+from solid2_utils.fingerprint import fingerprint
+from solid2_utils.frozen_mod import tx
+from solid2_utils.mod import rz, t
+from solid2_utils.pattern import grid, instances, polar
+
+
+def test_instances_child_emitted_once():
+    child = union()(cube(1), sphere(2))
+    result = instances(child, [t(1., 2., 3.), rz(90.).tx(5.), tx(-1.)])
+
+    scad = result._render()
+    assert scad.count("sphere(") == 1
+    assert scad.startswith("for (solid2_utils_m = [[[1, 0, 0, 1], [0, 1, 0, 2], [0, 0, 1, 3]], "
+                           "[[0, -1, 0, 5], [1, 0, 0, 0], [0, 0, 1, 0]], [[1, 0, 0, -1], [0, 1, 0, 0], [0, 0, 1, 0]]]) "
+                           "multmatrix(solid2_utils_m) {")
+    assert fingerprint(result) != fingerprint(instances(child, [t(1., 2., 3.)]))
+
+
+def test_grid():
+    scad = grid(cube(1), (3, 2), (10., 5.), center=True)._render()
+    assert scad.startswith("for (solid2_utils_v = [[-10, -2.5, 0], [0, -2.5, 0], [10, -2.5, 0], [-10, 2.5, 0], "
+                           "[0, 2.5, 0], [10, 2.5, 0]]) translate(solid2_utils_v) {")
+    assert scad.count("cube(") == 1
+
+
+def test_polar():
+    result = polar(cube(1), 4, radius=10.)
+    assert [m[:3] for m in result.matrices][:2] == [
+        ((1., 0., 0., 10.), (0., 1., 0., 0.), (0., 0., 1., 0.)),
+        ((0., -1., 0., 0.), (1., 0., 0., 10.), (0., 0., 1., 0.))]
+    assert polar(cube(1), 3, radius=10., angle=180., rotate=False)._render().startswith(
+        "for (solid2_utils_v = [[10, 0, 0], [0, 10, 0], [-10, 0, 0]]) translate(solid2_utils_v) {")
+    assert instances(cube(1), []).matrices == []
+    with pytest.raises(ValueError):
+        polar(cube(1), 0)
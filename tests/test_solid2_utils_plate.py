@@ -0,0 +1,44 @@
+from pathlib import Path
+
+import pytest
+from solid2 import cube
+
+from solid2_utils.cache import CacheIndex
+from solid2_utils.fingerprint import fingerprint
+from solid2_utils.plate import pack_rectangles, plate_tasks
+from solid2_utils.render import RenderTask
+
+
+def _write_box_stl(filename: Path, size) -> None:
+    x, y, z = size
+    filename.write_text(f"solid t\n facet normal 0 0 1\n  outer loop\n   vertex -1 -1 -1\n   vertex {x - 1} 0 0\n"
+                        f"   vertex 0 {y - 1} {z - 1}\n  endloop\n endfacet\nendsolid t\n")
+
+
+def test_pack_rectangles():
+    placements = pack_rectangles([(40., 10.), (10., 30.), (50., 50.), (60., 60.)], (100., 100.), spacing=2.)
+
+    assert placements[3] == (0, 0., 0., False)
+    assert placements[2] == (1, 0., 0., False)
+    assert placements[1] == (0, 62., 0., True)
+    assert placements[0][0] == 0 and not placements[0][3]
+
+    with pytest.raises(ValueError):
+        pack_rectangles([(120., 10.)], (100., 100.))
+
+
+def test_plate_tasks(tmp_path: Path):
+    build_dir = tmp_path.joinpath("build")
+    build_dir.mkdir()
+    parts = [RenderTask(cube(n), Path(f"part{n}")) for n in (1, 2)]
+    for rt, size in zip(parts, ((30, 10, 5), (20, 20, 8))):
+        _write_box_stl(build_dir.joinpath(f"{rt.filename}_{fingerprint(rt.scad_object)}.stl"), size)
+
+    plates = plate_tasks(parts, build_dir, "false", tmp_path, bed=(100., 100.), spacing=5.)
+
+    assert [p.filename for p in plates] == [tmp_path.joinpath("plate0")]
+    assert parts[1].position == (1., 1., 1.)
+    assert parts[0].position == (26., 1., 1.)
+    assert plates[0].scad_object.as_scad().count("import(") == 2
+    with CacheIndex(build_dir) as index:
+        assert index._db.execute("SELECT COUNT(*) FROM bounds").fetchone()[0] == 2
@@ -0,0 +1,102 @@
+from pathlib import Path
+
+from solid2 import cube
+
+from solid2_utils import remote
+from solid2_utils.remote import RemoteRenderer, RenderWorker, start_local_workers
+from solid2_utils.render import RenderTask, save_to_file
+
+_ECHO_SCAD = 'echo "solid $(basename "$scad")"'
+
+
+def test_remote_render(tmp_path: Path, fake_openscad):
+    workers = start_local_workers(3, fake_openscad(output=_ECHO_SCAD), slots=2)
+    try:
+        tasks = [RenderTask(cube(n), tmp_path.joinpath(f"part{n}")) for n in range(1, 8)]
+        results = save_to_file("remote", tasks, file_types=[".stl", ".png"],
+                               executor=RemoteRenderer(w.url for w in workers))
+    finally:
+        for worker in workers:
+            worker.shutdown()
+
+    assert sorted(filename.name for filename, _ in results) == [f"part{n}" for n in range(1, 8)]
+    assert all(elapsed > 0. for _, elapsed in results)
+    assert tmp_path.joinpath("part3.stl").read_text() == "solid part3.scad\n"
+    assert tmp_path.joinpath("part3.png").exists()
+    assert tmp_path.joinpath("part3.scad").exists()
+
+
+class _DeadWorkerRenderer(RemoteRenderer):
+    def _slots(self, url: str) -> int:
+        return 1
+
+
+def test_remote_render_retries_on_dead_worker(tmp_path: Path, fake_openscad):
+    dead = RenderWorker(None)
+    dead_url = dead.url
+    dead.server.server_close()
+
+    with RenderWorker(fake_openscad(output=_ECHO_SCAD), slots=1) as alive:
+        tasks = [RenderTask(cube(n), tmp_path.joinpath(f"part{n}")) for n in range(1, 4)]
+        results = save_to_file("remote", tasks, file_types=[".stl"],
+                               executor=_DeadWorkerRenderer([dead_url, alive.url]))
+
+    assert all(elapsed > 0. for _, elapsed in results)
+    assert len(results) == 3
+
+
+def test_remote_render_without_workers(tmp_path: Path):
+    tasks = [RenderTask(cube(1), tmp_path.joinpath("part1"))]
+    dead = RenderWorker(None)
+    dead_url = dead.url
+    dead.server.server_close()
+
+    results = save_to_file("remote", tasks, file_types=[".stl"], executor=_DeadWorkerRenderer([dead_url], retries=1))
+
+    assert results == [(tmp_path.joinpath("part1").absolute(), 0.)]
+
+
+class _FlakyRenderer(RemoteRenderer):
+    def __init__(self, workers, failures: int, **kwargs):
+        super().__init__(workers, **kwargs)
+        self.failures = failures
+
+    def _render(self, url, task):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ValueError("bad X-Metrics")
+        return super()._render(url, task)
+
+
+def test_remote_render_retries_flaky_task_on_same_slot(tmp_path: Path, fake_openscad):
+    with RenderWorker(fake_openscad(output=_ECHO_SCAD), slots=1) as worker:
+        tasks = [RenderTask(cube(n), tmp_path.joinpath(f"part{n}")) for n in range(1, 3)]
+        results = save_to_file("remote", tasks, file_types=[".stl"], executor=_FlakyRenderer([worker.url], 2))
+
+    assert sorted(filename.name for filename, elapsed in results if elapsed > 0.) == ["part1", "part2"]
+
+
+def test_remote_render_reports_exhausted_retries(tmp_path: Path, fake_openscad):
+    with RenderWorker(fake_openscad(output=_ECHO_SCAD), slots=1) as worker:
+        tasks = [RenderTask(cube(1), tmp_path.joinpath("part1"))]
+        results = save_to_file("remote", tasks, file_types=[".stl"],
+                               executor=_FlakyRenderer([worker.url], 5, retries=1))
+
+    assert results == [(tmp_path.joinpath("part1").absolute(), 0.)]
+
+
+def test_remote_render_task_crash_keeps_worker(tmp_path: Path, fake_openscad, monkeypatch):
+    render_to_file = remote._render_to_file
+    crashes = [RuntimeError("worker bug")]
+
+    def crash_once(task):
+        if len(crashes) > 0:
+            raise crashes.pop()
+        return render_to_file(task)
+
+    monkeypatch.setattr(remote, "_render_to_file", crash_once)
+    with RenderWorker(fake_openscad(output=_ECHO_SCAD), slots=1) as worker:
+        tasks = [RenderTask(cube(n), tmp_path.joinpath(f"part{n}")) for n in range(1, 4)]
+        results = save_to_file("remote", tasks, file_types=[".stl"], executor=RemoteRenderer([worker.url], retries=0))
+
+    assert sorted(filename.name for filename, elapsed in results if elapsed > 0.) == ["part2", "part3"]
@@ -1,7 +1,437 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import zipfile
 from pathlib import Path
 
-from solid2_utils.render import RenderTask
-from solid2 import cube
+from solid2_utils import render
+from solid2_utils.render import (DRAFTS_DIRNAME, RENDER_TIMINGS_FILENAME, DraftQuality, PreviewSettings, RenderLimits, RenderMetricsCollector, RenderProgress,
+                                 RenderTask, RenderTimings, _render_tasks_args, _replace_stream, _schedule_longest_first, _wslpaths, find_openscad,
+                                 iter_save_to_file, save_previews, save_to_file, save_to_file_asyncio, set_model_name,
+                                 set_model_names)
+from solid2 import cube, scad_inline, union
 
 def test_render_task():
-    rt:RenderTask = RenderTask(scad_object=cube(1,1,1), position=(0,0,0), filename=Path("./out.stl"))
\ No newline at end of file
+    rt:RenderTask = RenderTask(scad_object=cube(1,1,1), position=(0,0,0), filename=Path("./out.stl"))
+
+
+def test_iter_save_to_file(tmp_path: Path):
+    tasks = [RenderTask(cube(n), tmp_path.joinpath(f"part{n}")) for n in range(1, 4)]
+
+    results = list(iter_save_to_file(None, tasks, verbose=True))
+
+    assert sorted(filename.name for filename, _ in results) == ["part1", "part2", "part3"]
+    assert all(tmp_path.joinpath(f"part{n}.scad").exists() for n in range(1, 4))
+
+
+def test_save_to_file_callback_and_progress(tmp_path: Path):
+    tasks = [RenderTask(cube(n), tmp_path.joinpath(f"part{n}")) for n in range(1, 3)]
+    seen = []
+
+    results = save_to_file(None, tasks, verbose=True, callback=lambda filename, elapsed: seen.append(filename))
+
+    assert sorted(seen) == sorted(filename for filename, _ in results)
+
+    stream = io.StringIO()
+    progress = RenderProgress(2, stream=stream)
+    progress(Path("part1"), 1.)
+    assert progress.eta is not None
+    assert stream.getvalue().startswith("[1/2]")
+
+
+def test_schedule_longest_first(tmp_path: Path):
+    tasks = _render_tasks_args(None, [RenderTask(cube(n), tmp_path.joinpath(f"part{n}")) for n in (1, 2, 3)],
+                               None, None, True, False)
+    with RenderTimings(tmp_path.joinpath(RENDER_TIMINGS_FILENAME)) as timings:
+        scheduled = _schedule_longest_first(tasks, timings)
+        timings.record(scheduled[0].fingerprint, len(scheduled[0].scad_text), 1.)
+        timings.record(scheduled[1].fingerprint, len(scheduled[1].scad_text), 10.)
+
+    with RenderTimings(tmp_path.joinpath(RENDER_TIMINGS_FILENAME)) as timings:
+        rescheduled = _schedule_longest_first(tasks, timings)
+
+    assert [t.filename for t in rescheduled] == [scheduled[1].filename, scheduled[2].filename, scheduled[0].filename]
+
+
+def test_save_to_file_asyncio(tmp_path: Path, fake_openscad):
+    tasks = [RenderTask(cube(n), tmp_path.joinpath(f"part{n}")) for n in range(1, 4)]
+
+    results = save_to_file_asyncio(fake_openscad(), tasks, file_types=[".stl"], max_concurrency=2)
+
+    assert sorted(filename.name for filename, _ in results) == ["part1", "part2", "part3"]
+    assert all(elapsed > 0. for _, elapsed in results)
+    assert all(tmp_path.joinpath(f"part{n}.stl").exists() for n in range(1, 4))
+
+
+def test_save_to_file_asyncio_timeout(tmp_path: Path, fake_openscad):
+    tasks = [RenderTask(cube(1), tmp_path.joinpath("part1"))]
+
+    results = save_to_file_asyncio(fake_openscad(sleep=5.), tasks, file_types=[".stl"], timeout=.2)
+
+    assert results == [(tmp_path.joinpath("part1").absolute(), 0.)]
+    assert not tmp_path.joinpath("part1.stl").exists()
+
+
+def test_save_to_file_asyncio_missing_openscad(tmp_path: Path):
+    tasks = [RenderTask(cube(n), tmp_path.joinpath(f"part{n}")) for n in range(1, 3)]
+
+    results = save_to_file_asyncio(tmp_path.joinpath("missing").as_posix(), tasks, file_types=[".stl"])
+
+    assert sorted(results) == [(tmp_path.joinpath(f"part{n}").absolute(), 0.) for n in range(1, 3)]
+
+
+def test_save_to_file_incremental(tmp_path: Path, fake_openscad):
+    library = tmp_path.joinpath("lib.scad")
+    library.write_text("module part() { cube(1); }\n")
+    openscad_bin = fake_openscad()
+    tasks = [RenderTask(union()(scad_inline(f"use <{library.as_posix()}>;\n"), cube(n)), tmp_path.joinpath(f"part{n}"))
+             for n in range(1, 3)]
+
+    first = save_to_file(openscad_bin, tasks, file_types=[".stl"], verbose=True, incremental=True)
+    assert all(elapsed > 0. for _, elapsed in first)
+    assert tmp_path.joinpath("part1.stl.stamp").exists()
+
+    second = save_to_file(openscad_bin, tasks, file_types=[".stl"], verbose=True, incremental=True)
+    assert all(elapsed == 0. for _, elapsed in second)
+
+    tasks[1] = RenderTask(cube(5), tmp_path.joinpath("part2"))
+    third = dict(save_to_file(openscad_bin, tasks, file_types=[".stl"], verbose=True, incremental=True))
+    assert third[tmp_path.joinpath("part1").absolute()] == 0.
+    assert third[tmp_path.joinpath("part2").absolute()] > 0.
+
+    library.write_text("module part() { cube(2); }\n")
+    fourth = dict(save_to_file(openscad_bin, tasks, file_types=[".stl"], verbose=True, incremental=True))
+    assert fourth[tmp_path.joinpath("part1").absolute()] > 0.
+    assert fourth[tmp_path.joinpath("part2").absolute()] == 0.
+
+
+def test_save_to_file_incremental_library_dirs(tmp_path: Path, monkeypatch, fake_openscad):
+    monkeypatch.setenv("XDG_CACHE_HOME", tmp_path.joinpath("cache").as_posix())
+    library_dir = tmp_path.joinpath("libraries")
+    library_dir.joinpath("lib").mkdir(parents=True)
+    library = library_dir.joinpath("lib", "std.scad")
+    library.write_text("module part() { cube(1); }\n")
+    openscad_bin = fake_openscad(library_dirs=[library_dir])
+    tasks = [RenderTask(union()(scad_inline("include <lib/std.scad>;\n"), cube(1)), tmp_path.joinpath("part"))]
+
+    assert save_to_file(openscad_bin, tasks, file_types=[".stl"], verbose=True, incremental=True)[0][1] > 0.
+    assert save_to_file(openscad_bin, tasks, file_types=[".stl"], verbose=True, incremental=True)[0][1] == 0.
+    library.write_text("module part() { cube(2); }\n")
+    assert save_to_file(openscad_bin, tasks, file_types=[".stl"], verbose=True, incremental=True)[0][1] > 0.
+
+
+def test_save_to_file_metrics(tmp_path: Path, fake_openscad):
+    openscad_bin = fake_openscad()
+    tasks = [RenderTask(cube(n), tmp_path.joinpath(f"part{n}")) for n in range(1, 3)]
+
+    metrics = RenderMetricsCollector()
+    save_to_file(openscad_bin, tasks, file_types=[".stl"], verbose=True, incremental=True, metrics=metrics)
+    assert len(metrics.metrics) == 2
+    assert all(m.ok and m.cache is None and m.openscad_wall_s > 0. and m.output_sizes[".stl"] == 6
+               for m in metrics.metrics)
+    assert all(m.hash_s > 0. and m.serialize_s > 0. and m.end >= m.start for m in metrics.metrics)
+
+    save_to_file(openscad_bin, tasks, file_types=[".stl"], verbose=True, incremental=True, metrics=metrics)
+    assert [m.cache for m in metrics.metrics[2:]] == ["up_to_date", "up_to_date"]
+
+    metrics.save(tmp_path.joinpath("metrics.json"), tmp_path.joinpath("trace.json"))
+    assert len(json.loads(tmp_path.joinpath("metrics.json").read_text())) == 4
+    events = json.loads(tmp_path.joinpath("trace.json").read_text())["traceEvents"]
+    assert sorted(e["name"] for e in events if e["ph"] == "X") == ["part1", "part1", "part2", "part2"]
+    assert {e["args"]["name"] for e in events if e["ph"] == "M"} == {"main", *(m.slot for m in metrics.metrics if m.slot)}
+
+
+def test_save_to_file_memory_admission(tmp_path: Path, fake_openscad):
+    tasks = [RenderTask(cube(n), tmp_path.joinpath(f"part{n}")) for n in range(1, 4)]
+    metrics = RenderMetricsCollector()
+    timings_filename = tmp_path.joinpath(RENDER_TIMINGS_FILENAME)
+    limits = RenderLimits(memory_bytes=1 << 20, default_peak_rss_bytes=1 << 20, openscad_threads=1, workers=3)
+
+    results = save_to_file(fake_openscad(sleep=.2), tasks, file_types=[".stl"], timings_filename=timings_filename,
+                           metrics=metrics, limits=limits)
+
+    assert all(elapsed > 0. for _, elapsed in results)
+    spans = sorted((m.start, m.end) for m in metrics.metrics)
+    assert all(end <= next_start for (_, end), (next_start, _) in zip(spans, spans[1:]))
+    with RenderTimings(timings_filename) as timings:
+        fingerprints = [fingerprint for fingerprint, _ in timings._db.execute("SELECT fingerprint, seconds FROM timings")]
+        assert len(timings.peak_rss(fingerprints)) == 3
+
+
+def test_save_to_file_timeout(tmp_path: Path, fake_openscad):
+    tasks = [RenderTask(cube(1), tmp_path.joinpath("part1"))]
+
+    results = save_to_file(fake_openscad(sleep=5.), tasks, file_types=[".stl"], limits=RenderLimits(timeout=.2))
+
+    assert results == [(tmp_path.joinpath("part1").absolute(), 0.)]
+
+
+def test_save_to_file_progressive(tmp_path: Path, fake_openscad):
+    openscad_bin = fake_openscad(sleep=.5, output="echo $quality", runs=tmp_path.joinpath("runs"))
+    tasks = [RenderTask(cube(1), tmp_path.joinpath("part1"))]
+    metrics = RenderMetricsCollector()
+    previews = []
+
+    def watch_preview():
+        while not tmp_path.joinpath("part1.stl").exists():
+            time.sleep(.01)
+        previews.append(tmp_path.joinpath("part1.stl").read_text())
+
+    watcher = threading.Thread(target=watch_preview)
+    watcher.start()
+    results = save_to_file(openscad_bin, tasks, file_types=[".stl"], verbose=True, metrics=metrics,
+                           draft=DraftQuality())
+    watcher.join()
+
+    assert previews == ["draft\n"]
+    assert tmp_path.joinpath("part1.stl").read_text() == "final\n"
+    assert [filename.name for filename, _ in results] == ["part1"]
+    assert [m.cache for m in metrics.metrics] == ["draft", None]
+    assert [f.read_text() for f in tmp_path.joinpath(DRAFTS_DIRNAME).rglob("part1.stl")] == ["draft\n"]
+
+    save_to_file(openscad_bin, tasks, file_types=[".stl"], draft=DraftQuality())
+    assert tmp_path.joinpath("runs").read_text().split() == ["draft", "final", "final"]
+
+
+def test_save_to_file_progressive_late_draft(tmp_path: Path, fake_openscad):
+    tasks = [RenderTask(cube(1), tmp_path.joinpath("part1")), RenderTask(cube(1), tmp_path.joinpath("part2"))]
+
+    def render_all_then_report(work):
+        # every render, final ones included, is done before the first draft result is consumed
+        return [render._render_to_file(task) for task in work]
+
+    save_to_file(fake_openscad(output="echo $quality"), tasks, file_types=[".stl"], draft=DraftQuality(),
+                 executor=render_all_then_report)
+
+    assert [tmp_path.joinpath(name).read_text() for name in ("part1.stl", "part2.stl")] == ["final\n", "final\n"]
+
+
+def test_save_to_file_progressive_relative_include(tmp_path: Path, fake_openscad):
+    tmp_path.joinpath("lib.scad").write_text("module part() { cube(1); }\n")
+    openscad_bin = fake_openscad(output='cat "$(dirname "$scad")/lib.scad" > /dev/null && echo $quality')
+    tasks = [RenderTask(union()(scad_inline("include <lib.scad>;\n"), cube(1)), tmp_path.joinpath("part1"))]
+    metrics = RenderMetricsCollector()
+
+    save_to_file(openscad_bin, tasks, file_types=[".stl"], verbose=True, metrics=metrics, draft=DraftQuality())
+
+    assert [f.read_text() for f in tmp_path.joinpath(DRAFTS_DIRNAME).rglob("part1.stl")] == ["draft\n"]
+    assert tmp_path.joinpath("part1.stl").read_text() == "final\n"
+    assert [m.ok for m in metrics.metrics] == [True, True]
+    assert not any(f.name.endswith("_draft.scad") for f in tmp_path.iterdir())
+
+
+def test_save_to_file_progressive_failed_final_removes_draft(tmp_path: Path, fake_openscad):
+    tasks = [RenderTask(cube(1), tmp_path.joinpath("part1")), RenderTask(cube(1), tmp_path.joinpath("part2"))]
+
+    def fail_final_renders(work):
+        return [render._render_to_file(task) if DRAFTS_DIRNAME in task.filename.parts else
+                (task.filename.absolute(), 0.) for task in work]
+
+    results = save_to_file(fake_openscad(output="echo $quality"), tasks, file_types=[".stl"], draft=DraftQuality(),
+                           executor=fail_final_renders)
+
+    assert all(elapsed == 0. for _, elapsed in results)
+    assert not tmp_path.joinpath("part1.stl").exists()
+    assert not tmp_path.joinpath("part2.stl").exists()
+
+
+def test_draft_quality_coarsens_per_node_resolution():
+    from solid2 import cylinder, sphere
+    scad = union()(scad_inline("$fa=1;\n"), cylinder(r=1, h=2, _fn=64), sphere(1, _fn=6)).as_scad()
+
+    coarse = DraftQuality().coarsen(scad)
+
+    assert "cylinder($fn = 16," in coarse
+    assert "sphere($fn = 6," in coarse
+    assert "$fa = 30" in coarse
+
+
+def test_save_previews(tmp_path: Path, fake_openscad):
+    openscad_bin = fake_openscad()
+    mesh = tmp_path.joinpath("part.stl")
+    mesh.write_text("solid part\nendsolid part\n")
+
+    first = save_previews(openscad_bin, [mesh])
+    assert first[0][1] > 0.
+    assert tmp_path.joinpath("part.png").exists()
+    assert tmp_path.joinpath("part.stl.preview.scad").read_text().startswith("import(")
+
+    assert save_previews(openscad_bin, [mesh])[0][1] == 0.
+    assert save_previews(openscad_bin, [mesh], PreviewSettings(camera="0,0,0,55,0,25,140"))[0][1] > 0.
+
+    mesh.write_text("solid other\nendsolid other\n")
+    assert save_previews(openscad_bin, [mesh], PreviewSettings(camera="0,0,0,55,0,25,140"))[0][1] > 0.
+
+
+def _write_3mf(filename: Path, model: bytes) -> None:
+    with zipfile.ZipFile(filename, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", "<Types/>" * 100)
+        archive.writestr("3D/3dmodel.model", model)
+        archive.writestr("Metadata/thumbnail.png", b"\x89PNG" + bytes(range(256)) * 10,
+                         compress_type=zipfile.ZIP_STORED)
+
+
+def test_set_model_name(tmp_path: Path):
+    filename = tmp_path.joinpath("part.3mf")
+    model = b"<object name=\"OpenSCAD Model\">" + b"<vertex/>" * 300000 + b"<object name=\"OpenSCAD Model\">"
+    _write_3mf(filename, model)
+
+    set_model_name(filename, "part")
+
+    with zipfile.ZipFile(filename) as archive:
+        assert archive.testzip() is None
+        assert archive.read("3D/3dmodel.model") == model.replace(b"OpenSCAD Model", b"part")
+        assert archive.read("[Content_Types].xml") == b"<Types/>" * 100
+        assert archive.getinfo("3D/3dmodel.model").compress_type == zipfile.ZIP_DEFLATED
+        assert archive.getinfo("Metadata/thumbnail.png").compress_type == zipfile.ZIP_STORED
+
+
+def test_set_model_name_without_zipfile_internals(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(render, "_supports_raw_copy", lambda new: False)
+    filename = tmp_path.joinpath("part.3mf")
+    _write_3mf(filename, b"<object name=\"OpenSCAD Model\">")
+
+    set_model_name(filename, "part")
+
+    with zipfile.ZipFile(filename) as archive:
+        assert archive.testzip() is None
+        assert archive.read("3D/3dmodel.model") == b"<object name=\"part\">"
+        assert archive.read("Metadata/thumbnail.png") == b"\x89PNG" + bytes(range(256)) * 10
+        assert archive.getinfo("Metadata/thumbnail.png").compress_type == zipfile.ZIP_STORED
+
+
+def test_replace_stream_across_chunks():
+    for split in range(1, 14):
+        data = b"a" * ((1 << 20) - split) + b"OpenSCAD Model" + b"b" * 10
+        dst = io.BytesIO()
+        _replace_stream(io.BytesIO(data), dst, b"OpenSCAD Model", b"x")
+        assert dst.getvalue() == data.replace(b"OpenSCAD Model", b"x")
+
+
+def test_set_model_names(tmp_path: Path):
+    filenames = [tmp_path.joinpath(f"part{n}.3mf") for n in range(3)]
+    for filename in filenames:
+        _write_3mf(filename, b"<object name=\"OpenSCAD Model\">")
+
+    set_model_names(filenames, verbose=True)
+
+    for n, filename in enumerate(filenames):
+        with zipfile.ZipFile(filename) as archive:
+            assert archive.read("3D/3dmodel.model") == f"<object name=\"part{n}\">".encode()
+
+
+def _fake_wsl(tmp_path: Path, monkeypatch) -> Path:
+    bin_dir = tmp_path.joinpath("bin")
+    bin_dir.mkdir()
+    calls = tmp_path.joinpath("wsl_calls")
+    bin_dir.joinpath("wsl").write_text(f"#!/bin/sh\necho \"$*\" >> {calls.as_posix()}\nexec \"$@\"\n")
+    bin_dir.joinpath("wslpath").write_text("#!/bin/sh\necho \"/mnt$1\"\n")
+    bin_dir.joinpath("bash").write_text("#!/bin/sh\necho /usr/bin/openscad\n")
+    for script in bin_dir.iterdir():
+        script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir.as_posix()}{os.pathsep}/usr/bin{os.pathsep}/bin")
+    monkeypatch.setenv("XDG_CACHE_HOME", tmp_path.joinpath("cache").as_posix())
+    return calls
+
+
+def test_wslpaths_batched_and_memoized(tmp_path: Path, monkeypatch):
+    calls = _fake_wsl(tmp_path, monkeypatch)
+    paths = [f"/build/part{n}.stl" for n in range(5)]
+
+    assert _wslpaths(paths) == [f"/mnt{p}" for p in paths]
+    assert _wslpaths(paths[:2]) == [f"/mnt{p}" for p in paths[:2]]
+    assert len(calls.read_text().splitlines()) == 1
+
+    many = [f"/build/many{n}.stl" for n in range(100)]
+    assert _wslpaths(many) == [f"/mnt{p}" for p in many]
+    assert len(calls.read_text().splitlines()) == 3
+
+
+def test_find_openscad_cached(tmp_path: Path, monkeypatch):
+    calls = _fake_wsl(tmp_path, monkeypatch)
+
+    assert find_openscad() == "wsl /usr/bin/openscad"
+    assert find_openscad() == "wsl /usr/bin/openscad"
+    assert find_openscad("/opt/openscad") == "/opt/openscad"
+    assert len(calls.read_text().splitlines()) == 1
+
+
+def test_find_openscad_miss_not_cached(tmp_path: Path, monkeypatch):
+    calls = _fake_wsl(tmp_path, monkeypatch)
+    tmp_path.joinpath("bin", "bash").write_text("#!/bin/sh\n")
+
+    assert find_openscad() is None
+    assert find_openscad() is None
+    assert len(calls.read_text().splitlines()) == 2
+
+
+def _fake_openscad_3mf(tmp_path: Path) -> str:
+    script = tmp_path.joinpath("openscad3mf")
+    script.write_text("#!/usr/bin/env python3\n"
+                      "import sys, zipfile\n"
+                      f"open({tmp_path.joinpath('calls').as_posix()!r}, 'a').write('x')\n"
+                      "output = sys.argv[sys.argv.index('-o') + 1]\n"
+                      "with zipfile.ZipFile(output, 'w') as archive:\n"
+                      "    archive.writestr('3D/3dmodel.model', '<object name=\"OpenSCAD Model\"/>')\n")
+    script.chmod(0o755)
+    return script.as_posix()
+
+
+def test_save_to_file_content_duplicates(tmp_path: Path):
+    openscad_bin = _fake_openscad_3mf(tmp_path)
+    tasks = [RenderTask(cube(1), tmp_path.joinpath("left")), RenderTask(cube(1), tmp_path.joinpath("right")),
+             RenderTask(cube(2), tmp_path.joinpath("other"))]
+
+    results = dict(save_to_file(openscad_bin, tasks, file_types=[".3mf"], verbose=True))
+
+    assert tmp_path.joinpath("calls").read_text() == "xx"
+    assert all(elapsed > 0. for elapsed in results.values())
+    for name in ("left", "right", "other"):
+        with zipfile.ZipFile(tmp_path.joinpath(name).with_suffix(".3mf")) as archive:
+            assert archive.read("3D/3dmodel.model") == f"<object name=\"{name}\"/>".encode()
+        assert tmp_path.joinpath(name).with_suffix(".scad").exists()
+
+    save_to_file(openscad_bin, tasks, file_types=[".3mf"], verbose=True, remove_duplicates=False)
+    assert tmp_path.joinpath("calls").read_text() == "xxxxx"
+
+
+def test_save_to_file_relative_imports_not_duplicates(tmp_path: Path):
+    from solid2 import import_stl
+    openscad_bin = _fake_openscad_3mf(tmp_path)
+    tasks = [RenderTask(import_stl("mesh.stl"), tmp_path.joinpath(d, "part")) for d in ("a", "b")]
+    for d in ("a", "b"):
+        tmp_path.joinpath(d).mkdir()
+
+    save_to_file(openscad_bin, tasks, file_types=[".3mf"], verbose=True)
+
+    assert tmp_path.joinpath("calls").read_text() == "xx"
+
+
+def test_save_to_file_failure_keeps_outputs(tmp_path: Path, fake_openscad):
+    tasks = [RenderTask(cube(1), tmp_path.joinpath("part"))]
+    save_to_file(fake_openscad(), tasks, file_types=[".stl"], verbose=True)
+
+    assert save_to_file("false", tasks, file_types=[".stl"], verbose=True)[0][1] == 0.
+    assert tmp_path.joinpath("part.stl").read_text() == "solid\n"
+    assert [f.name for f in tmp_path.iterdir() if f.name.endswith("_tmp.stl")] == []
+
+
+IMPORT_BUDGET_S = .25
+
+
+def test_import_render_is_lazy():
+    code = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import solid2_utils.render, solid2_utils.cache, solid2_utils.mod\n"
+            "elapsed = time.perf_counter() - start\n"
+            "print(elapsed, *sorted({name.split('.')[0] for name in sys.modules} & {'solid2', 'numpy', 'asyncio'}))")
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                         env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)})
+    elapsed, *heavy = out.stdout.split()
+
+    assert heavy == []
+    assert float(elapsed) < IMPORT_BUDGET_S
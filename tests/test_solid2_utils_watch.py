@@ -0,0 +1,73 @@
+import importlib
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+from solid2_utils import watch as watch_module
+from solid2_utils.watch import _render_after, watch
+
+
+def _write_design(design_dir: Path, size: int) -> None:
+    filename = design_dir.joinpath("watch_design.py")
+    filename.write_text("from solid2 import cube\n"
+                        "from solid2_utils.render import RenderTask\n"
+                        "def tasks(output_dir):\n"
+                        f"    return [RenderTask(cube({size}), output_dir.joinpath('changing')),\n"
+                        "            RenderTask(cube(1), output_dir.joinpath('fixed'))]\n")
+    os.utime(filename, ns=(time.time_ns(), time.time_ns() + size * 1_000_000_000))
+
+
+def test_watch_rerenders_changed_tasks(tmp_path: Path, monkeypatch, fake_openscad):
+    design_dir = tmp_path.joinpath("design")
+    design_dir.mkdir()
+    _write_design(design_dir, 1)
+    monkeypatch.syspath_prepend(design_dir.as_posix())
+    importlib.import_module("watch_design")
+    rendered = []
+
+    thread = threading.Thread(target=watch, kwargs=dict(
+        build_tasks=lambda: sys.modules["watch_design"].tasks(tmp_path), openscad_bin=fake_openscad(),
+        file_types=[".stl"], roots=[design_dir], interval=.02, callback=lambda f, _: rendered.append(f.name),
+        generations=2))
+    thread.start()
+    try:
+        while len(rendered) < 2:
+            time.sleep(.02)
+        _write_design(design_dir, 2)
+        thread.join(timeout=30)
+    finally:
+        del sys.modules["watch_design"]
+
+    assert not thread.is_alive()
+    assert sorted(rendered) == ["changing", "changing", "fixed"]
+    assert "cube(size = 2)" in tmp_path.joinpath("changing.scad").read_text()
+
+
+def test_render_after_waits_for_cancelled_render(monkeypatch):
+    import asyncio
+    events = []
+
+    async def cancelled_render():
+        try:
+            await asyncio.sleep(10.)
+        finally:
+            await asyncio.sleep(.1)
+            events.append("cleaned up")
+
+    async def render(task, limit, timeout):
+        events.append(f"render {task}")
+
+    async def run():
+        previous = asyncio.create_task(cancelled_render())
+        await asyncio.sleep(0.)
+        previous.cancel()
+        second = asyncio.create_task(_render_after(previous, "second", None, None))
+        await asyncio.sleep(0.)
+        second.cancel()
+        await _render_after(second, "third", None, None)
+
+    monkeypatch.setattr(watch_module, "_render_to_file_async", render)
+    asyncio.run(run())
+    assert events == ["cleaned up", "render third"]